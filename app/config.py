@@ -8,19 +8,124 @@ APP_ROOT_DIR = os.path.abspath(os.path.dirname(__file__))
 DROPBOX_CONFIG_FILE = os.path.join(APP_ROOT_DIR,'config_dropbox.ini')
 DROPBOX_POLL_INTERVAL = datetime.timedelta(seconds=120)     # Min interval between full recursive syncs
 DROPBOX_FILE_POLL_INTERVAL = datetime.timedelta(seconds=10) # Min interval between single file syncs
+DROPBOX_SYNC_WINDOW = 8 # Max number of metadata requests in flight during a sync
+DROPBOX_SYNC_MODE = 'walk' # Full syncs: 'walk' the tree by hash, follow the 'delta' feed from a stored cursor,
+                           # or walk to make a 'plan' of the changes and apply it in bulk (per task
+                           # of the SyncRun, see models.plan)
+PLAN_APPLY_BATCH = 500 # Entries written, and handled per resource class, in one batch when applying a plan
+PLAN_MAX_AGE = 600     # Seconds a stored plan may be applied after it was made
+PLAN_CHUNK_SIZE = 512*1024 # Stored plans larger than this (compressed) are split into chunks (must stay below the 1MB entity limit)
+
+#Streaming listings: directory contents are parsed while the response is read, and matched
+#with the datastore in batches of SYNC_LISTING_BATCH entries, so large directories do not
+#need the full listing in memory. As there is no asynchronous streaming request, listings
+#are then fetched concurrently by threads rather than by RPCs (see fetchers.make_fetcher).
+#Each batch is sorted by path before matching; if the batches of a listing overlap, the
+#rest of it is matched in memory.
+STREAMING_LISTINGS = False
+SYNC_LISTING_BATCH = 200
+
+#Adaptive polling (walk mode): each dir is polled on its own schedule, backing off
+#by POLL_BACKOFF while unchanged, and the scheduler syncs only the dirs that are due.
+#Intervals in seconds. POLL_MIN_INTERVAL also limits how often the scheduler runs.
+ADAPTIVE_POLLING = True
+POLL_MIN_INTERVAL = 30
+POLL_MAX_INTERVAL = 24*3600
+POLL_BACKOFF = 2
+POLL_MAX_DUE_DIRS = 100 # Max number of due dirs picked up by one scheduler run
+
+#Walking syncs are split across tasks, each syncing at most SYNC_TASK_MAX_DIRS dirs
+#and handing the remaining subtrees on to at most SYNC_FANOUT child tasks
+#(enqueued transactionally, so at most 5)
+SYNC_TASK_MAX_DIRS = 50
+SYNC_FANOUT = 5
+SYNC_RUN_TIMEOUT = datetime.timedelta(minutes=30) # A run not updated for this long is abandoned
+
+#Change notifications (webhooks) pushed by Dropbox to NOTIFY_URL trigger a sync of the
+#affected dirs after NOTIFY_DEBOUNCE seconds. Notifications are signed with NOTIFY_SECRET,
+#or if None, the consumer secret from DROPBOX_CONFIG_FILE.
+#With notifications set up, ACCESS_TRIGGERED_SYNC can be set to False so that
+#visits never trigger syncs.
+NOTIFY_URL = '/_notify/dropbox'
+NOTIFY_SECRET = None
+NOTIFY_DEBOUNCE = 10
+ACCESS_TRIGGERED_SYNC = True
+
+#All Dropbox requests share a rate limit of DROPBOX_RATE_LIMIT requests per second, in bursts of
+#up to DROPBOX_RATE_BURST. A request waits up to DROPBOX_RATE_MAX_WAIT seconds for its turn.
+DROPBOX_RATE_LIMIT = 10
+DROPBOX_RATE_BURST = 20
+DROPBOX_RATE_MAX_WAIT = 2
+
+#Circuit breaker: after BREAKER_THRESHOLD consecutive failed requests, Dropbox is left alone
+#for BREAKER_BASE_DELAY seconds, doubling (up to BREAKER_MAX_DELAY) while probes keep failing.
+#A probe that has not completed in BREAKER_PROBE_TIMEOUT seconds is given up.
+BREAKER_THRESHOLD = 5
+BREAKER_BASE_DELAY = 30
+BREAKER_MAX_DELAY = 30*60
+BREAKER_PROBE_TIMEOUT = 60
 
 #Restrictions to keep the GAE load down:
 PROXY_MAX_AGE = 3600  #For cache-control in Google's reverse proxy. Currently used for *.ico
 PROXY_ENABLED = True  #Whether to enable reverse proxy
 
+#Full response cache. Entries expire after a poll interval, so visits still trigger syncs
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_MAX_AGE = DROPBOX_POLL_INTERVAL.seconds
+RESPONSE_CACHE_MAX_SIZE = 900*1000 #memcache values are limited to 1MB
+CACHED_ACCESS_NOTIFY_INTERVAL = 60 #Seconds between access notifications for hits on a cached resource
+
+#Stale-while-revalidate: when a new revision of a requested resource is pending, it is
+#fetched inline if that is estimated to take less than SWR_BUDGET seconds, or if it has
+#been pending for more than SWR_MAX_STALE seconds. Otherwise the current revision is served
+#and the fetch is left to an interactive task. Both can be set per pattern with the
+#swr_budget and swr_max_stale resource default attributes.
+SWR_ENABLED = True
+SWR_BUDGET = 1.0
+SWR_MAX_STALE = 600
+SWR_FETCH_LATENCY = 0.3           # Estimated seconds for a Dropbox download to start
+SWR_FETCH_BANDWIDTH = 1024*1024   # Estimated bytes per second for a Dropbox download
+SWR_MAX_INLINE_FETCH = 10         # Larger fetches are never made inline, however stale the resource
+
+#Max age of the instance copies of the list of known urls used to reject requests
+#for unknown pages. The list itself is kept up to date in memcache.
+KNOWN_URLS_MAX_AGE = 60
+KNOWN_URLS_SETTLE = 30 # Seconds after a url is indexed before the index query is trusted to include it
+URL_BACKFILL_INTERVAL = 600 # Seconds between backfills queued while the url index is incomplete
+
+#Precompressed variants are stored for compressible content above this size
+GZIP_MIN_SIZE = 512
+GZIP_LEVEL = 9
+
+#Files larger than this are stored in chunks of this size (must stay below the 1MB entity limit)
+CONTENT_CHUNK_SIZE = 512*1024
+CONTENT_CHUNK_GRACE = 300 # Seconds the chunks of a replaced revision are kept for requests still reading them
+
 #Django configuration
 TEMPLATE_DIR='/templates'
+TEMPLATE_CACHE_SIZE = 50 #Compiled templates kept in instance memory
 DJANGO_CONFIG_MODULE = 'config_django'
 
 #URL's for the admin interface
 ADMIN_URL='/admin/'
 CDEFERRED_URL = '/admin/_cdeferred'
-RESOURCE_QUEUENAME = 'default'
+#Task priority classes (the _priority argument of cdefer) and their queues (see queue.yaml)
+TASK_PRIORITY_QUEUES = {
+    'interactive': 'interactive', # On behalf of a visitor waiting for a resource
+    'sync': 'sync',               # Background syncs and resource updates
+    'bulk': 'bulk',               # Re-verification and other cold work
+    }
+RESOURCE_PRIORITY = 'sync'
+
+#Resource fetches and formatting are coalesced into batch tasks, run at most every
+#BATCH_DELAY seconds. Each handles up to BATCH_SIZE actions, downloading up to
+#BATCH_FETCH_WINDOW files at a time.
+BATCH_ACTIONS_ENABLED = True
+BATCH_DELAY = 5
+BATCH_SIZE = 20
+BATCH_FETCH_WINDOW = 4
+BATCH_MAX_ATTEMPTS = 3
+BATCH_SETTLE = 30 # Batches reschedule until this many seconds after the last action was added
 
 #Constants for the admin templates
 TEMPLATE_SETTINGS={
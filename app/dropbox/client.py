@@ -230,6 +230,62 @@ class DropboxClient(object):
 
         return self.api_rest.GET(url, headers)
 
+    def metadata_async(self, root, path, file_limit=10000, hash=None, list=True, status_in_response=False, callback=None):
+        """
+        As metadata, but returns a dropbox.rest.AsyncRESTResponse without
+        waiting for the result. Only available on App Engine.
+        """
+        assert root in ["dropbox", "sandbox"]
+
+        path = "/metadata/%s%s" % (root, path)
+
+        params = {'file_limit': file_limit,
+                  'list': "true" if list else "false",
+                  'status_in_response': status_in_response}
+        if hash is not None:
+            params['hash'] = hash
+
+        url, headers, params = self.request(self.api_host, "GET", path, params, callback)
+
+        return self.api_rest.request_async("GET", url, headers=headers)
+
+    def metadata_stream(self, root, path, file_limit=10000, hash=None):
+        """
+        As metadata for a listing, but returns a dropbox.rest.JSONStreamResponse,
+        from which the contents of a directory are read one entry at a time by
+        iter_array(). The data attribute holds the other fields. Close the
+        response when done.
+        """
+        assert root in ["dropbox", "sandbox"]
+
+        path = "/metadata/%s%s" % (root, path)
+
+        params = {'file_limit': file_limit, 'list': "true"}
+        if hash is not None:
+            params['hash'] = hash
+
+        url, headers, params = self.request(self.api_host, "GET", path, params, None)
+
+        return self.api_rest.request("GET", url, headers=headers, stream_key='contents')
+
+    def delta(self, cursor=None):
+        """
+        Retrieve the entries changed since cursor, or all entries if no
+        cursor is given. The data of the response is a dict with
+
+        * entries. A list of [path, metadata] pairs. The path is lower case, and metadata is None for deleted entries.
+        * reset. If true, discard all state from earlier calls before applying entries.
+        * cursor. Pass this to the next call.
+        * has_more. If true, call again right away to get more entries.
+        """
+        params = {}
+        if cursor is not None:
+            params['cursor'] = cursor
+
+        url, headers, params = self.request(self.api_host, "POST", "/delta", params, None)
+
+        return self.api_rest.POST(url, params, headers)
+
     def links(self, root, path):
         assert root in ["dropbox", "sandbox"]
         path = "/links/%s%s" % (root, path)
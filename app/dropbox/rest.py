@@ -6,9 +6,112 @@ unless you're implementing unsupport methods.
 
 
 import httplib
+import socket
+import time
 import simplejson as json
 import urllib
 
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+try:
+    import select
+except ImportError:
+    select = None
+
+
+class ConnectionPool(object):
+    """
+    Keeps idle HTTP connections per (host, port) for reuse, so that a
+    sequence of requests to the same host does not pay for a new TCP
+    connection each time.
+
+    Connections idle for longer than idle_timeout seconds are closed rather
+    than reused, and at most max_idle connections are kept for each host.
+    A single pool (the module-level `pool`) is shared by all RESTClients
+    in the process.
+    """
+
+    connection_class = httplib.HTTPConnection
+
+    def __init__(self, idle_timeout=30, max_idle=4):
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, host, port):
+        """
+        Returns (connection, reused), reused being True for a kept-alive connection
+        """
+        now = time.time()
+        while True:
+            self._lock.acquire()
+            try:
+                idle = self._idle.get((host, port))
+                if not idle:
+                    break
+                conn, released = idle.pop()
+            finally:
+                self._lock.release()
+            if now - released < self.idle_timeout and self.is_healthy(conn):
+                return (conn, True)
+            conn.close()
+        return (self.connection_class(host, port), False)
+
+    def put(self, host, port, conn):
+        """
+        Return a connection whose last response has been fully read
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault((host, port), [])
+            if len(idle) < self.max_idle:
+                idle.append((conn, time.time()))
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def release(self, host, port, conn, http_resp):
+        """
+        Keep conn for reuse if the server allows it, otherwise close it
+        """
+        if http_resp.will_close or not http_resp.isclosed():
+            conn.close()
+        else:
+            self.put(host, port, conn)
+
+    def is_healthy(self, conn):
+        """
+        An idle connection is usable if it still has its socket, and the
+        server has not closed it or sent anything unrequested.
+        """
+        sock = getattr(conn, 'sock', None)
+        if sock is None:
+            return False
+        if select is None:
+            return True
+        try:
+            readable = select.select([sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for conns in idle.values():
+            for conn, released in conns:
+                conn.close()
+
+pool = ConnectionPool()
+
 
 class RESTClient(object):
     """
@@ -19,11 +122,12 @@ class RESTClient(object):
     It is not designed well for file uploads.
     """
     
-    def __init__(self, host, port):
+    def __init__(self, host, port, connection_pool=None):
         self.host = host
         self.port = port
+        self.pool = connection_pool or pool
 
-    def request(self, method, url, post_params=None, headers=None, raw_response=False):
+    def request(self, method, url, post_params=None, headers=None, raw_response=False, stream_key=None):
         """
         Given the method and url this will make a JSON REST request to the
         configured self.host:self.port and returns a RESTResponse for you.
@@ -34,7 +138,15 @@ class RESTClient(object):
         The raw_response parameter determines if you get a RESTResponse or a 
         raw HTTPResponse object.  In some cases, like getting a file, you 
         don't want any JSON decoding or extra processing.  In that case set
-        this to True and you'll get a plain HTTPResponse.
+        this to True and you'll get a plain HTTPResponse. Close it when
+        done, so that the connection can be reused.
+
+        With stream_key, you get a JSONStreamResponse, which parses the
+        array under stream_key in the body while it is read.
+
+        Connections are taken from the shared pool. A GET on a kept-alive
+        connection which turns out to be closed by the server is retried
+        once on a fresh connection.
         """
         params = post_params or {}
         headers = headers or {}
@@ -47,17 +159,55 @@ class RESTClient(object):
         if body:
             headers["Content-type"] = "application/x-www-form-urlencoded"
 
-        conn = httplib.HTTPConnection(self.host, self.port)
-        conn.request(method, url, body, headers)
+        conn, reused = self.pool.get(self.host, self.port)
+        try:
+            conn.request(method, url, body, headers)
+            http_resp = conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not (reused and method == "GET"):
+                raise
+            conn = self.pool.connection_class(self.host, self.port)
+            try:
+                conn.request(method, url, body, headers)
+                http_resp = conn.getresponse()
+            except:
+                conn.close()
+                raise
 
         if raw_response:
-            return conn.getresponse()
-        else:
-            resp = RESTResponse(conn.getresponse())
-            conn.close()
+            return PooledResponse(http_resp, conn, self)
+
+        if stream_key:
+            try:
+                return JSONStreamResponse(PooledResponse(http_resp, conn, self), stream_key)
+            except:
+                conn.close()
+                raise
 
+        try:
+            resp = RESTResponse(http_resp)
+        except:
+            conn.close()
+            raise
+        self.release(conn, http_resp)
         return resp
 
+    def release(self, conn, http_resp):
+        self.pool.release(self.host, self.port, conn, http_resp)
+
+    def request_async(self, method, url, headers=None, deadline=None):
+        """
+        Start a request via the App Engine urlfetch service and return an
+        AsyncRESTResponse without waiting for the result.
+        Only available when running on App Engine.
+        """
+        from google.appengine.api import urlfetch
+        rpc = urlfetch.create_rpc(deadline=deadline)
+        urlfetch.make_fetch_call(rpc, 'http://%s:%d%s' % (self.host, self.port, url),
+                                 method=method, headers=headers or {})
+        return AsyncRESTResponse(rpc)
+
     def GET(self, url, headers=None):
         """Convenience method that just does a GET request."""
         return self.request("GET", url, headers=headers)
@@ -90,4 +240,191 @@ class RESTResponse(object):
             self.data = None
 
 
+class PooledResponse(object):
+    """
+    Returned by RESTClient.request for raw_response=True. Behaves like the
+    wrapped HTTPResponse. Closing it returns the connection to the pool if
+    the body has been read completely, and closes the connection otherwise.
+    """
+
+    def __init__(self, http_resp, conn, rest_client):
+        self.http_response = http_resp
+        self._conn = conn
+        self._client = rest_client
+
+    def __getattr__(self, name):
+        return getattr(self.http_response, name)
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        self._client.release(conn, self.http_response)
+        self.http_response.close()
+
+
+class JSONStreamResponse(object):
+    """
+    Returned by RESTClient.request for stream_key. For a body holding a JSON
+    object with a (possibly large) array under stream_key, the array is
+    parsed while the body is read, so only one element at a time is held
+    in memory: data holds the other members of the object, and
+    iter_array() yields the elements of the array. Members following the
+    array are added to data once the array has been read.
+    Responses with a status other than 200 are read and parsed as a whole.
+
+    Close the response when done, so that the connection can be reused.
+    """
+
+    chunk_size = 64*1024
+    decoder = json.JSONDecoder()
+
+    def __init__(self, http_resp, stream_key):
+        self.http_response = http_resp
+        self.status = http_resp.status
+        self.reason = http_resp.reason
+        self.headers = dict(http_resp.getheaders())
+        self.stream_key = stream_key
+        self.body = ''
+        self.data = None
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._in_array = False
+        if self.status != 200:
+            self.body = http_resp.read()
+            self.close()
+            try:
+                self.data = json.loads(self.body)
+            except ValueError:
+                pass
+            return
+        self.data = {}
+        self._expect('{')
+        if not self._read_members():
+            self.close()
+
+    def _fill(self):
+        if self._eof:
+            return False
+        chunk = self.http_response.read(self.chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        if self._pos > self.chunk_size:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        self._buf += chunk
+        return True
+
+    def _peek(self):
+        """
+        Skip whitespace and return the next character ('' at the end of the body)
+        """
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buf) or not self._fill():
+                return self._buf[self._pos:self._pos+1]
+
+    def _expect(self, c):
+        if self._peek() != c:
+            raise ValueError('Expected %r at position %d of JSON stream'%(c, self._pos))
+        self._pos += 1
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self._buf, self._pos)
+                # A number at the end of the buffer might go on in the next chunk
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def _read_members(self):
+        """
+        Read members of the object into data until the streamed array is
+        reached (returns True) or the object ends (returns False)
+        """
+        if self._peek() == '}':
+            self._pos += 1
+            return False
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == self.stream_key:
+                self._expect('[')
+                self._in_array = True
+                return True
+            self.data[key] = self._value()
+            c = self._peek()
+            self._pos += 1
+            if c == '}':
+                return False
+            if c != ',':
+                raise ValueError('Expected , or } at position %d of JSON stream'%(self._pos-1))
+
+    def has_array(self):
+        return self._in_array
+
+    def iter_array(self):
+        if not self._in_array:
+            return
+        try:
+            if self._peek() == ']':
+                self._pos += 1
+            else:
+                while True:
+                    yield self._value()
+                    c = self._peek()
+                    self._pos += 1
+                    if c == ']':
+                        break
+                    if c != ',':
+                        raise ValueError('Expected , or ] at position %d of JSON stream'%(self._pos-1))
+            self._in_array = False
+            c = self._peek()
+            self._pos += 1
+            if c == ',':
+                self._read_members()
+            elif c != '}':
+                raise ValueError('Expected , or } at position %d of JSON stream'%(self._pos-1))
+        finally:
+            self.close()
+
+    def close(self):
+        self._buf = ''
+        self.http_response.close()
+
+
+class AsyncRESTResponse(object):
+    """
+    Returned by RESTClient.request_async. The rpc attribute is the urlfetch
+    rpc, and get_result() waits for it and returns a RESTResponse.
+    """
+
+    def __init__(self, rpc):
+        self.rpc = rpc
+
+    def get_result(self):
+        return RESTResponse(_UrlfetchResponse(self.rpc.get_result()))
+
+
+class _UrlfetchResponse(object):
+    """Adapts a urlfetch result to the parts of HTTPResponse used by RESTResponse"""
+
+    def __init__(self, result):
+        self.status = result.status_code
+        self.reason = ''
+        self._result = result
+
+    def read(self):
+        return self._result.content
 
+    def getheaders(self):
+        return self._result.headers.items()
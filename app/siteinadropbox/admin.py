@@ -19,6 +19,7 @@ from siteinadropbox import controller
 from siteinadropbox import cache
 from siteinadropbox.handlers import dropboxhandlers
 from siteinadropbox.handlers.cdeferred import CDeferredHandler
+from siteinadropbox.handlers.notify import NotificationHandler
 
 def admin_url(s=None):
     if not s:
@@ -171,6 +172,7 @@ class StatusHandler(BaseHandler):
             'site_raw': site,
             'dropbox_info': dropbox_info,
             'config_path': site.get_config_path(),
+            'guard': models.get_guard_status(),
             },'admin_status.html')
 
 def list_all_resources(nmax=1000):
@@ -222,18 +224,54 @@ class ConfigHandler(BaseHandler):
                                 template_values = {'config_default': config.DEFAULT_CONFIG_YAML,
                                                     'config_path': config_path,
                                                     'config_src': config_src})
-        
+
+class PlanHandler(BaseHandler):
+    """
+    Dry run of a sync: shows the latest plan of the changes, which can then
+    be applied. Plans are made in a task, as walking Dropbox may take longer
+    than a request may.
+    """
+    @owneronly
+    def get(self):
+        plan = models.SyncPlan.get_latest()
+        self.render_to_template(template_name= 'admin_plan.html',
+                                template_values = {'plan': plan,
+                                                   'plan_key': plan and str(plan.key()),
+                                                   'stale': plan and plan.is_stale(),
+                                                   'changes': plan and plan.get_diff(),
+                                                   'max_age': config.PLAN_MAX_AGE})
+
+    @owneronly
+    def post(self):
+        """
+        Callers should supply 'action': 'make' or 'apply', with 'plan_key'
+        """
+        gov = controller.get_current_site_controller()
+        action = self.request.POST.get('action', 'apply').lower()
+        assert(action in ['make', 'apply'])
+        if action == 'make':
+            logging.debug('Admin/plan: making plan')
+            gov.cdefer(models.make_stored_plan, _priority='sync')
+        else:
+            plan_key = self.request.POST.get('plan_key')
+            logging.debug('Admin/plan: applying %s'%plan_key)
+            gov.cdefer(models.apply_plan_by_key, plan_key, _priority='sync')
+        self.redirect('%s?%s'%(admin_url(), urllib.urlencode({'action': '%s plan'%action, 'response': 'scheduled'})))
+
 def main():
     logging.getLogger().setLevel(logging.DEBUG)
     CDeferredHandler.set_controller_factory(controller.get_current_site_controller)
+    NotificationHandler.set_controller_factory(controller.get_current_site_controller)
 
     routes=[
         (admin_url()[:-1], webapp.RedirectHandler.new_factory(admin_url(), permanent=True)),
         (admin_url(), StatusHandler),
         (admin_url('config'), ConfigHandler),
         (admin_url('content'), ContentHandler),
+        (admin_url('plan'), PlanHandler),
         (admin_url('authorize-dropbox'), dropboxhandlers.AuthHandler.new_factory(formurl = admin_url('authorize-dropbox'), returnurl=admin_url())),
-        (config.CDEFERRED_URL, CDeferredHandler)
+        (config.CDEFERRED_URL, CDeferredHandler),
+        (config.NOTIFY_URL, NotificationHandler)
         ]
     application = webapp.WSGIApplication(routes,debug=True)
     wsgiref.handlers.CGIHandler().run(application)
@@ -8,6 +8,7 @@ to always be valid.
 
 import logging
 import functools
+import time
 
 from google.appengine.api import memcache
 
@@ -117,3 +118,95 @@ def flush_all():
     Flush all cached values for current namespace
     """
     memcache.flush_all()
+
+
+class LRUCache(object):
+    """
+    A small instance-local cache, evicting the least recently used
+    entry when full.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.clear()
+
+    def clear(self):
+        self._data = {}
+        self._used = {}
+        self._tick = 0
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        self._tick += 1
+        self._used[key] = self._tick
+        return self._data[key]
+
+    def set(self, key, value):
+        if key not in self._data and len(self._data) >= self.max_size:
+            oldest = min(self._used, key=self._used.get)
+            del self._data[oldest]
+            del self._used[oldest]
+        self._tick += 1
+        self._data[key] = value
+        self._used[key] = self._tick
+
+class Generation(object):
+    """
+    A memcache counter identifying the current version of some
+    site-wide state. Values cached under a key that includes the
+    generation are invalidated by bumping it.
+
+    Counters are (re)initialized from the clock, so a memcache flush
+    will not bring back an old generation.
+    """
+    def __init__(self, name):
+        self.key = '_generation:%s'%name
+
+    def get(self):
+        val = memcache.get(self.key)
+        if val is None:
+            memcache.add(self.key, int(time.time()*1000))
+            val = memcache.get(self.key)
+        return val
+
+    def bump(self):
+        return memcache.incr(self.key, initial_value=int(time.time()*1000))
+
+response_generation = Generation('responses')
+template_generation = Generation('templates')
+config_generation = Generation('config')
+controller_generation = Generation('controller')
+
+def _response_key(url):
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return '_response:%s:%s'%(response_generation.get(), url.lower())
+
+def get_cached_response(url):
+    """
+    Returns a (status, headers, body, body_gz, resource_key) tupple stored by
+    set_cached_response or None.
+    """
+    return memcache.get(_response_key(url))
+
+def set_cached_response(url, status, headers, body, body_gz, max_age, resource_key=None):
+    """
+    Cache a full response for url. Either body or the gzipped body_gz
+    may be None. resource_key is the (string) key of the resource served,
+    if any. The entry is dropped after max_age seconds or when
+    flush_responses is called.
+    """
+    memcache.set(_response_key(url), (status, headers, body, body_gz, resource_key),
+                 time=max_age)
+
+def flush_response(url):
+    """
+    Invalidate the cached response for url
+    """
+    memcache.delete(_response_key(url))
+
+def flush_responses():
+    """
+    Invalidate all cached responses for current namespace
+    """
+    response_generation.bump()
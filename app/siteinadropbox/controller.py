@@ -5,9 +5,12 @@ import traceback
 import types
 import os.path
 
+from google.appengine.api import namespace_manager
+
 import config
 from siteinadropbox import models
 from siteinadropbox import cache
+from siteinadropbox import templateloader
 from siteinadropbox.handlers import cdeferred
 from siteinadropbox.handlers import dropboxhandlers
 
@@ -20,6 +23,8 @@ both to allow more modular code and to avoid circular import problems...
 """
 
 class BaseController(object):
+    # Priority of the resource actions scheduled, if not that of each resource
+    action_priority = None
 
     def __init__(self, site):
         self.site = site
@@ -113,8 +118,21 @@ class BaseController(object):
 
     def handle_config_changes(self):
         logging.debug('Config has changed')
+        cache.flush_responses()
+        cache.config_generation.bump()
+        cache.controller_generation.bump()
         cache.flush_all()
-        self.cdefer(verify_database_consistency, _countdown =2)
+        # Verifying halfway through a sync is wasted: wait for the run to complete
+        if not models.SyncRun.add_followup('verify_database_consistency'):
+            self.cdefer(verify_database_consistency, _countdown =2, _priority='bulk')
+
+    def handle_sync_complete(self, run):
+        """
+        Called when the last task of a SyncRun has completed.
+        """
+        logging.debug('Sync completed: %s'%run)
+        if 'verify_database_consistency' in run.followups:
+            self.cdefer(verify_database_consistency, _priority='bulk')
 
     def format_error_notify(self, resource, exception):
         """
@@ -136,11 +154,22 @@ class BaseController(object):
         """
         logging.debug('access_error_notify called')
 
-    def resource_access_notify(self, resource = None, url = None):
-        logging.debug('Resource accessed: %s'%(resource or (url and '%s by url'%url) ))
+    def resource_access_notify(self, resource = None, url = None, resource_key = None):
+        """
+        Should be called when a resource (or, for cached responses, the
+        resource with resource_key) or a non-existing url is accessed
+        """
+        logging.debug('Resource accessed: %s'%(
+                resource or resource_key or (url and '%s by url'%url) ))
 
     def do_verify_database_consistency(self):
-        models.DirEntry.verify_all_resources(self)
+        models.UrlIndex.backfill()
+        # Whatever the walk finds out of date is cold work: fetch it as such
+        self.action_priority = 'bulk'
+        try:
+            models.DirEntry.verify_all_resources(self)
+        finally:
+            self.action_priority = None
         models.Resource.delete_orphans(self)
 
     #Relies on cache.flush_all at config change
@@ -169,45 +198,107 @@ class BaseController(object):
         gov.cdefer(obj,*args, **kwargs) will do a deferred execution of
         obj(gov, *args, **kwargs).
         You can pass extra arguments for the defer library:
-        _countdown, _eta, _name, _transactional, _url, _queue
+        _countdown, _eta, _name, _transactional, _url, _queue, _priority
         """
         logging.debug('cdefer called')
 
 class Controller(BaseController):
+    # Resource actions are coalesced into batch tasks, see models.batch
+    batch_actions = config.BATCH_ACTIONS_ENABLED
+
+    def handle_resource_changes(self, created=[], updated=[], removed=[]):
+        BaseController.handle_resource_changes(self, created, updated, removed)
+        cache.flush_responses()
+        models.clear_pending_revisions(created+updated)
+        template_prefix = config.TEMPLATE_DIR.lower()+'/'
+        templates = [r for r in created+updated+removed if r.url.startswith(template_prefix)]
+        for r in templates:
+            templateloader.flush_template_source(r.parent_key().name())
+        if templates:
+            cache.template_generation.bump()
+
     def handle_metadata_changes(self, created=[], updated=[], removed=[]):
         cu = created + updated
         logging.debug('Updating resources for %s'%', '.join(str(e) for e in cu))
         
-        for entry in created+updated:
-            models.Resource.update(self, entry)
+        if self.batch_actions:
+            # Actions scheduled by the updates are written together
+            models.collect_actions(self)
+        try:
+            for entry in created+updated:
+                models.Resource.update(self, entry)
+        finally:
+            if self.batch_actions:
+                models.flush_actions(self)
+        if removed:
+            # Resources below removed entries are deleted without notification
+            cache.flush_responses()
+            template_dir = config.TEMPLATE_DIR.lower()
+            for e in removed:
+                path = e.get_path().rstrip('/')
+                if (path == template_dir or path.startswith(template_dir+'/') or
+                    template_dir.startswith(path+'/')):
+                    # Drops the cached sources along with the compiled templates
+                    cache.template_generation.bump()
+                    break
 
     def cdefer(self, obj, *args, **kwargs):
         """
         gov.cdefer(obj,*args, **kwargs) will do a deferred execution of
         obj(gov, *args, **kwargs).
         You can pass extra arguments for the defer library:
-        _countdown, _eta, _name, _transactional, _url, _queue
+        _countdown, _eta, _name, _transactional, _url, _queue, _priority
         """
         cdeferred.defer(obj, *args, **kwargs)
 
-    def resource_access_notify(self, resource = None, url = None):
-        BaseController.resource_access_notify(self, resource, url)
-        #TODO cache here!
+    def resource_access_notify(self, resource = None, url = None, resource_key = None):
+        BaseController.resource_access_notify(self, resource, url, resource_key)
         entry = None
-        if (not resource) and url:
+        if (not resource) and (not resource_key) and url:
             resource = models.Resource.get_resource_by_url(url)
         if resource:
-            entry = resource.parent()
-        models.schedule_sync(self, entry=entry)
+            resource_key = resource.key()
+        if resource_key:
+            # The key is enough: schedule_sync only fetches the entry if needed
+            entry = resource_key.parent()
+        if config.ACCESS_TRIGGERED_SYNC:
+            models.schedule_sync(self, entry=entry)
+        if resource_key and self.batch_actions:
+            # Someone is waiting for this one: run its pending actions first
+            models.promote_actions(self, resource_key)
+
+# Instance-local controllers: namespace -> (controller generation, controller)
+# The site-object doesn't pickle, so controllers can't go in memcache.
+_controllers = {}
+
+def get_loaded_site_controller():
+    """
+    Returns the controller for the current namespace if this instance
+    has a current one loaded, otherwise None. Never touches the datastore.
+    """
+    cached = _controllers.get(namespace_manager.get_namespace())
+    if cached and cached[0] == cache.controller_generation.get():
+        return cached[1]
 
-#@cache.memoize()
-#Can't cache the whole controller as the site-object doesn't pickle
 def get_current_site_controller():
+    """
+    Returns the controller for the current namespace.
+    Controllers are kept in instance memory and reused until
+    cache.controller_generation is bumped by a config change or
+    an update of the Site entity.
+    """
+    gov = get_loaded_site_controller()
+    if gov:
+        return gov
+    namespace = namespace_manager.get_namespace()
+    generation = cache.controller_generation.get()
     site = models.Site.get_current_site()
     if not site:
         raise models.InvalidSiteError('Site not registered')
     # This might also raise InvalidSiteError
-    return Controller(site)
+    gov = Controller(site)
+    _controllers[namespace] = (generation, gov)
+    return gov
 
 def verify_database_consistency(gov):
     return gov.do_verify_database_consistency()
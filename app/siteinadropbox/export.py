@@ -0,0 +1,319 @@
+"""
+Static export of a site.
+
+Renders every resource of the current namespace to a directory tree or a
+tar stream, so the site can be served from a CDN or any static file server.
+A manifest maps urls to files and records content types and validators,
+which are used to only rewrite changed files on re-export.
+
+The export can run on the datastore of a live site (export_site), or
+straight off a DropboxClient-compatible backend such as test.dbtools.FakeClient
+or localclient.LocalFolderClient (export_from_client, which needs the
+datastore and memcache stubs).
+Pages are rendered in parallel across a process pool when available.
+
+Command line use:
+  python -m siteinadropbox.export --state-zip test/pickledsites/C0.zip out/
+  python -m siteinadropbox.export --local-root ~/Dropbox --base-dir /Public/mysite out/
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import os
+import sys
+import logging
+import tarfile
+import time
+import zlib
+import hashlib
+import mimetypes
+from cStringIO import StringIO
+import simplejson as json
+
+from google.appengine.ext import db
+
+import config
+from siteinadropbox import models
+from siteinadropbox import controller
+from siteinadropbox import cache
+from siteinadropbox import templateloader
+from siteinadropbox.handlers import cdeferred
+from siteinadropbox.models import resources
+
+MANIFEST_NAME = '.export-manifest.json'
+PAGE_CONTENT_TYPE = 'text/html; charset=utf-8'
+
+class ExportController(controller.BaseController):
+    """
+    A controller executing all deferred calls immediately, for syncing
+    a site into the datastore stubs.
+    """
+    def __init__(self, site):
+        controller.BaseController.__init__(self, site)
+        # Keys of the entries updated so far, see handle_config_changes
+        self.updated_keys = []
+
+    def handle_metadata_changes(self, created=[], updated=[], removed=[]):
+        for entry in created+updated:
+            models.Resource.update(self, entry)
+            self.updated_keys.append(entry.key())
+
+    def handle_config_changes(self):
+        """
+        Nothing is served from this datastore, so only the memoized default
+        attributes and the parsed config need flushing. Rather than verifying
+        the database, the entries updated before the change are updated
+        again, as the rest of the sync sees the new config.
+        """
+        cache.flush_all()
+        self._parse_config_yaml()
+        for entry in db.get(self.updated_keys):
+            if entry:
+                models.Resource.update(self, entry)
+
+    def cdefer(self, obj, *args, **kwargs):
+        cdeferred.pop_task_options(kwargs)
+        obj(self, *args, **kwargs)
+
+def url_to_path(url, is_page):
+    """
+    Map a url to a relative file path. Directory urls get an index.html,
+    and pages without an extension get a .html extension.
+    """
+    path = url.lstrip('/')
+    if not path or path.endswith('/'):
+        return path+'index.html'
+    if is_page and not os.path.splitext(path)[1]:
+        return path+'.html'
+    return path
+
+class DirectoryWriter(object):
+    def __init__(self, root):
+        self.root = root
+
+    def read_manifest(self):
+        try:
+            with open(os.path.join(self.root, MANIFEST_NAME)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def exists(self, path):
+        return os.path.exists(os.path.join(self.root, path))
+
+    def write(self, path, data):
+        filename = os.path.join(self.root, path)
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    def remove(self, path):
+        filename = os.path.join(self.root, path)
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def close(self):
+        pass
+
+class TarWriter(object):
+    """
+    Writes a (possibly gzipped) tar stream. Always a full export.
+    """
+    def __init__(self, fileobj, compress=False):
+        self.tar = tarfile.open(fileobj=fileobj, mode=(compress and 'w|gz') or 'w|')
+
+    def read_manifest(self):
+        return {}
+
+    def exists(self, path):
+        return False
+
+    def write(self, path, data):
+        info = tarfile.TarInfo(_encode(path))
+        info.size = len(data)
+        info.mtime = time.time()
+        self.tar.addfile(info, StringIO(data))
+
+    def remove(self, path):
+        pass
+
+    def close(self):
+        self.tar.close()
+
+def _encode(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s or ''
+
+def _init_worker(template_sources):
+    templateloader.set_static_sources(template_sources)
+
+def render_page(job):
+    """
+    Render a page outside of any request. job is (path, template_path, context),
+    where the context only holds plain data, so jobs can be sent to worker processes.
+    """
+    path, template_path, context = job
+    import django.template
+    import django.template.loader
+    template = django.template.loader.get_template(template_path)
+    return (path, _encode(template.render(django.template.Context(context))))
+
+def page_context(gov, page):
+    """
+    The plain-data equivalent of the context used by PageResource.serve_request
+    """
+    d = dict(page.attributes)
+    d.update({
+        'url': page.url,
+        'revision': page.revision,
+        'source': page.source,
+        'source_format': page.source_format,
+        'body': page.body,
+        })
+    return {'site': gov.site_constants, 'page': d}
+
+def collect_templates():
+    """
+    Returns dict of lower case entry path -> (revision, source) for all templates
+    """
+    prefix = config.TEMPLATE_DIR.lower()+'/'
+    templates = {}
+    for r in resources.TextResource.all():
+        path = r.parent_key().name()
+        if path.startswith(prefix):
+            templates[path] = (r.revision, r.source or '&nbsp;')
+    return templates
+
+def export_site(gov, writer, processes=None):
+    """
+    Export all resources of the current namespace through writer.
+    Only files whose validator changed since the manifest of the
+    previous export are written. Returns a dict of counts.
+    """
+    old_manifest = writer.read_manifest()
+    manifest = {}
+    stats = {'written': 0, 'skipped': 0, 'removed': 0}
+    templates = collect_templates()
+    # Rendered pages depend on all templates and the site constants
+    site_token = hashlib.md5(repr((sorted(templates.items()), gov.site_constants))).hexdigest()[:12]
+
+    def unchanged(url, path, validator):
+        old = old_manifest.get(url)
+        return old and old['path'] == path and old['validator'] == validator and writer.exists(path)
+
+    jobs = []
+    for r in models.Resource.all():
+        is_page = isinstance(r, resources.PageResource)
+        if r.revision is None and not is_page:
+            # Directory pages are never fetched, everything else should be
+            logging.debug('Export: skipping %s, which has not been fetched'%r)
+            continue
+        path = url_to_path(r.url, is_page)
+        if is_page:
+            validator = '%s-%08x-%s'%(r.revision, zlib.adler32(_encode(r.body)) & 0xffffffff, site_token)
+            content_type = PAGE_CONTENT_TYPE
+        else:
+            validator = 'rev%d'%r.revision
+            content_type = (getattr(r, 'content_type', None) or
+                            mimetypes.guess_type(r.url)[0] or 'application/octet-stream')
+        manifest[r.url] = {'path': path, 'content_type': content_type, 'validator': validator}
+        if unchanged(r.url, path, validator):
+            stats['skipped'] += 1
+            continue
+        stats['written'] += 1
+        if is_page and r.attributes.get('template'):
+            jobs.append((path, r.attributes['template'], page_context(gov, r)))
+        elif is_page:
+            writer.write(path, _encode(r.body))
+        elif isinstance(r, resources.RawResource):
+            writer.write(path, ''.join(r.iter_content()))
+        else:
+            writer.write(path, _encode(r.source))
+
+    for path, data in render_all(jobs, templates, processes):
+        writer.write(path, data)
+
+    for url, old in old_manifest.items():
+        if url not in manifest:
+            writer.remove(old['path'])
+            stats['removed'] += 1
+    writer.write(MANIFEST_NAME, json.dumps(manifest, indent=1, sort_keys=True))
+    writer.close()
+    logging.info('Export done: %s'%stats)
+    return stats
+
+def render_all(jobs, templates, processes=None):
+    """
+    Render jobs, using a process pool if possible
+    """
+    if processes != 1 and len(jobs) > 1:
+        try:
+            import multiprocessing
+        except ImportError:
+            multiprocessing = None
+        if multiprocessing:
+            pool = multiprocessing.Pool(processes, _init_worker, (templates,))
+            try:
+                return pool.map(render_page, jobs)
+            finally:
+                pool.close()
+                pool.join()
+    _init_worker(templates)
+    try:
+        return [render_page(job) for job in jobs]
+    finally:
+        templateloader.set_static_sources(None)
+
+def export_from_client(site, writer, processes=None):
+    """
+    Sync site (an object like test.dbtools.FakeSite) into the current
+    datastore, then export it. Requires datastore and memcache stubs.
+    """
+    gov = ExportController(site)
+    models.perform_sync(gov, models.DirEntry.get_root_entry())
+    return export_site(gov, writer, processes)
+
+def make_writer(target):
+    if target == '-':
+        return TarWriter(sys.stdout)
+    if target.endswith('.tar'):
+        return TarWriter(open(target, 'wb'))
+    if target.endswith('.tar.gz') or target.endswith('.tgz'):
+        return TarWriter(open(target, 'wb'), compress=True)
+    return DirectoryWriter(target)
+
+def main(argv=None):
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] TARGET\n'
+                          'TARGET is a directory, a .tar/.tar.gz file, or - for a tar stream on stdout')
+    parser.add_option('--state-zip', help='Export a site from a test.dbtools state zip')
+    parser.add_option('--local-root', help='Export a site from a local directory standing in for the Dropbox')
+    parser.add_option('--base-dir', default='/Dropsite', help='Site directory in the snapshot')
+    parser.add_option('--processes', type='int', default=None, help='Number of render processes')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1 or not (options.state_zip or options.local_root):
+        parser.error('A state zip or a local root, and a single target are required')
+
+    from google.appengine.ext import testbed
+    from test import dbtools
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_datastore_v3_stub()
+    tb.init_memcache_stub()
+    try:
+        if options.local_root:
+            from siteinadropbox.localclient import LocalFolderClient
+            client = LocalFolderClient(options.local_root, trust_dir_mtime=True)
+        else:
+            client = dbtools.FakeClient(state_zip=options.state_zip)
+        site = dbtools.FakeSite(client, base_dir=options.base_dir)
+        export_from_client(site, make_writer(args[0]), options.processes)
+    finally:
+        tb.deactivate()
+
+if __name__ == '__main__':
+    main()
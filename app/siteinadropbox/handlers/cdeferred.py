@@ -17,6 +17,9 @@ Example usage:
 
   # Providing non-default task queue arguments
   deferred.defer(do_something_later, 20, _queue="foo", countdown=60)
+
+  # Using the queue of a priority class, see config.TASK_PRIORITY_QUEUES
+  deferred.defer(do_something_later, 20, _priority="interactive")
 """
 
 from __future__ import absolute_import
@@ -162,6 +165,20 @@ def serialize(obj, *args, **kwargs):
     logging.debug('Cdeferred: Call tupple %s(%s, %s) pickled to %d B'%(cobj, cargs, ckwargs, len(result)))
     return result
 
+def pop_task_options(kwargs):
+    """
+    Remove the options for the task queue (the _-prefixed arguments of defer)
+    from kwargs. Returns (task arguments, queue name, transactional)
+    """
+    taskargs = dict((x, kwargs.pop(("_%s" % x), None))
+                    for x in ("countdown", "eta", "name"))
+    taskargs["url"] = kwargs.pop("_url", _DEFAULT_URL)
+    transactional = kwargs.pop("_transactional", False)
+    taskargs["headers"] = _TASKQUEUE_HEADERS
+    priority = kwargs.pop("_priority", None)
+    queue = kwargs.pop("_queue", None) or config.TASK_PRIORITY_QUEUES.get(priority, _DEFAULT_QUEUE)
+    return (taskargs, queue, transactional)
+
 def defer(obj, *args, **kwargs):
     """Defers a callable for execution later.
 
@@ -174,17 +191,14 @@ def defer(obj, *args, **kwargs):
       obj: The callable to execute. See module docstring for restrictions.
       _countdown, _eta, _name, _transactional, _url, _queue: Passed through to
       the task queue - see the task queue documentation for details.
+      _priority: A priority class from config.TASK_PRIORITY_QUEUES, selecting
+      the queue if _queue is not given.
       args: Positional arguments to call the callable with.
       kwargs: Any other keyword arguments are passed through to the callable.
     Returns:
       A taskqueue.Task object which represents an enqueued callable.
     """
-    taskargs = dict((x, kwargs.pop(("_%s" % x), None))
-                    for x in ("countdown", "eta", "name"))
-    taskargs["url"] = kwargs.pop("_url", _DEFAULT_URL)
-    transactional = kwargs.pop("_transactional", False)
-    taskargs["headers"] = _TASKQUEUE_HEADERS
-    queue = kwargs.pop("_queue", _DEFAULT_QUEUE)
+    taskargs, queue, transactional = pop_task_options(kwargs)
     pickled = serialize(obj, *args, **kwargs)
     try:
         task = taskqueue.Task(payload=pickled, **taskargs)
@@ -0,0 +1,83 @@
+"""
+A webapp handler receiving change notifications (webhooks) from Dropbox,
+so syncs can be driven by pushed changes rather than by visits.
+
+Notifications are verified by the X-Dropbox-Signature header, a hex
+HMAC-SHA256 of the request body keyed with config.NOTIFY_SECRET, or if that
+is not set, the consumer secret of the app (as used by Dropbox).
+A GET with a 'challenge' parameter is answered by echoing the challenge, as
+Dropbox requires when the endpoint is registered.
+
+The body is JSON. Notifications in the format of Dropbox carry no paths,
+and trigger a sync of the whole site. A list of changed dropbox paths can be
+given as 'paths', which restricts the sync to the affected subtrees:
+  {"paths": ["/Public/mysite/blog/post.txt"]}
+See models.notify_changes for how bursts are debounced.
+
+As with CDeferredHandler, the controller is obtained from a factory set by
+calling NotificationHandler.set_controller_factory.
+"""
+
+import hmac
+import hashlib
+import logging
+import simplejson as json
+
+from google.appengine.ext import webapp
+
+import config
+from siteinadropbox import models
+
+SIGNATURE_HEADER = 'X-Dropbox-Signature'
+
+def get_secret(site):
+    return config.NOTIFY_SECRET or site.dropbox_config.get('consumer_secret')
+
+def sign(secret, body):
+    return hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+def _equal(a, b):
+    """
+    String comparison in time independent of where the strings differ
+    """
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+class NotificationHandler(webapp.RequestHandler):
+    controller_factory = None
+
+    @classmethod
+    def set_controller_factory(cls, factory):
+        cls.controller_factory = staticmethod(factory)
+
+    def get(self):
+        challenge = self.request.get('challenge')
+        if not challenge:
+            return self.error(400)
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.headers['X-Content-Type-Options'] = 'nosniff'
+        self.response.out.write(challenge)
+
+    def post(self):
+        try:
+            gov = self.controller_factory()
+        except models.InvalidSiteError:
+            logging.debug('Notify: notification for invalid site')
+            return self.error(404)
+        secret = get_secret(gov.site)
+        signature = self.request.headers.get(SIGNATURE_HEADER, '')
+        if not secret or not _equal(str(signature), sign(str(secret), self.request.body)):
+            logging.warning('Notify: rejecting notification with bad signature')
+            return self.error(403)
+        try:
+            data = json.loads(self.request.body or '{}')
+        except ValueError:
+            logging.info('Notify: notification body is not JSON')
+            return self.error(400)
+        paths = (isinstance(data, dict) and data.get('paths')) or None
+        logging.debug('Notify: changes notified for %s'%(paths or 'the whole site'))
+        models.notify_changes(gov, paths)
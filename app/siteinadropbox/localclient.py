@@ -0,0 +1,239 @@
+"""
+A backend serving a local directory through the interface of
+dropbox.client.DropboxClient, for offline builds, on-prem mirrors and
+benchmarks.
+
+It is selected by Site.get_dropbox_client when the local_root of the site
+is set (new sites take it from the [auth] section of config_dropbox.ini).
+Dropbox paths are mapped to paths below local_root, and names are matched
+case-insensitively, as on Dropbox. Symbolic links are followed only as long
+as they stay inside local_root.
+
+Directory hashes are computed from stat data, so a sync gets 304 for an
+unchanged directory without any file being read. By default (trust_dir_mtime),
+the hash is computed from the stat of the directory itself, so a poll of an
+unchanged directory costs a single stat, and only changed directories have
+their members stat'ed. This misses files modified in place, which do not
+touch the mtime of their directory, but not files created, deleted or
+replaced by a rename, which is how most editors and sync tools save.
+When files may be rewritten in place, turn trust_dir_mtime off: the hash
+then covers the stats of all members, so every poll stats every member
+of the polled directory.
+
+File revisions are the latest of the modification and change times, in
+milliseconds. File content is read through a memory map where available.
+Only metadata, get_file and account_info are implemented, so the delta
+sync mode is not supported: syncs walk the tree instead (see
+metadata.use_delta_sync).
+"""
+
+import os
+import stat
+import time
+import hashlib
+import logging
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+DATE_FORMAT = '%a, %d %b %Y %H:%M:%S +0000'
+
+class LocalResponse(object):
+    """
+    Response with the attributes of a dropbox.rest.RESTResponse.
+    Can be closed, as get_file responses can.
+    """
+    def __init__(self, status, reason, data=None):
+        self.status = status
+        self.reason = reason
+        self.data = data
+        self.body = ''
+
+    def __str__(self):
+        return 'Local response %s (%s)'%(self.status, self.reason)
+
+    def read(self, n=None):
+        return ''
+
+    def getheaders(self):
+        return []
+
+    def close(self):
+        pass
+
+class LocalFile(LocalResponse):
+    """
+    An open file, read through a memory map when possible
+    """
+    def __init__(self, filename):
+        LocalResponse.__init__(self, 200, 'OK')
+        self._file = open(filename, 'rb')
+        self._map = None
+        self._pos = 0
+        if mmap and os.fstat(self._file.fileno()).st_size:
+            try:
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError), e:
+                logging.debug('LocalFile: unable to map %s (%s), reading instead'%(filename, e))
+
+    def read(self, n=None):
+        if self._map is None:
+            if n is None:
+                return self._file.read()
+            return self._file.read(n)
+        end = len(self._map)
+        if n is not None:
+            end = min(self._pos+n, end)
+        data = self._map[self._pos:end]
+        self._pos = end
+        return data
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+def _stat(filename):
+    try:
+        return os.stat(filename)
+    except OSError:
+        # Removed meanwhile, or a broken link
+        return None
+
+def _revision(st):
+    return int(max(st.st_mtime, st.st_ctime)*1000)
+
+class LocalFolderClient(object):
+    def __init__(self, local_root, trust_dir_mtime=True):
+        self.local_root = os.path.realpath(os.path.expanduser(local_root))
+        self.trust_dir_mtime = trust_dir_mtime
+        # Lower case dropbox path -> local filename
+        self._filenames = {}
+
+    def __str__(self):
+        return 'LocalFolderClient(%s)'%self.local_root
+
+    def _inside(self, filename):
+        """
+        Returns the real path of filename, or None if it is outside local_root
+        """
+        real = os.path.realpath(filename)
+        if real != self.local_root and not real.startswith(os.path.join(self.local_root, '')):
+            return None
+        return real
+
+    def _resolve(self, path):
+        """
+        Returns the local filename for a dropbox path, or None if there is none.
+        Paths leading outside local_root, also through links, have none.
+        """
+        key = path.rstrip('/').lower()
+        filename = self._filenames.get(key)
+        if filename and os.path.lexists(filename):
+            filename = self._inside(filename)
+            if not filename:
+                logging.warning('LocalFolderClient: %s is outside %s'%(path, self.local_root))
+            return filename
+        filename = self.local_root
+        for name in key.split('/'):
+            if not name:
+                continue
+            if name in ['.', '..']:
+                logging.warning('LocalFolderClient: rejecting path %s'%path)
+                return None
+            candidate = os.path.join(filename, name)
+            if not os.path.lexists(candidate):
+                try:
+                    match = [n for n in os.listdir(filename) if n.lower() == name]
+                except OSError:
+                    return None
+                if not match:
+                    return None
+                candidate = os.path.join(filename, match[0])
+            filename = candidate
+        filename = self._inside(filename)
+        if not filename:
+            logging.warning('LocalFolderClient: %s is outside %s'%(path, self.local_root))
+            return None
+        self._filenames[key] = filename
+        return filename
+
+    def _metadata_dict(self, root, path, st):
+        is_dir = stat.S_ISDIR(st.st_mode)
+        size = (not is_dir and st.st_size) or 0
+        return {
+            'path': path,
+            'root': root,
+            'is_dir': is_dir,
+            'revision': _revision(st),
+            'modified': time.strftime(DATE_FORMAT, time.gmtime(st.st_mtime)),
+            'bytes': size,
+            'size': '%d bytes'%size,
+            'thumb_exists': False,
+            'icon': (is_dir and 'folder') or 'page_white',
+            }
+
+    def _dir_hash(self, st, members):
+        if self.trust_dir_mtime:
+            key = (st.st_dev, st.st_ino, st.st_mtime, st.st_ctime)
+        else:
+            key = sorted((name, m.st_mode, m.st_size, m.st_mtime, m.st_ctime) for name, m in members)
+        return hashlib.md5(repr(key)).hexdigest()
+
+    def metadata(self, root, path, file_limit=10000, hash=None, list=True, status_in_response=False, callback=None):
+        """
+        As DropboxClient.metadata
+        """
+        filename = self._resolve(path)
+        st = filename and _stat(filename)
+        if not st:
+            return LocalResponse(404, 'Not Found', {'error': 'Path %s not found'%path})
+        data = self._metadata_dict(root, path, st)
+        if not data['is_dir'] or not list:
+            return LocalResponse(200, 'OK', data)
+        if self.trust_dir_mtime and hash == self._dir_hash(st, None):
+            return LocalResponse(304, 'Not Modified', {})
+
+        members = []
+        for name in os.listdir(filename):
+            member_st = _stat(os.path.join(filename, name))
+            if member_st:
+                members.append((name, member_st))
+        if len(members) > file_limit:
+            return LocalResponse(406, 'Not Acceptable', {'error': 'Too many files in %s'%path})
+        data['hash'] = self._dir_hash(st, members)
+        if data['hash'] == hash:
+            return LocalResponse(304, 'Not Modified', {})
+
+        prefix = path.rstrip('/')
+        data['contents'] = []
+        # In the order of lowercased paths, as metadata._merge_listing expects
+        for name, member_st in sorted(members, key=lambda m: m[0].lower()):
+            member_filename = os.path.join(filename, name)
+            if os.path.islink(member_filename) and not self._inside(member_filename):
+                logging.debug('LocalFolderClient: skipping link %s out of %s'%(member_filename, self.local_root))
+                continue
+            member_path = '%s/%s'%(prefix, name)
+            self._filenames[member_path.lower()] = member_filename
+            data['contents'].append(self._metadata_dict(root, member_path, member_st))
+        return LocalResponse(200, 'OK', data)
+
+    def get_file(self, root, from_path):
+        """
+        As DropboxClient.get_file. The caller must close the returned object.
+        """
+        filename = self._resolve(from_path)
+        if not filename or not os.path.isfile(filename):
+            return LocalResponse(404, 'Not Found')
+        return LocalFile(filename)
+
+    def account_info(self, status_in_response=False, callback=None):
+        return LocalResponse(200, 'OK', {
+                'display_name': 'Local folder %s'%self.local_root,
+                'email': 'local@localhost',
+                'uid': 0,
+                'country': '',
+                'quota_info': {'shared': 0, 'quota': 0, 'normal': 0},
+                })
@@ -5,24 +5,135 @@ import wsgiref.handlers
 import urllib
 
 from google.appengine.ext import webapp
+from google.appengine.ext import db
 from google.appengine.api import namespace_manager
+from google.appengine.api import memcache
 
 import dropbox.auth
 import dropbox.client
 from siteinadropbox import controller
 from siteinadropbox import models
+from siteinadropbox import cache
 
 class PageHandler(webapp.RequestHandler):
-    #max_age = config.CACHE_MAX_AGE
+    def serve_cached(self, request_path):
+        """
+        Serve a response stored by cache_response. Returns True on a hit.
+        Hits are passed on to resource_access_notify like any other access,
+        see notify_cached.
+        """
+        if (not config.RESPONSE_CACHE_ENABLED or self.request.query_string or
+            'Range' in self.request.headers):
+            return False
+        cached = cache.get_cached_response(request_path)
+        if not cached:
+            return False
+        status, headers, body, body_gz, resource_key = cached
+        if body is None and not models.accepts_gzip(self.request):
+            return False
+        logging.debug('Serving %s from response cache'%request_path)
+        for k,v in headers:
+            self.response.headers[k]=v
+        if models.is_not_modified(self.request, self.response.headers.get('ETag'),
+                                  models.parse_http_date(self.response.headers.get('Last-Modified'))):
+            self.response.set_status(304)
+        else:
+            self.response.set_status(status)
+            models.write_body(self, body, body_gz)
+        self.notify_cached(resource_key)
+        return True
+
+    def notify_cached(self, resource_key):
+        """
+        Access-triggered syncs and promotion of pending actions must not stop
+        when a page is served from the cache. Cache hits never load a
+        controller, so this is skipped until a cache miss has loaded one in
+        this instance, and it is done at most once per
+        config.CACHED_ACCESS_NOTIFY_INTERVAL for each resource.
+        """
+        gov = controller.get_loaded_site_controller()
+        if not gov or not memcache.add('_cached_access:%s'%resource_key, 1,
+                                       time=config.CACHED_ACCESS_NOTIFY_INTERVAL):
+            return
+        gov.resource_access_notify(resource_key=resource_key and db.Key(resource_key))
+
+    def cache_response(self, request_path, resource_key=None):
+        if not config.RESPONSE_CACHE_ENABLED or self.request.query_string:
+            return
+        if self.response.status != 200:
+            return
+        # Rendered output is compressed once, when cached
+        out = self.response.out.getvalue()
+        headers = [(k,v) for k,v in self.response.headers.items()
+                   if k.lower() != 'content-encoding']
+        if self.response.headers.get('Content-Encoding') == 'gzip':
+            body, body_gz = None, out
+        else:
+            body = out
+            body_gz = models.gzip_compress(out, self.response.headers.get('Content-Type'))
+        if len(body or '')+len(body_gz or '') > config.RESPONSE_CACHE_MAX_SIZE:
+            return
+        cache.set_cached_response(request_path, self.response.status,
+                                  headers, body, body_gz,
+                                  max_age=config.RESPONSE_CACHE_MAX_AGE,
+                                  resource_key=resource_key and str(resource_key))
+
+    def revalidate(self, gov, resource):
+        """
+        Stale-while-revalidate: when a new revision of resource is pending,
+        it is fetched right away if that is estimated to take less than the
+        swr_budget attribute, or if it has been pending for more than
+        swr_max_stale seconds. Otherwise the current revision is served,
+        and the fetch is moved to an interactive task. Fetches estimated to
+        take more than config.SWR_MAX_INLINE_FETCH seconds are never made
+        inline, so large files cannot run past the request deadline.
+        Returns (resource to serve, pending revision or None)
+        """
+        if not config.SWR_ENABLED:
+            return (resource, None)
+        pending = models.get_pending_revision(resource.key())
+        if not pending or pending[0] == resource.revision:
+            return (resource, None)
+        revision, stale_for = pending
+        entry = resource.parent()
+        entry_path = resource.parent_key().name().rstrip('/')
+        if entry and entry.is_dir:
+            entry_path += '/'
+        attributes = gov.get_resource_default_attributes(entry_path)
+        budget = float(attributes.get('swr_budget', config.SWR_BUDGET))
+        max_stale = float(attributes.get('swr_max_stale', config.SWR_MAX_STALE))
+        fetch_time = resource.estimate_fetch_time()
+        if (stale_for <= max_stale and fetch_time > budget) or fetch_time > config.SWR_MAX_INLINE_FETCH:
+            logging.debug('Serving %s while revision %s is pending'%(resource, revision))
+            resource.request_refresh(gov, revision)
+            return (resource, revision)
+        logging.debug('Fetching revision %s of %s inline'%(revision, resource))
+        try:
+            fresh = resource.refresh(gov, revision) or resource
+        except Exception, e:
+            logging.warning('Inline fetch of %s failed: %s'%(resource, e))
+            return (resource, revision)
+        if fresh.revision != revision:
+            return (fresh, revision)
+        return (fresh, None)
 
-    #@memoize(key_func=lambda s,g,r,p: p, max_age = s.max_age, tickers = [config.RESOURCE_TICKER, config.CONFIG_TICKER])
-    def get_response(self, gov, request, request_path):
-        resource=models.Resource.get_resource_by_url(request_path)
-        if resource:
-            resource.serve_request(gov, request)
-            return request.response
-        
     def get(self, url):
+        #TODO: Handle unicode in path
+        request_path = urllib.unquote(self.request.path)
+
+        # Cached responses are served without touching the datastore
+        if self.serve_cached(request_path):
+            return
+
+        # ... and so are requests for urls that are known not to exist
+        candidates = [request_path]
+        if not request_path.endswith('/') and not self.request.query_string:
+            candidates.append(request_path+'/')
+        if not models.UrlIndex.may_exist(candidates):
+            logging.debug('Access to unknown url %s'%request_path)
+            self.error(404)
+            return
+
         # Check if namespace is initialized
         try:
             gov = controller.get_current_site_controller()
@@ -31,25 +142,30 @@ class PageHandler(webapp.RequestHandler):
                 namespace_manager.get_namespace(), config.ADMIN_URL))
             self.redirect(config.ADMIN_URL)
             return
+        # The list of known urls is only used once the index is complete
+        models.UrlIndex.request_backfill(gov)
+        # ... and is built in a task, not here
+        models.UrlIndex.request_rebuild(gov)
 
-        #TODO: Handle unicode in path
-        request_path = urllib.unquote(self.request.path)
-
-        # Look up response
         logging.debug('Serving %s according to path %s'%(self.request.url, request_path))
-        response = self.get_response(gov, self, request_path)
-        if response:
-            self.response = response
-            gov.resource_access_notify(url=request_path)
+        resource = models.Resource.get_resource_by_url(request_path)
+        if resource:
+            resource, pending_revision = self.revalidate(gov, resource)
+            if pending_revision is not None:
+                self.response.headers['X-Pending-Revision'] = str(pending_revision)
+            resource.serve(gov, self)
+            if pending_revision is None:
+                # Stale responses are not cached
+                self.cache_response(request_path, resource.key())
+            gov.resource_access_notify(resource=resource)
             return
 
-        # No response: look for friendly rewrites
-        if not request_path.endswith('/') and not self.request.query_string:
+        # No resource: look for friendly rewrites
+        if len(candidates)>1 and models.Resource.get_resource_by_url(candidates[1]):
             new_path = self.request.path+'/'
-            if self.get_response(gov, self, new_path):
-                logging.debug('Redirecting %s to %s'%(request_path, new_path))
-                self.redirect(new_path, permanent = True)
-                return
+            logging.debug('Redirecting %s to %s'%(request_path, new_path))
+            self.redirect(new_path, permanent = True)
+            return
 
         # Otherwise, it's 404
         logging.debug('Access to non-existing url %s'%request_path)
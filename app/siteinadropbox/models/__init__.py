@@ -6,8 +6,14 @@ The datastore models used by siteinadropbox
 
 """
 from __future__ import absolute_import
-from .metadata import DirEntry, Throttle, DropboxError, ListingVisitor, schedule_sync, perform_sync
-from .resources import FormatError, Resource
+from .metadata import DirEntry, Throttle, DropboxError, ListingVisitor, SyncRun, schedule_sync, perform_sync, start_sync_run
+from .metadata import notify_changes, use_delta_sync, perform_sync_by_key
+from .resources import FormatError, Resource, UrlIndex, is_not_modified, parse_http_date, accepts_gzip, gzip_compress, write_body
+from .resources import get_pending_revision, clear_pending_revisions
+from .delta import DeltaCursor, perform_delta_sync
+from .plan import SyncPlan, make_plan, make_stored_plan, apply_plan, apply_plan_by_key
+from .batch import PendingAction, run_batch, promote_actions, has_pending_actions, collect_actions, flush_actions
+from .guard import GuardedClient, DropboxUnavailable, get_guard_status
 from .site import InvalidSiteError, Site
 
 
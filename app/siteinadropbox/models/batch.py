@@ -0,0 +1,330 @@
+"""
+Coalescing of resource actions (fetch, run_formatter) into batches.
+
+Rather than a task per action, Resource.schedule records a PendingAction,
+keyed by action and resource so repeated requests collapse into one, and
+makes sure a batch task is queued. The batch task (run_batch) downloads
+the sources of several text resources concurrently, formats them, and
+writes them back with a single db.put. Actions without a batched version,
+such as fetches of RawResources which stream their content into chunks,
+are run one by one in the same task.
+
+A failing action does not affect the rest of its batch; it is retried in
+a later batch, up to config.BATCH_MAX_ATTEMPTS times.
+
+Batches find their actions with a query, which may miss actions added
+just before. So batches reschedule themselves until config.BATCH_SETTLE
+seconds after the last action was added.
+
+The actions scheduled while handling a set of metadata changes are
+collected (collect_actions) and written together (flush_actions).
+
+Each action keeps the priority it was scheduled at (the resource's own,
+or 'bulk' for re-verification), and batches run per priority class, as
+tasks of that priority. When a resource with pending actions is requested,
+promote_actions runs its actions in an 'interactive' task.
+"""
+
+import logging
+import time
+
+from google.appengine.ext import db
+from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
+from google.appengine.api import taskqueue
+
+import config
+from . import fetchers
+from . import guard
+from .resources import TextResource, PageResource, ConfigResource
+from .resources import get_pending_revision, clear_pending_revision
+
+class PendingAction(db.Model):
+    """
+    An action waiting to be run on a resource. Keyed by '<action>:<resource key>'
+    """
+    resource = db.ReferenceProperty()
+    action = db.StringProperty()
+    revision = db.IntegerProperty()
+    priority = db.StringProperty(default=config.RESOURCE_PRIORITY)
+    attempts = db.IntegerProperty(default=0)
+    created = db.DateTimeProperty(auto_now_add=True)
+
+    @staticmethod
+    def key_name_for(resource, action):
+        return '%s:%s'%(action, resource.key())
+
+    def get_resource_key(self):
+        return PendingAction.resource.get_value_for_datastore(self)
+
+ACTIONS = ['fetch', 'run_formatter']
+# Most urgent first
+PRIORITIES = ['interactive', 'sync', 'bulk']
+
+def _more_urgent(a, b):
+    """
+    The more urgent of priorities a and b
+    """
+    return min(a, b, key=PRIORITIES.index)
+
+def _is_covered(pa, new_revision, priority):
+    """
+    True if the pending action pa already asks for new_revision, at least as urgently
+    """
+    return (pa is not None and pa.revision is not None and pa.revision >= new_revision
+            and _more_urgent(pa.priority, priority) == pa.priority)
+
+def _merged(key_name, pa, resource, action, new_revision, priority):
+    """
+    The pending action recording action on resource for new_revision, given
+    the one already pending (pa, or None). An action requested again keeps
+    the newest revision and the most urgent priority.
+    """
+    if pa is not None and pa.revision is not None:
+        new_revision = max(pa.revision, new_revision)
+        priority = _more_urgent(pa.priority, priority)
+    return PendingAction(key_name=key_name, resource=resource, action=action,
+                         revision=new_revision, priority=priority)
+
+def has_pending_actions(resource_key):
+    """
+    Cheap check for pending actions on a resource, through the memcache
+    marker set by Resource.schedule
+    """
+    return get_pending_revision(resource_key) is not None
+
+def _note_added(priority=config.RESOURCE_PRIORITY):
+    memcache.set('_batch_added:%s'%priority, time.time())
+
+def _may_have_missed(start, priority=config.RESOURCE_PRIORITY):
+    """
+    True if actions of priority were added so shortly before start that
+    a query made then may not have seen them
+    """
+    added = memcache.get('_batch_added:%s'%priority)
+    return added is not None and added > start-config.BATCH_SETTLE
+
+def add_action(gov, resource, action, new_revision, priority=config.RESOURCE_PRIORITY):
+    """
+    Record that action should be run on resource for new_revision, and
+    make sure a batch of priority will run. While actions are collected
+    on gov, the action is recorded by flush_actions instead.
+    """
+    collected = getattr(gov, '_collected_actions', None)
+    if collected is not None:
+        collected.append((resource, action, new_revision, priority))
+        return
+    key_name = PendingAction.key_name_for(resource, action)
+    def txn():
+        pa = PendingAction.get_by_key_name(key_name)
+        if _is_covered(pa, new_revision, priority):
+            return None
+        pa = _merged(key_name, pa, resource, action, new_revision, priority)
+        pa.put()
+        return pa.priority
+    queued = db.run_in_transaction(txn)
+    if queued:
+        logging.debug('Batch: queued %s on %s, rev. %d, %s'%(action, resource, new_revision, queued))
+        _note_added(queued)
+        schedule_batch(gov, priority=queued)
+    else:
+        logging.debug('Batch: %s on %s is already pending'%(action, resource))
+
+def collect_actions(gov):
+    """
+    Collect the actions added on gov, until flush_actions records them together
+    """
+    gov._collected_actions = []
+
+def flush_actions(gov):
+    """
+    Record the collected actions with one batch get and one batch put.
+    Unlike add_action, this is not transactional: a concurrent add for an
+    older revision may win, in which case the resource is fetched again
+    when it is next verified.
+    """
+    collected = getattr(gov, '_collected_actions', None)
+    gov._collected_actions = None
+    if not collected:
+        return
+    latest = {}
+    for resource, action, new_revision, priority in collected:
+        key_name = PendingAction.key_name_for(resource, action)
+        if key_name in latest:
+            new_revision = max(latest[key_name][2], new_revision)
+            priority = _more_urgent(latest[key_name][3], priority)
+        latest[key_name] = (resource, action, new_revision, priority)
+    key_names = latest.keys()
+    put = []
+    for key_name, pa in zip(key_names, PendingAction.get_by_key_name(key_names)):
+        resource, action, new_revision, priority = latest[key_name]
+        if _is_covered(pa, new_revision, priority):
+            continue
+        put.append(_merged(key_name, pa, resource, action, new_revision, priority))
+    if put:
+        db.put(put)
+        logging.debug('Batch: queued %d actions'%len(put))
+    for priority in set(pa.priority for pa in put):
+        _note_added(priority)
+        schedule_batch(gov, priority=priority)
+
+def _task_namespace():
+    """
+    The current namespace as it goes in task names. Namespaces may hold
+    '.', which task names may not, so it is hex-encoded to keep the names
+    of different namespaces apart.
+    """
+    return namespace_manager.get_namespace().encode('hex')
+
+def schedule_batch(gov, countdown=None, priority=config.RESOURCE_PRIORITY):
+    """
+    Make sure a batch task of priority is queued for the current time slot.
+    Tasks are named by namespace, priority and slot, so at most one is
+    queued per slot and priority.
+    """
+    if countdown is None:
+        countdown = config.BATCH_DELAY
+    slot = int(time.time()+countdown)//max(config.BATCH_DELAY, 1)
+    name = 'batch-%s-%s-%d'%(_task_namespace(), priority, slot)
+    if not memcache.add('_batch_slot:%s'%name, 1, time=max(config.BATCH_DELAY, 1)*2):
+        return
+    try:
+        gov.cdefer(run_batch, priority=priority, _name=name, _countdown=countdown, _priority=priority)
+        logging.debug('Batch: scheduled %s'%name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.debug('Batch: %s was already scheduled'%name)
+
+def promote_actions(gov, resource_key):
+    """
+    Run the pending actions on a requested resource ahead of the
+    batches, in an interactive task. Returns True if there are any.
+    """
+    if not has_pending_actions(resource_key):
+        return False
+    if memcache.add('_promoted:%s'%resource_key, 1, time=max(config.BATCH_DELAY, 1)*2):
+        logging.debug('Batch: promoting actions on %s'%resource_key)
+        gov.cdefer(run_batch, resource_keys=[str(resource_key)], _priority='interactive')
+    return True
+
+def _download(entry, gov):
+    try:
+        return (entry.download_content(gov), None)
+    except Exception, e:
+        return (None, e)
+
+def run_batch(gov, size=None, resource_keys=None, priority=config.RESOURCE_PRIORITY):
+    """
+    Run up to `size` (default config.BATCH_SIZE) pending actions of priority,
+    oldest first, or the pending actions on the resources with resource_keys.
+    """
+    start = time.time()
+    if guard.is_open():
+        logging.info('Batch: Dropbox unavailable, postponing batch')
+        schedule_batch(gov, countdown=int(guard.retry_after())+1, priority=priority)
+        return
+    size = size or config.BATCH_SIZE
+    if resource_keys:
+        actions = [a for a in PendingAction.get_by_key_name(
+                ['%s:%s'%(action, k) for k in resource_keys for action in ACTIONS]) if a]
+        more = False
+    else:
+        actions = PendingAction.all().filter('priority =', priority).order('created').fetch(size+1)
+        more = len(actions) > size
+        actions = actions[:size]
+    if not actions:
+        if not resource_keys and _may_have_missed(start, priority):
+            logging.debug('Batch: no %s actions found yet, checking again'%priority)
+            schedule_batch(gov, priority=priority)
+        return
+    resource_keys = list(set(a.get_resource_key() for a in actions))
+    resources = dict((r.key(), r) for r in db.get(resource_keys) if r)
+    entries = dict((e.key(), e) for e in db.get(list(set(r.parent_key() for r in resources.values()))) if e)
+    fetch_keys = set(a.get_resource_key() for a in actions if a.action == 'fetch')
+
+    done = []
+    failed = []
+    to_fetch = []
+    updated = []
+    for a in actions:
+        r = resources.get(a.get_resource_key())
+        if not r or (a.action == 'fetch' and r.revision == a.revision):
+            logging.debug('Batch: nothing to do for %s on %s'%(a.action, r))
+            done.append(a)
+        elif a.action == 'fetch' and isinstance(r, TextResource) and r.parent_key() in entries:
+            to_fetch.append((a, r))
+        elif a.action == 'run_formatter' and isinstance(r, PageResource):
+            if r.key() in fetch_keys:
+                # Formatted when fetched
+                done.append(a)
+                continue
+            try:
+                r.format_source(gov)
+                updated.append((a, r))
+            except Exception, e:
+                logging.warning('Batch: %s on %s failed: %s'%(a.action, r, e))
+                failed.append(a)
+        else:
+            try:
+                getattr(r, a.action)(gov, a.revision)
+                done.append(a)
+            except Exception, e:
+                logging.warning('Batch: %s on %s failed: %s'%(a.action, r, e))
+                failed.append(a)
+
+    ## Download concurrently
+    fetcher = fetchers.ThreadFetcher(config.BATCH_FETCH_WINDOW)
+    try:
+        for a, r in to_fetch:
+            fetcher.submit((a, r), _download, entries[r.parent_key()], gov)
+        while fetcher.pending():
+            (a, r), (source, error) = fetcher.next_result()
+            try:
+                if error:
+                    raise error
+                r.receive(gov, entries[r.parent_key()], source, a.revision)
+                updated.append((a, r))
+            except Exception, e:
+                logging.warning('Batch: %s on %s failed: %s'%(a.action, r, e))
+                failed.append(a)
+    finally:
+        fetcher.close()
+
+    if updated:
+        changed = dict((r.key(), r) for a, r in updated).values()
+        db.put(changed)
+        done.extend([a for a, r in updated])
+        gov.handle_resource_changes(updated=changed)
+        if [r for r in changed if isinstance(r, ConfigResource)]:
+            gov.handle_config_changes()
+
+    _finish(done, failed)
+    logging.info('Batch: %d actions done (%d written together), %d failed'%(
+            len(done), len(updated), len(failed)))
+    retry = set(a.priority for a in failed if a.attempts+1 < config.BATCH_MAX_ATTEMPTS)
+    if not resource_keys and (more or _may_have_missed(start, priority)):
+        retry.add(priority)
+    for p in retry:
+        # Named for the next slot, as the slot of this task is taken
+        schedule_batch(gov, priority=p)
+
+def _finish(done, failed):
+    """
+    Delete done actions, unless a newer revision was requested meanwhile,
+    and count attempts on failed ones.
+    """
+    current = PendingAction.get([a.key() for a in done+failed])
+    delete = []
+    put = []
+    for a, c in zip(done+failed, current):
+        if not c or c.revision != a.revision:
+            continue
+        if a in failed and c.attempts+1 < config.BATCH_MAX_ATTEMPTS:
+            c.attempts += 1
+            put.append(c)
+        else:
+            if a in failed:
+                logging.error('Batch: giving up %s on %s, rev. %d'%(c.action, c.get_resource_key(), c.revision))
+            delete.append(c)
+    db.put(put)
+    db.delete(delete)
+    clear_pending_revision([c.get_resource_key() for c in delete])
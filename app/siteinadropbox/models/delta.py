@@ -0,0 +1,183 @@
+"""
+Cursor-based sync of the DirEntry tree.
+
+Rather than walking the tree with one metadata request per directory (see
+metadata.perform_sync), ask Dropbox for the entries changed since a stored
+cursor and apply them in bulk, so the cost of a poll follows the size of
+the change, not the size of the tree.
+
+The client (gov.db_client) must have a method delta(cursor) returning a
+response with a status and a data dict:
+  entries:  list of [lower case path, metadata dict or None for deleted]
+  reset:    True if the state built from earlier calls should be discarded
+  cursor:   string to pass to the next call
+  has_more: True if more entries are available right away
+This is the dropbox delta API, and test.dbtools.FakeClient implements it
+for state zips.
+"""
+
+import logging
+import posixpath
+
+from google.appengine.ext import db
+
+from .metadata import DirEntry, DropboxError, start_sync_run
+
+class DeltaCursor(db.Model):
+    """
+    The delta cursor for the site of the current namespace.
+    """
+    the_key_name = 'the_key_name'
+    cursor = db.TextProperty()
+    updated = db.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def get_cursor(cls):
+        c = cls.get_by_key_name(cls.the_key_name)
+        return c and c.cursor
+
+    @classmethod
+    def set_cursor(cls, cursor):
+        cls(key_name=cls.the_key_name, cursor=cursor).put()
+
+    @classmethod
+    def clear(cls):
+        db.delete(db.Key.from_path(cls.kind(), cls.the_key_name))
+
+def fetch_delta(gov, cursor):
+    response = gov.db_client.delta(cursor)
+    if response.status != 200:
+        msg = 'Delta request failed. %d [%s]: %s'%(response.status, response.reason, response.body)
+        gov.access_error_notify(msg)
+        raise DropboxError(response.status, msg)
+    return response.data
+
+def perform_delta_sync(gov):
+    """
+    Bring the DirEntry tree up to date with the delta API.
+
+    gov.handle_metadata_changes is called as for perform_sync.
+    When there is no stored cursor, or Dropbox asks for a reset, the feed
+    is read to its end to obtain a fresh cursor, and the tree is then
+    reconciled by a full SyncRun (see start_sync_run), walked across tasks.
+    Changes made during the walk are reported again by the next delta
+    call, which is harmless.
+    """
+    cursor = DeltaCursor.get_cursor()
+    while True:
+        data = fetch_delta(gov, cursor)
+        if data.get('reset') or cursor is None:
+            logging.info('DeltaSync: reset, reconciling with a full sync')
+            while data.get('has_more'):
+                data = fetch_delta(gov, data['cursor'])
+            start_sync_run(gov, DirEntry.get_root_entry(), full=True)
+            DeltaCursor.set_cursor(data['cursor'])
+            return
+        logging.debug('DeltaSync: %d changed entries'%len(data['entries']))
+        if not apply_delta(gov, data['entries']):
+            logging.info('DeltaSync: delta could not be applied, falling back to a full sync')
+            start_sync_run(gov, DirEntry.get_root_entry(), full=True)
+        cursor = data['cursor']
+        DeltaCursor.set_cursor(cursor)
+        if not data.get('has_more'):
+            return
+
+def _set_attrs(entry, metadata):
+    """
+    As DirEntry.set_from_dict, for delta metadata, which may lack fields and
+    never has directory hashes.
+    """
+    attrs = DirEntry.make_attr_dict(metadata)
+    attrs['hash_'] = None
+    modlist = []
+    for k, v in attrs.items():
+        if getattr(entry, k) != v:
+            setattr(entry, k, v)
+            modlist.append(k)
+    return modlist
+
+def apply_delta(gov, entries):
+    """
+    Apply a list of delta entries to the DirEntry tree.
+
+    Removed entries are handled and deleted before updates are made.
+    Updated entries are handled files first and then directories, deepest
+    first, so a directory is handled after its members.
+    Returns False if an entry had no known parent, in which case the caller
+    should do a full sync.
+    """
+    base_dir = gov.site.dropbox_base_dir.lower()
+    changes = {}
+    for path, metadata in entries:
+        path = path.lower()
+        if path == base_dir:
+            path = '/'
+        elif path.startswith(base_dir+'/'):
+            path = path[len(base_dir):]
+        else:
+            continue
+        # Later entries for the same path win
+        changes[path] = metadata
+    if not changes:
+        return True
+
+    # Sorted, parents come before their members
+    paths = sorted(changes.keys())
+    existing = dict(zip(paths, DirEntry.get_by_key_name(paths)))
+    parent_paths = set(posixpath.dirname(p) for p in paths if p != '/')
+    missing = [p for p in parent_paths if p not in existing]
+    existing.update(zip(missing, DirEntry.get_by_key_name(missing)))
+
+    update = []
+    remove = []
+    removed_dirs = []
+    known_dirs = set(p for p, e in existing.items() if e and e.is_dir)
+    complete = True
+    for path in paths:
+        metadata = changes[path]
+        entry = existing[path]
+        if [d for d in removed_dirs if path.startswith(d.rstrip('/')+'/')]:
+            # Deleted along with an ancestor
+            continue
+        if metadata is None or (entry and entry.is_dir != metadata['is_dir']):
+            if entry:
+                remove.append(entry)
+                known_dirs.discard(path)
+                if entry.is_dir:
+                    removed_dirs.append(path)
+            if metadata is None:
+                continue
+            if entry:
+                logging.info('DirEntry %s changed between file and dir'%entry)
+            entry = None
+        if entry is None:
+            parent_path = posixpath.dirname(path)
+            if path == '/' or parent_path not in known_dirs:
+                logging.warning('DeltaSync: no parent directory for %s'%path)
+                complete = False
+                continue
+            entry = DirEntry(key_name=path, parent_dir=db.Key.from_path(DirEntry.kind(), parent_path))
+            _set_attrs(entry, metadata)
+            logging.debug('Creating entry: %s'%entry)
+            update.append(entry)
+        elif _set_attrs(entry, metadata):
+            update.append(entry)
+        if entry.is_dir:
+            known_dirs.add(path)
+
+    if remove:
+        if [e for e in remove if e.is_root()]:
+            msg='Dropbox base dir not accessible'
+            gov.access_error_notify(msg)
+            raise DropboxError(0, msg)
+        logging.debug('DeltaSync: Removing entries:\n -%s'%'\n -'.join([str(e) for e in remove]))
+        gov.handle_metadata_changes(removed=remove)
+        DirEntry.delete_all_below(remove)
+        db.delete(remove)
+
+    if update:
+        update.sort(key=lambda e: (e.is_dir, -e.get_path().count('/')))
+        logging.debug('DeltaSync: Updating entries:\n -%s'%'\n -'.join([str(e) for e in update]))
+        gov.handle_metadata_changes(updated=update)
+        db.put(update)
+    return complete
@@ -0,0 +1,148 @@
+"""
+Helpers for keeping a bounded window of requests to Dropbox in flight.
+
+All fetchers share the interface
+  fetcher.has_room()     -- True if another request can be submitted
+  fetcher.pending()      -- number of submitted requests without a returned result
+  fetcher.submit(tag, func, *args, **kwargs)
+  fetcher.next_result()  -- (tag, func(*args, **kwargs)) for some completed request
+  fetcher.close()
+Results are returned in completion order, and exceptions raised by
+a request are re-raised by next_result.
+"""
+
+import sys
+import logging
+import Queue
+
+class SerialFetcher(object):
+    """
+    Runs each request when its result is asked for.
+    """
+    def __init__(self, window=1):
+        self.window = window
+        self._queue = []
+
+    def has_room(self):
+        return len(self._queue) < self.window
+
+    def pending(self):
+        return len(self._queue)
+
+    def submit(self, tag, func, *args, **kwargs):
+        self._queue.append((tag, func, args, kwargs))
+
+    def next_result(self):
+        tag, func, args, kwargs = self._queue.pop(0)
+        return (tag, func(*args, **kwargs))
+
+    def close(self):
+        self._queue = []
+
+class ThreadFetcher(SerialFetcher):
+    """
+    Runs requests on up to `window` worker threads.
+    Falls back to serial execution if threads cannot be started, as
+    is the case on the python 2.5 runtime.
+    """
+    def __init__(self, window):
+        SerialFetcher.__init__(self, window)
+        self._jobs = Queue.Queue()
+        self._results = Queue.Queue()
+        self._threads = []
+        self._in_flight = 0
+        self._serial = False
+
+    def _start_worker(self):
+        try:
+            import threading
+            t = threading.Thread(target=self._work)
+            t.setDaemon(True)
+            t.start()
+        except Exception, e:
+            logging.debug('ThreadFetcher: unable to start threads (%s), running serially'%e)
+            self._serial = True
+            return
+        self._threads.append(t)
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            tag, func, args, kwargs = job
+            try:
+                self._results.put((tag, func(*args, **kwargs), None))
+            except Exception:
+                self._results.put((tag, None, sys.exc_info()))
+
+    def has_room(self):
+        return self.pending() < self.window
+
+    def pending(self):
+        return self._in_flight + len(self._queue)
+
+    def submit(self, tag, func, *args, **kwargs):
+        if not self._serial and len(self._threads) < min(self.window, self._in_flight+1):
+            self._start_worker()
+        if self._serial:
+            return SerialFetcher.submit(self, tag, func, *args, **kwargs)
+        self._in_flight += 1
+        self._jobs.put((tag, func, args, kwargs))
+
+    def next_result(self):
+        if self._queue:
+            return SerialFetcher.next_result(self)
+        tag, result, exc_info = self._results.get()
+        self._in_flight -= 1
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return (tag, result)
+
+    def close(self):
+        SerialFetcher.close(self)
+        for t in self._threads:
+            self._jobs.put(None)
+        self._threads = []
+
+class RPCFetcher(SerialFetcher):
+    """
+    For functions returning asynchronous results, i.e. objects with an `rpc`
+    attribute (an apiproxy UserRPC) and a `get_result()` method.
+    """
+    def __init__(self, window):
+        SerialFetcher.__init__(self, window)
+        self._in_flight = []
+
+    def pending(self):
+        return len(self._in_flight)
+
+    def submit(self, tag, func, *args, **kwargs):
+        self._in_flight.append((tag, func(*args, **kwargs)))
+
+    def next_result(self):
+        done = 0
+        try:
+            from google.appengine.api import apiproxy_stub_map
+            rpc = apiproxy_stub_map.UserRPC.wait_any([r.rpc for t, r in self._in_flight])
+            done = [r.rpc for t, r in self._in_flight].index(rpc)
+        except (ImportError, AttributeError, ValueError):
+            # No wait_any in this SDK: take the oldest
+            pass
+        tag, result = self._in_flight.pop(done)
+        return (tag, result.get_result())
+
+    def close(self):
+        self._in_flight = []
+
+def make_fetcher(window, func):
+    """
+    Returns (fetcher, request function) for making requests to func,
+    using its asynchronous version func_async if one exists.
+    """
+    func_async = getattr(getattr(func, 'im_self', None), func.__name__+'_async', None)
+    if func_async:
+        return (RPCFetcher(window), func_async)
+    if window > 1:
+        return (ThreadFetcher(window), func)
+    return (SerialFetcher(), func)
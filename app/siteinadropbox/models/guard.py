@@ -0,0 +1,268 @@
+"""
+Protection of the Dropbox API (and of our quota) against overload.
+
+All requests to Dropbox go through a GuardedClient, which
+- takes a token from a rate limiting TokenBucket, shared by all instances
+  through memcache, waiting up to config.DROPBOX_RATE_MAX_WAIT seconds
+  for one to become available, and
+- is short-circuited by a CircuitBreaker while Dropbox is failing.
+
+The breaker opens after config.BREAKER_THRESHOLD consecutive failures
+(5xx responses or exceptions). While open, requests fail right away with
+DropboxUnavailable, and no new syncs or batches are scheduled (see is_open).
+After a delay, the breaker is half-open: a single request is let through as
+a probe. If it succeeds, the breaker closes. If it fails, the breaker opens
+again, with the delay doubled, up to config.BREAKER_MAX_DELAY.
+
+State is kept in the default memcache namespace, as it concerns the app
+rather than any single site. If memcache is unavailable, requests are let through.
+"""
+
+import time
+import logging
+from datetime import datetime
+
+from google.appengine.api import memcache
+
+import config
+
+GUARD_NAMESPACE = ''
+
+class DropboxUnavailable(Exception):
+    """
+    Raised instead of making a request to Dropbox
+    """
+    pass
+
+class TokenBucket(object):
+    """
+    Cross-instance limit of `rate` requests per second, allowing bursts of
+    up to `capacity` requests. Memcache holds the number of tokens taken in
+    the current refill period of capacity/rate seconds, and the bucket is
+    refilled in whole at the start of each period.
+    """
+    def __init__(self, name, rate=None, capacity=None):
+        self.name = name
+        self._rate = rate
+        self._capacity = capacity
+
+    def get_rate(self):
+        return self._rate or config.DROPBOX_RATE_LIMIT
+
+    def get_capacity(self):
+        return self._capacity or config.DROPBOX_RATE_BURST
+
+    def get_period(self):
+        return float(self.get_capacity())/self.get_rate()
+
+    def _key(self, now):
+        return '_bucket:%s:%d'%(self.name, int(now/self.get_period()))
+
+    def try_acquire(self, now=None):
+        """
+        Take a token if one is available. Returns 0 if one was taken, else the
+        number of seconds until the bucket is refilled.
+        """
+        now = now or time.time()
+        period = self.get_period()
+        key = self._key(now)
+        memcache.add(key, 0, time=int(period)+1, namespace=GUARD_NAMESPACE)
+        taken = memcache.incr(key, namespace=GUARD_NAMESPACE)
+        if taken is None or taken <= self.get_capacity():
+            return 0
+        return (int(now/period)+1)*period - now
+
+    def acquire(self, max_wait=None):
+        """
+        Take a token, waiting up to max_wait (default config.DROPBOX_RATE_MAX_WAIT)
+        seconds for one. Raises DropboxUnavailable if none became available.
+        """
+        if max_wait is None:
+            max_wait = config.DROPBOX_RATE_MAX_WAIT
+        waited = 0
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            if waited+wait > max_wait:
+                logging.info('Guard: rate limit of %s exceeded'%self.name)
+                raise DropboxUnavailable('Rate limit of %s exceeded'%self.name)
+            time.sleep(wait)
+            waited += wait
+
+    def get_status(self):
+        taken = memcache.get(self._key(time.time()), namespace=GUARD_NAMESPACE) or 0
+        return {'rate': self.get_rate(), 'capacity': self.get_capacity(),
+                'available': max(self.get_capacity()-taken, 0)}
+
+class CircuitBreaker(object):
+    """
+    See module documentation. Memcache holds the count of consecutive
+    failures, and while open, a state dict with the times the breaker
+    opened and may be probed, and the number of times it opened in a row.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._failures_key = '_breaker:%s:failures'%name
+        self._state_key = '_breaker:%s:state'%name
+        self._probe_key = '_breaker:%s:probe'%name
+
+    def _get(self):
+        d = memcache.get_multi([self._failures_key, self._state_key], namespace=GUARD_NAMESPACE)
+        return (d.get(self._failures_key) or 0, d.get(self._state_key))
+
+    def is_open(self, now=None):
+        """
+        True if the breaker is open and may not yet be probed
+        """
+        state = memcache.get(self._state_key, namespace=GUARD_NAMESPACE)
+        return bool(state) and (now or time.time()) < state['retry_at']
+
+    def allow(self, now=None):
+        """
+        Returns True if a request may be made. Sets self.seen_failures,
+        so record_success only writes to memcache if needed.
+        """
+        failures, state = self._get()
+        self.seen_failures = bool(failures or state)
+        if not state:
+            return True
+        if (now or time.time()) < state['retry_at']:
+            return False
+        # Half-open: let one request through as a probe
+        return memcache.add(self._probe_key, 1, time=config.BREAKER_PROBE_TIMEOUT,
+                            namespace=GUARD_NAMESPACE)
+
+    def record_success(self):
+        if getattr(self, 'seen_failures', True):
+            if memcache.get(self._state_key, namespace=GUARD_NAMESPACE):
+                logging.info('Guard: closing breaker %s'%self.name)
+            memcache.delete_multi([self._failures_key, self._state_key, self._probe_key],
+                                  namespace=GUARD_NAMESPACE)
+            self.seen_failures = False
+
+    def record_failure(self, now=None):
+        now = now or time.time()
+        self.seen_failures = True
+        failures = memcache.incr(self._failures_key, initial_value=0, namespace=GUARD_NAMESPACE) or 1
+        state = memcache.get(self._state_key, namespace=GUARD_NAMESPACE)
+        if state and now >= state['retry_at']:
+            # The probe failed
+            self._open(now, state['trips'])
+        elif not state and failures >= config.BREAKER_THRESHOLD:
+            self._open(now, 0)
+
+    def _open(self, now, trips):
+        delay = min(config.BREAKER_BASE_DELAY*2**trips, config.BREAKER_MAX_DELAY)
+        logging.warning('Guard: opening breaker %s for %d seconds'%(self.name, delay))
+        memcache.set(self._state_key, {'opened_at': now, 'retry_at': now+delay, 'trips': trips+1},
+                     namespace=GUARD_NAMESPACE)
+        memcache.delete_multi([self._failures_key, self._probe_key], namespace=GUARD_NAMESPACE)
+
+    def get_status(self, now=None):
+        now = now or time.time()
+        failures, state = self._get()
+        status = {'state': 'closed', 'failures': failures, 'trips': 0,
+                  'opened_at': None, 'retry_at': None}
+        if state:
+            status.update({
+                    'state': (now < state['retry_at'] and 'open') or 'half-open',
+                    'trips': state['trips'],
+                    'opened_at': datetime.fromtimestamp(state['opened_at']),
+                    'retry_at': datetime.fromtimestamp(state['retry_at'])})
+        return status
+
+bucket = TokenBucket('dropbox')
+breaker = CircuitBreaker('dropbox')
+
+def is_open():
+    return breaker.is_open()
+
+def retry_after():
+    """
+    Seconds until the breaker may be probed (0 if it is not open)
+    """
+    state = memcache.get(breaker._state_key, namespace=GUARD_NAMESPACE)
+    return (state and max(state['retry_at']-time.time(), 0)) or 0
+
+def get_guard_status():
+    return {'breaker': breaker.get_status(), 'bucket': bucket.get_status()}
+
+def is_failure(response):
+    return response.status >= 500
+
+class _GuardedResult(object):
+    """
+    Wraps an asynchronous response, to record its outcome when it is read
+    """
+    def __init__(self, guard, result):
+        self._guard = guard
+        self._result = result
+        self.rpc = result.rpc
+
+    def get_result(self):
+        return self._guard._record(self._result.get_result)
+
+class GuardedClient(object):
+    """
+    A DropboxClient, with metadata, get_file, delta, and the requests of
+    `guarded_optional` and `guarded_async` if the wrapped client has them,
+    made through the bucket and the breaker.
+    Other attributes are those of the wrapped client.
+    """
+    guarded_optional = ['metadata_stream']
+    guarded_async = ['metadata_async']
+
+    def __init__(self, client, bucket=bucket, breaker=breaker):
+        self.client = client
+        self.bucket = bucket
+        self.breaker = breaker
+
+    def _check(self, name):
+        if not self.breaker.allow():
+            raise DropboxUnavailable('Dropbox unavailable, not calling %s'%name)
+        self.bucket.acquire()
+
+    def _record(self, func, *args, **kwargs):
+        try:
+            response = func(*args, **kwargs)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        if is_failure(response):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def metadata(self, *args, **kwargs):
+        self._check('metadata')
+        return self._record(self.client.metadata, *args, **kwargs)
+
+    def get_file(self, *args, **kwargs):
+        self._check('get_file')
+        return self._record(self.client.get_file, *args, **kwargs)
+
+    def delta(self, *args, **kwargs):
+        self._check('delta')
+        return self._record(self.client.delta, *args, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name in self.guarded_optional:
+            def guarded_call(*args, **kwargs):
+                self._check(name)
+                return self._record(attr, *args, **kwargs)
+            guarded_call.__name__ = name
+            return guarded_call
+        if name not in self.guarded_async:
+            return attr
+        def guarded_call(*args, **kwargs):
+            self._check(name)
+            try:
+                return _GuardedResult(self, attr(*args, **kwargs))
+            except Exception:
+                self.breaker.record_failure()
+                raise
+        guarded_call.__name__ = name
+        return guarded_call
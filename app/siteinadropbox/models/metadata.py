@@ -1,11 +1,16 @@
 import logging
 import os.path
+import posixpath
 import itertools
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from google.appengine.ext import db
+from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
 
 import config
+from . import fetchers
+from . import guard
 
 BEGINNING_OF_TIME = datetime(1900,1,1)
 
@@ -86,6 +91,18 @@ class DirEntry(db.Model):
     is_dir = db.BooleanProperty(required=True, default=False)
     bytes = db.IntegerProperty(required=True, default=0)
     hash_ = db.TextProperty()
+    # For directories: paths of the member directories and the number of
+    # members, as of the last listing. member_count is None until populated.
+    subdirs = db.StringListProperty(indexed=False)
+    member_count = db.IntegerProperty(indexed=False)
+    # For directories: poll statistics and schedule, see record_poll
+    next_poll = db.DateTimeProperty()
+    poll_interval = db.IntegerProperty(indexed=False)
+    last_polled = db.DateTimeProperty(indexed=False)
+    last_changed = db.DateTimeProperty(indexed=False)
+    poll_count = db.IntegerProperty(indexed=False, default=0)
+    change_count = db.IntegerProperty(indexed=False, default=0)
+    not_modified_count = db.IntegerProperty(indexed=False, default=0)
 
     @classmethod
     def get_root_entry(cls):
@@ -110,27 +127,127 @@ class DirEntry(db.Model):
             self.revision,
             self.modified.isoformat())
 
-    def delete_below(self):
+    def delete_below(self, batch_size=500):
         """
         Delete all nodes below, including descendants.
-        Does not delete self.
-        TODO: reimplement to use fast delete
+        Does not delete self. See delete_all_below.
         """
-        for m in self.dir_members:
-            m.delete_below()
-            m.delete()
-        for d in db.query_descendants(self).run():
-            d.delete()
+        DirEntry.delete_all_below([self], batch_size)
+
+    @classmethod
+    def delete_all_below(cls, entries, batch_size=500):
+        """
+        Delete all nodes below each of entries, including descendants.
+        Does not delete the entries themselves.
+
+        The entries below a dir share its path prefix, so they and their
+        descendants (resources, throttles) are found with a kindless
+        keys-only query on a key range. The descendants of each entry are
+        found with an ancestor query. The keys found for all of entries are
+        deleted together, batch_size at a time, and url index entries of
+        deleted resources are removed along with them.
+        """
+        from .resources import UrlIndex
+        own = set(e.key() for e in entries)
+        queries = []
+        for e in entries:
+            if e.is_dir:
+                prefix = e.get_path().rstrip('/')+'/'
+                queries.append(db.Query(keys_only=True).filter(
+                        '__key__ >', db.Key.from_path(cls.kind(), prefix)).filter(
+                        '__key__ <', db.Key.from_path(cls.kind(), prefix+u'\ufffd')))
+            queries.append(db.Query(keys_only=True).ancestor(e))
+        keys = set()
+        for q in queries:
+            while True:
+                found = q.fetch(batch_size)
+                keys.update([k for k in found if k not in own])
+                if len(found) < batch_size:
+                    break
+                q.with_cursor(q.cursor())
+        keys = list(keys)
+        for i in range(0, len(keys), batch_size):
+            chunk = keys[i:i+batch_size]
+            logging.debug('DirEntry: deleting %d entities below %d entries'%(len(chunk), len(entries)))
+            UrlIndex.remove_keys([k for k in chunk if k.kind() == 'Resource'])
+            db.delete(chunk)
 
     def get_path(self):
         return self.key().name()
 
-    def download_content(self, gov):
+    def record_poll(self, changed, now):
         """
-        Download and return the content of the corresponding file
+        Update the statistics of a directory after its listing was requested,
+        and set the next poll time: soon after a change, then backing off
+        exponentially while the directory is unchanged. Does not put.
+        """
+        self.poll_count = (self.poll_count or 0) + 1
+        self.last_polled = now
+        if changed:
+            self.change_count = (self.change_count or 0) + 1
+            self.last_changed = now
+            interval = config.POLL_MIN_INTERVAL
+        else:
+            self.not_modified_count = (self.not_modified_count or 0) + 1
+            interval = min(int((self.poll_interval or config.POLL_MIN_INTERVAL)*config.POLL_BACKOFF),
+                           config.POLL_MAX_INTERVAL)
+        self.poll_interval = interval
+        self.next_poll = now + timedelta(seconds=interval)
+
+    def is_due(self, now):
+        return self.next_poll is None or self.next_poll <= now
+
+    def get_poll_stats(self):
+        """
+        Returns (polls, changes, fraction of polls answered 304)
+        """
+        polls = self.poll_count or 0
+        return (polls, self.change_count or 0,
+                (polls and float(self.not_modified_count or 0)/polls) or 0.0)
+
+    @classmethod
+    def get_due_dirs(cls, now, limit=None):
+        """
+        Returns the directories due for a poll, leaving out those below
+        another due directory, as they are synced along with it.
+        """
+        root = cls.get_root_entry()
+        if root.is_due(now):
+            return [root]
+        due = cls.all().filter('next_poll >', BEGINNING_OF_TIME).filter(
+            'next_poll <=', now).order('next_poll').fetch(limit or config.POLL_MAX_DUE_DIRS)
+        due.sort(key=lambda e: e.get_path())
+        roots = []
+        for e in due:
+            if e.is_dir and not [r for r in roots if e.get_path().startswith(r.get_path()+'/')]:
+                roots.append(e)
+        return roots
+
+    def get_subdirs(self, save=True):
+        """
+        Returns the member directories, with a batch get when the list
+        of member dirs is populated. Entries from before subdirs was
+        introduced get it populated from a query here, and put unless
+        save is False.
+        """
+        if self.member_count is not None:
+            entries = DirEntry.get_by_key_name(self.subdirs)
+            if not [e for e in entries if not e or not e.is_dir]:
+                return entries
+            logging.debug('DirEntry: member dirs of %s are out of date'%self)
+        members = list(self.dir_members)
+        entries = [de for de in members if de.is_dir]
+        self.subdirs = [de.get_path() for de in entries]
+        self.member_count = len(members)
+        if save:
+            self.put()
+        return entries
+
+    def open_content(self, gov):
+        """
+        Returns an open connection for reading the content of the corresponding file.
+        The caller must close it.
         """
-        if self.is_dir:
-            return
         site=gov.site
         filename=site.dropbox_base_dir+self.get_path()
         conn=gov.db_client.get_file(site.dropbox_config['root'], filename)
@@ -139,11 +256,42 @@ class DirEntry(db.Model):
             msg = 'While reading %s. Reason: %s'%(filename, conn.reason)
             gov.access_error_notify(msg)
             raise DropboxError(conn.status, msg)
+        logging.debug('Downloading revision %s. Status: %s'%(filename, conn.status))
+        return conn
+
+    def download_content(self, gov):
+        """
+        Download and return the content of the corresponding file
+        """
+        if self.is_dir:
+            return
+        conn = self.open_content(gov)
         content = conn.read()
-        logging.debug('Downloaded revision %s. Status: %s'%(filename, conn.status))
         conn.close()
         return content
 
+    def iter_content(self, gov, chunk_size):
+        """
+        Download the content of the corresponding file, yielding
+        blocks of chunk_size bytes (the last may be shorter)
+        """
+        if self.is_dir:
+            return
+        conn = self.open_content(gov)
+        try:
+            while True:
+                block = conn.read(chunk_size)
+                while block and len(block) < chunk_size:
+                    more = conn.read(chunk_size-len(block))
+                    if not more:
+                        break
+                    block += more
+                if not block:
+                    break
+                yield block
+        finally:
+            conn.close()
+
     def is_root(self):
         """
         We only allow file entries to be fake
@@ -188,7 +336,7 @@ class DirEntry(db.Model):
                 modlist.append(dict_name)
         return modlist
 
-    def _sync(self, response, normalize_path, update, remove, visit):
+    def _sync(self, response, normalize_path, update, remove, visit, flush=None, save=True):
         """
         A helper for handlers.dropbox.perform_sync
         
@@ -196,6 +344,15 @@ class DirEntry(db.Model):
         is required
         Adds all directories below to 'visit'
         Will append to update, remove and visit.
+
+        A listing is matched against the members in the datastore by a
+        sorted merge (see _merge_listing), reading the contents one at a time
+        from streaming responses (see _iter_listing). If flush is given, it
+        is called with (update, remove) whenever they hold
+        config.SYNC_LISTING_BATCH entries, and should apply and empty them.
+        The entry itself is added to update last, as its hash may follow
+        the contents of a streamed listing. Nothing is written unless save
+        is True (see get_subdirs).
         """
         data = response.data
         logging.debug('DBSync: Dropbox response data:%s'%data)
@@ -207,7 +364,8 @@ class DirEntry(db.Model):
             return 
 
         ## Case A: single file
-        if (response.status == 200 and not data['is_dir']) or (response.status == 304 and not self.is_dir):
+        # Streamed listings may only give is_dir after the contents
+        if (response.status == 200 and not data.get('is_dir', True)) or (response.status == 304 and not self.is_dir):
             logging.debug('DirEntry: Handling a single file %s'%(self))
             ## Corner case -- changed status from dir
             if self.is_dir:
@@ -221,7 +379,7 @@ class DirEntry(db.Model):
         ## Case B: Unmodified directory
         if response.status==304:
             logging.debug('Matching hash for %s'%self)
-            visit.extend([de for de in self.dir_members if de.is_dir])
+            visit.extend(self.get_subdirs(save=save))
             return
 
         ## Case C: Directory without matching hash
@@ -229,62 +387,87 @@ class DirEntry(db.Model):
         if not self.is_dir:
             logging.debug('Entry %s changed from file to dir'%self)
             remove.append(self)
-        self_modlist=self.set_from_dict(data)
-        assert self.is_dir, 'Somehow %s is not a dir...?'%self
         logging.debug('Parsing full listing for %s'%self)
 
-        ## Build dictionary of current dropbox and datastore entries
-        db_contents = dict([(normalize_path(e['path']), e) for e in data['contents'] ])
-        ds_contents = dict([(e.get_path(), e) for e in self.dir_members])
-        db_keys = set(db_contents.keys())
-        ds_keys = set(ds_contents.keys())
-
-        ## Handle the three Venn-sectors one at a time: 
-        db_not_ds = db_keys.difference(ds_keys)
-        db_and_ds = db_keys.intersection(ds_keys)
-        ds_not_db = ds_keys.difference(db_keys)
-
-        # ds_not_db: Removed from dropbox
-        remove.extend([ds_contents[k] for k in ds_not_db])
-
-        # db_not_ds: Created in dropbox
-        for k, entry in itertools.izip(
-                db_not_ds, DirEntry.get_by_key_name(db_not_ds)):
-            # First, check that there is no orphan around:
-            if not entry:
-                entry = DirEntry.get_or_insert(
-                    key_name=k, parent_dir = self,
-                    **self.make_attr_dict(db_contents[k]))
-                logging.debug('Creating entry: %s'%entry)
-            else:
-                logging.debug('Found orphan entry: %s'%entry)
-                modlist = entry.set_from_dict(db_contents[k])
-                entry.parent_dir=self
-                assert entry.hash_ is None
-
-            if entry.is_dir:
-                #Visitor will check is_saved and save
-                visit.append(entry)
-            else:
-                update.append(entry)
-            
-        # db_and_ds: Existing entries
-        for k in db_and_ds:
-            entry = ds_contents[k]
-            if db_contents[k]['is_dir']:
-                if not entry.is_dir:
-                    logging.debug('Entry %s changed file->dir, should be handled when visiting'%entry)
-                # Visit all dirs.
-                # Handle file -> dir corner case when visiting
-                visit.append(entry)
-            else:
-                # only update files now:
-                modlist = entry.set_from_dict(db_contents[k])
-                if modlist:
+        ## Merge the dropbox listing with the datastore members:
+        ## Items only in dropbox are created, members only in the datastore
+        ## are removed, and files in both are updated.
+        created = set()
+        if self.is_saved():
+            members = (e for e in DirEntry.all().filter('parent_dir =', self).order('__key__')
+                       if e.get_path() not in created)
+        else:
+            members = iter([])
+        subdirs = []
+        member_count = 0
+        new_items = []
+
+        def create_entries():
+            keys = [item[0] for item in new_items]
+            for item, entry in itertools.izip(new_items, DirEntry.get_by_key_name(keys)):
+                # First, check that there is no orphan around:
+                if not entry:
+                    # Saved in a batch along with the rest of update, or when visited
+                    entry = DirEntry(
+                        key_name=item[0], parent_dir = self,
+                        **self.make_attr_dict(_item_dict(item)))
+                    logging.debug('Creating entry: %s'%entry)
+                else:
+                    logging.debug('Found orphan entry: %s'%entry)
+                    modlist = entry.set_from_dict(_item_dict(item))
+                    entry.parent_dir=self
+                    assert entry.hash_ is None
+                created.add(entry.get_path())
+                if entry.is_dir:
+                    #Visitor will check is_saved and save
+                    visit.append(entry)
+                else:
                     update.append(entry)
-                    if entry.is_dir:
-                        # Status change dir -> file
-                        remove.append(entry)
+            del new_items[:]
+
+        batch_size = config.SYNC_LISTING_BATCH
+        for path, item, entry in _merge_listing(_iter_listing(response, normalize_path), members,
+                                                page_size=batch_size):
+            if item is None:
+                # Removed from dropbox
+                remove.append(entry)
+            else:
+                member_count += 1
+                if item[1]:
+                    subdirs.append(path)
+                if entry is None:
+                    # Created in dropbox
+                    new_items.append(item)
+                    if len(new_items) >= batch_size:
+                        create_entries()
+                elif item[1]:
+                    if not entry.is_dir:
+                        logging.debug('Entry %s changed file->dir, should be handled when visiting'%entry)
+                    # Visit all dirs.
+                    # Handle file -> dir corner case when visiting
+                    visit.append(entry)
+                else:
+                    # only update files now:
+                    modlist = entry.set_from_dict(_item_dict(item))
+                    if modlist:
+                        update.append(entry)
+                        if entry.is_dir:
+                            # Status change dir -> file
+                            remove.append(entry)
+            if flush and len(update)+len(remove) >= batch_size:
+                flush(update, remove)
+        create_entries()
+
+        ## Streamed fields following the contents are read by now
+        self_modlist=self.set_from_dict(response.data)
+        assert self.is_dir, 'Somehow %s is not a dir...?'%self
+
+        ## Keep track of member dirs, for walking the dir after a 304
+        subdirs.sort()
+        if subdirs != self.subdirs or self.member_count != member_count:
+            self.subdirs = subdirs
+            self.member_count = member_count
+            self_modlist.append('subdirs')
 
         ## Maybe update self (new hash/initial call)
         if self_modlist or not self.is_saved():
@@ -336,13 +519,114 @@ class DirEntry(db.Model):
             gov.handle_metadata_changes(updated = roots)
 
 
+def _iter_listing(response, normalize_path):
+    """
+    The contents of a listing response as compact tuples
+    (path, is_dir, revision, bytes, modified), read one at a time from
+    streaming responses (see dropbox.rest.JSONStreamResponse).
+    Listings which are not streamed are sorted by (normalized) path,
+    as expected by _merge_listing.
+    """
+    def item(e):
+        return (normalize_path(e['path']), e['is_dir'], e.get('revision'),
+                e.get('bytes'), e.get('modified'))
+    if hasattr(response, 'iter_array'):
+        return (item(e) for e in response.iter_array())
+    return iter(sorted(item(e) for e in response.data['contents']))
+
+def _item_dict(item):
+    """
+    The metadata dict of a listing tuple, as accepted by DirEntry.make_attr_dict
+    """
+    return dict((k, v) for k, v in zip(['is_dir', 'revision', 'bytes', 'modified'], item[1:])
+                if v is not None)
+
+def _next(iterator):
+    try:
+        return iterator.next()
+    except StopIteration:
+        return None
+
+def _sorted_pages(items, page_size):
+    """
+    The items, read and sorted page_size at a time
+    """
+    page = list(itertools.islice(items, page_size))
+    while page:
+        page.sort()
+        for item in page:
+            yield item
+        page = list(itertools.islice(items, page_size))
+
+def _merge_listing(items, members, page_size=None):
+    """
+    Match listing tuples with member DirEntries (ordered by path) by path.
+    Yields (path, item, entry), with entry None for items without a member,
+    and item None for members without an item, after all items.
+
+    Items and members are consumed together, and while the items are sorted
+    by path, only the members removed from Dropbox are held until the end.
+    Listings which are not streamed are sorted by _iter_listing, but Dropbox
+    does not promise any order, so streamed listings may not be. With
+    page_size, items are sorted a page at a time, which is enough while
+    pages do not overlap. At the first item out of order, the merge falls
+    back to reading the rest of the items and members into memory.
+    """
+    if page_size:
+        items = _sorted_pages(iter(items), page_size)
+    passed = {}
+    member = _next(members)
+    last = None
+    for item in items:
+        path = item[0]
+        if last is not None and path < last:
+            logging.info('DBSync: listing is not sorted at %s, merging the rest in memory'%path)
+            rest = {path: item}
+            for item in items:
+                rest[item[0]] = item
+            while member is not None:
+                passed[member.get_path()] = member
+                member = _next(members)
+            for path in sorted(rest.keys()):
+                yield (path, rest[path], passed.pop(path, None))
+            break
+        last = path
+        while member is not None and member.get_path() < path:
+            passed[member.get_path()] = member
+            member = _next(members)
+        if member is not None and member.get_path() == path:
+            entry = member
+            member = _next(members)
+        else:
+            entry = passed.pop(path, None)
+        yield (path, item, entry)
+    while member is not None:
+        passed[member.get_path()] = member
+        member = _next(members)
+    for path in sorted(passed.keys()):
+        yield (path, None, passed[path])
+
+def use_delta_sync(gov):
+    """
+    True if full syncs follow the delta feed: in delta mode, unless the
+    client has no delta method (as a LocalFolderClient), in which case
+    syncs walk the tree.
+    """
+    return config.DROPBOX_SYNC_MODE == 'delta' and hasattr(gov.db_client, 'delta')
+
 def perform_sync_by_key(gov, entry_key):
     entry = db.get(entry_key)
     if not entry:
         raise CDeferred.PermanentTaskFailure('Unable to retrieve %s'%entry_key)
+    if entry.is_root() and use_delta_sync(gov):
+        from .delta import perform_delta_sync
+        return perform_delta_sync(gov)
+    if config.DROPBOX_SYNC_MODE == 'plan':
+        from .plan import perform_planned_sync
+        return perform_planned_sync(gov, entry)
     return perform_sync(gov, entry)
 
-def perform_sync(gov, entry):
+def perform_sync(gov, entry, window=None):
     """
     Recursively sync metadata with Dropbox for the tree below `entry`.
     Handlers are called as described below, and all descendants
@@ -362,9 +646,28 @@ def perform_sync(gov, entry):
     are valid, our fundamental goal is to save all information
     pertaining to a client request to the datastore before making a new
     request.
+    Up to `window` (default: config.DROPBOX_SYNC_WINDOW) metadata requests
+    are kept in flight, and responses are processed in the order they
+    complete. As members are only requested once their dir has been
+    processed, the ordering guarantees above still hold.
 
     """
 
+    logging.debug('DBSync: Starting sync from %s'%entry)
+    _sync_entries(gov, [entry], window)
+
+def _sync_entries(gov, visit, window=None, max_dirs=None, visit_filter=None, planner=None):
+    """
+    Sync the trees below the entries in visit, as perform_sync.
+    If max_dirs is given, no more than max_dirs entries are requested.
+    If visit_filter is given, member dirs for which it returns False are
+    not visited (the entries in visit are).
+    If planner is given, changes are passed to planner.add rather than
+    applied, and nothing is written (see plan.make_plan).
+    Returns (entries left to visit, number of entries visited). The member
+    dirs left have passed visit_filter, as they are the entries in visit of
+    the next call (see sync_subtree).
+    """
     base_dir = gov.site.dropbox_base_dir.lower()
     db_root = gov.site.dropbox_config['root']
     db_client = gov.db_client
@@ -374,50 +677,295 @@ def perform_sync(gov, entry):
         assert pl.startswith(base_dir)
         return pl[len(base_dir):]
 
-    logging.debug('DBSync: Starting sync from %s'%entry)
-    visit=[entry]
-    while visit:
-        update=[]
-        remove=[]
-        visiting = visit.pop()
-        logging.debug('DBSync: Visiting %s'%visiting)
-        visiting_path=base_dir+visiting.get_path()
-        response=db_client.metadata(db_root,visiting_path,hash=visiting.hash_ )
-        if not response.status in [200,304, 404]:
-            msg = 'Metadata request for %s failed. %d [%s]: %s'%(visiting_path,response.status,response.reason,response.body)
-            gov.access_error_notify(msg)
-            raise DropboxError(response.status, msg)
-        if response.status == 404:
-            msg = 'Metadata request for %s failed. %d [%s]: %s'%(visiting_path,response.status,response.reason,response.body)
-            #info=db_client.account_info()
-            #msg+='\nDropbox info: %s(%s): %s'%(info.status, info.reason, info.data)
-            logging.debug(msg)
-            
+    list_func = db_client.metadata
+    if config.STREAMING_LISTINGS and getattr(db_client, 'metadata_stream', None):
+        list_func = db_client.metadata_stream
+    fetcher, request = fetchers.make_fetcher(window or config.DROPBOX_SYNC_WINDOW, list_func)
+    visited = 0
+    # Dirs of which only the poll statistics changed, put together at the end,
+    # so walking an unchanged tree costs a single write
+    polled = []
+    start = set(id(e) for e in visit)
+    try:
+        visit=list(visit)
+        while (visit and (max_dirs is None or visited < max_dirs)) or fetcher.pending():
+            # Keep the window of requests full
+            while visit and fetcher.has_room() and (max_dirs is None or visited < max_dirs):
+                visiting = visit.pop()
+                if visit_filter and id(visiting) not in start and not visit_filter(visiting):
+                    logging.debug('DBSync: Skipping %s'%visiting)
+                    continue
+                visited += 1
+                logging.debug('DBSync: Requesting %s'%visiting)
+                fetcher.submit(visiting, request, db_root, base_dir+visiting.get_path(), hash=visiting.hash_)
+            visiting, response = fetcher.next_result()
+            _process_sync_response(gov, visiting, response, normalize_path, visit, planner, polled)
+    finally:
+        fetcher.close()
+    if polled:
+        db.put(polled)
+    if visit_filter:
+        visit = [e for e in visit if id(e) in start or visit_filter(e)]
+    return (visit, visited)
+
+class SyncRun(db.Model):
+    """
+    Book-keeping for a sync split across tasks, see start_sync_run.
+    pending holds the names of the tasks of the run which have not
+    completed. followups are names of actions to take once the run
+    completes, see BaseController.handle_sync_complete
+    Full runs visit all dirs, also with adaptive polling. In planned runs,
+    each task plans and then applies the sync of its part of the tree (see
+    plan.perform_planned_sync).
+    """
+    root_path = db.StringProperty()
+    started = db.DateTimeProperty(auto_now_add=True)
+    updated = db.DateTimeProperty(auto_now=True)
+    finished = db.DateTimeProperty()
+    pending = db.StringListProperty(indexed=False)
+    followups = db.StringListProperty(indexed=False)
+    task_count = db.IntegerProperty(default=0)
+    dir_count = db.IntegerProperty(default=0)
+    full = db.BooleanProperty(default=False)
+    planned = db.BooleanProperty(default=False)
+
+    def __str__(self):
+        return 'Sync of %s started %s: %d tasks, %d dirs, %s'%(
+            self.root_path, self.started, self.task_count, self.dir_count,
+            (self.finished and 'finished %s'%self.finished) or '%d pending'%len(self.pending))
+
+    def is_active(self):
+        return not self.finished and datetime.now()-self.updated < config.SYNC_RUN_TIMEOUT
+
+    @classmethod
+    def get_latest(cls):
+        return cls.all().order('-started').get()
+
+    @classmethod
+    def add_followup(cls, name):
+        """
+        Add a followup to the active run. Returns False if there is none.
+        """
+        run = cls.get_latest()
+        if not run or not run.is_active():
+            return False
+        def txn():
+            r = db.get(run.key())
+            if r.finished:
+                return False
+            if name not in r.followups:
+                r.followups.append(name)
+                r.put()
+            return True
+        return db.run_in_transaction(txn)
+
+    @classmethod
+    def prune(cls, keep=5):
+        """
+        Delete all but the `keep` latest runs, except runs still active
+        """
+        old = [r for r in cls.all().order('-started').fetch(100, offset=keep) if not r.is_active()]
+        if old:
+            logging.debug('SyncRun: deleting %d old runs'%len(old))
+            db.delete(old)
+
+def start_sync_run(gov, entries, full=False, planned=False):
+    """
+    Start a sync of the trees below entries (a DirEntry or a list), split across tasks.
+
+    Each task (sync_subtree) syncs up to config.SYNC_TASK_MAX_DIRS dirs,
+    then hands the remaining subtrees on to at most config.SYNC_FANOUT
+    child tasks. A task and its children are swapped in the pending list
+    of the SyncRun in the transaction enqueuing the children, so a
+    retried task either redoes its (idempotent) sync or does nothing.
+    gov.handle_sync_complete(run) is called when the last task is done.
+    With config.ADAPTIVE_POLLING, dirs which are not due are skipped,
+    unless `full` or `planned` is set. With `planned`, each task plans
+    its changes before applying them, see plan.perform_planned_sync.
+    """
+    if isinstance(entries, DirEntry):
+        entries = [entries]
+    run = SyncRun(root_path=','.join([e.get_path() for e in entries])[:500], pending=['0'], task_count=1,
+                  full=full, planned=planned)
+    def txn():
+        run.put()
+        gov.cdefer(sync_subtree, str(run.key()), '0', [str(e.key()) for e in entries],
+                   _transactional=True, _priority='sync')
+    db.run_in_transaction(txn)
+    logging.debug('SyncRun: started %s'%run)
+    return run
+
+def sync_subtree(gov, run_key, name, entry_keys):
+    """
+    Task of a SyncRun, see start_sync_run
+    """
+    run = SyncRun.get(run_key)
+    if not run or name not in run.pending:
+        logging.debug('SyncRun: task %s of %s is already done'%(name, run_key))
+        return
+    entries = [e for e in db.get(entry_keys) if e]
+    visit_filter = None
+    if config.ADAPTIVE_POLLING and not (run.full or run.planned):
+        now = datetime.now()
+        visit_filter = lambda e: e.is_due(now)
+    planner = None
+    if run.planned:
+        from .plan import Planner
+        planner = Planner(gov)
+    visit, visited = _sync_entries(gov, entries, max_dirs=config.SYNC_TASK_MAX_DIRS,
+                                   visit_filter=visit_filter, planner=planner)
+    if planner:
+        from .plan import apply_planner
+        apply_planner(gov, planner, ','.join([e.get_path() for e in entries])[:500])
+    # New dirs are saved when visited: save them now, so the child tasks can get them
+    db.put([e for e in visit if not e.is_saved()])
+    nchunks = min(len(visit), config.SYNC_FANOUT)
+    chunks = [visit[i::nchunks] for i in range(nchunks)]
+
+    def txn():
+        r = db.get(run_key)
+        if name not in r.pending:
+            return None
+        r.pending.remove(name)
+        for i, chunk in enumerate(chunks):
+            child = '%s.%d'%(name, i)
+            r.pending.append(child)
+            gov.cdefer(sync_subtree, run_key, child, [str(e.key()) for e in chunk],
+                       _transactional=True, _priority='sync')
+        r.task_count += len(chunks)
+        r.dir_count += visited
+        if not r.pending:
+            r.finished = datetime.now()
+        r.put()
+        return r
+    run = db.run_in_transaction(txn)
+    logging.debug('SyncRun: task %s done, %d dirs synced, %d child tasks'%(name, visited, len(chunks)))
+    if run and run.finished:
+        logging.info('SyncRun: completed %s'%run)
+        gov.handle_sync_complete(run)
+        SyncRun.prune()
+
+def _process_sync_response(gov, visiting, response, normalize_path, visit, planner=None, polled=None):
+    """
+    Handle the metadata response for one visited entry, see perform_sync.
+    Visited dirs of which only the poll statistics changed are appended
+    to polled, for the caller to put, or put right away if it is None.
+    """
+    if planner:
+        apply = planner.add
+    else:
+        apply = lambda update, remove: _apply_changes(gov, update, remove)
+    update=[]
+    remove=[]
+    logging.debug('DBSync: Visiting %s'%visiting)
+    visiting_path=gov.site.dropbox_base_dir.lower()+visiting.get_path()
+    if not response.status in [200,304, 404]:
+        msg = 'Metadata request for %s failed. %d [%s]: %s'%(visiting_path,response.status,response.reason,response.body)
+        gov.access_error_notify(msg)
+        raise DropboxError(response.status, msg)
+    if response.status == 404:
+        msg = 'Metadata request for %s failed. %d [%s]: %s'%(visiting_path,response.status,response.reason,response.body)
+        #info=db_client.account_info()
+        #msg+='\nDropbox info: %s(%s): %s'%(info.status, info.reason, info.data)
+        logging.debug(msg)
+        
+    removed_self = []
+    def flush(update, remove):
+        removed_self.extend([e for e in remove if e is visiting])
+        apply(update, remove)
+    try:
         visiting._sync(response=response, normalize_path=normalize_path,
-                       update=update, remove=remove, visit=visit)
-
-        if remove:
-            logging.debug('DBSync: Removing entries:\n -%s'%'\n -'.join([str(e) for e in remove]))
-            gov.handle_metadata_changes(removed=remove)
-            for e in remove:
-                e.delete_below()
-            if not remove[0].parent_dir:
-                msg='Dropbox base dir not accessible'
-                gov.access_error_notify(msg)
-                raise DropboxError(0, msg)
-            else:
-                db.delete(remove)
+                       update=update, remove=remove, visit=visit, flush=flush,
+                       save=not planner)
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+    was_polled = (not planner and visiting.is_dir and response.status in [200, 304]
+                  and not [e for e in remove+removed_self if e is visiting])
+    if was_polled:
+        visiting.record_poll(response.status == 200, datetime.now())
+
+    updated_self = [e for e in update if e is visiting]
+    apply(update, remove)
+    if was_polled and not updated_self:
+        # Only the poll statistics changed
+        if polled is None:
+            visiting.put()
+        else:
+            polled.append(visiting)
+
+def _apply_changes(gov, update, remove):
+    """
+    Handle and delete the entries of remove, then handle and put those of
+    update, and empty both lists
+    """
+    if remove:
+        logging.debug('DBSync: Removing entries:\n -%s'%'\n -'.join([str(e) for e in remove]))
+        gov.handle_metadata_changes(removed=remove)
+        DirEntry.delete_all_below(remove)
+        if not DirEntry.parent_dir.get_value_for_datastore(remove[0]):
+            msg='Dropbox base dir not accessible'
+            gov.access_error_notify(msg)
+            raise DropboxError(0, msg)
+        else:
+            db.delete(remove)
+
+    if update: 
+        logging.debug('DBSync: Updating entries:\n -%s'%'\n -'.join([str(e) for e in update]))
+        gov.handle_metadata_changes(updated=update)
+        db.put(update)
+    del remove[:]
+    del update[:]
 
-        if update: 
-            logging.debug('DBSync: Updating entries:\n -%s'%'\n -'.join([str(e) for e in update]))
-            gov.handle_metadata_changes(updated=update)
-            db.put(update)
+# Instance-local throttle: (namespace, entry path) -> datetime of earliest next sync
+_local_throttle = {}
+_LOCAL_THROTTLE_MAX_SIZE = 1000
+
+def _set_gate(path, until, now):
+    if len(_local_throttle) > _LOCAL_THROTTLE_MAX_SIZE:
+        _local_throttle.clear()
+    _local_throttle[(namespace_manager.get_namespace(), path)] = until
+    memcache.set('_sync_gate:%s'%path, until, time=max(int((until-now).seconds), 1))
+
+def _acquire_sync_lease(path, polint, now):
+    """
+    Cheap check in front of the Throttle entities: Returns True if the caller
+    should go on and check the durable throttle for path.
+    First checks an instance-local timestamp, then tries to atomically add
+    a memcache lease, so only one instance per poll interval gets through.
+    """
+    key = (namespace_manager.get_namespace(), path)
+    until = _local_throttle.get(key)
+    if until and until > now:
+        return False
+    if memcache.add('_sync_gate:%s'%path, now+polint, time=polint.seconds):
+        _local_throttle[key] = now+polint
+        return True
+    until = memcache.get('_sync_gate:%s'%path)
+    if until:
+        _local_throttle[key] = until
+    return False
+
+def _root_poll_interval():
+    """
+    The interval between syncs from root, or with adaptive polling,
+    between looking for directories due for a sync
+    """
+    if config.ADAPTIVE_POLLING and config.DROPBOX_SYNC_MODE == 'walk':
+        return timedelta(seconds=config.POLL_MIN_INTERVAL)
+    return config.DROPBOX_POLL_INTERVAL
 
 def schedule_sync(gov, entry=None):
     """
-    Schedule a sync of either resource or the whole tree.
+    Schedule a sync of either resource or the whole tree (with adaptive
+    polling, of the directories due for a sync).
     Returns earliest sync time (or True for fake resources) if
     sync could not be scheduled.
+
+    `entry` can be a DirEntry or the key of one, in which case it is only
+    fetched if needed. When a sync was scheduled recently, no datastore
+    calls are made. Nothing is scheduled while the circuit breaker
+    guarding Dropbox is open.
     """
     def do_schedule(entry, now):
         tt=Throttle.all().ancestor(entry).filter('earliest_sync >=',now).get()
@@ -425,10 +973,11 @@ def schedule_sync(gov, entry=None):
             logging.debug('Earliest_sync of %s: in %s'%(
                 entry.get_path(),
                 tt.earliest_sync-now))
+            _set_gate(entry.get_path(), tt.earliest_sync, now)
             return tt
         # We are not throttled!
         if entry.is_dir:
-            polint=config.DROPBOX_POLL_INTERVAL
+            polint=_root_poll_interval()
         else:
             polint=config.DROPBOX_FILE_POLL_INTERVAL
 
@@ -441,21 +990,108 @@ def schedule_sync(gov, entry=None):
         # Schedule the fetch
         # taskqueue.add(url=DirEntry, params={'key':str(entry.key())})
         logging.debug('Sync of %s: scheduled'%entry.get_path())
-        gov.cdefer(perform_sync_by_key, str(entry.key()))
+        if entry.is_dir and config.DROPBOX_SYNC_MODE == 'walk':
+            if config.ADAPTIVE_POLLING:
+                due = DirEntry.get_due_dirs(now)
+                logging.debug('Due for sync: %s'%', '.join([e.get_path() for e in due]))
+                if due:
+                    start_sync_run(gov, due)
+            else:
+                start_sync_run(gov, entry)
+        elif entry.is_dir and config.DROPBOX_SYNC_MODE == 'plan':
+            start_sync_run(gov, entry, planned=True)
+        else:
+            # Single files are synced when requested by a visitor
+            gov.cdefer(perform_sync_by_key, str(entry.key()),
+                       _priority=(entry.is_dir and 'sync') or 'interactive')
 
+    if guard.is_open():
+        logging.debug('Dropbox unavailable, not scheduling sync')
+        return True
     now = datetime.now()
 
     ## Start by checking if we can sync root
-    root = DirEntry.get_root_entry()
-    if do_schedule(root,now) is None:
-        # Root was scheduled for sync
+    if _acquire_sync_lease('/', _root_poll_interval(), now):
+        root = DirEntry.get_root_entry()
+        if do_schedule(root,now) is None:
+            # Root was scheduled for sync
+            return
+    if not entry:
+        # schedule was called for root
         return
-    if not entry or entry.is_dir:
-        # schedule was called for root or a directory
+    if isinstance(entry, db.Key):
+        entry_key = entry
+    else:
+        if entry.is_dir:
+            # schedule was called for a directory
+            return
+        entry_key = entry.key()
+    if entry_key.name() == '/':
         return
+    if not _acquire_sync_lease(entry_key.name(), config.DROPBOX_FILE_POLL_INTERVAL, now):
+        return
+    if isinstance(entry, db.Key):
+        entry = DirEntry.get(entry_key)
+        if not entry or entry.is_dir:
+            return
     if entry.is_fake():
         logging.debug('Not scheduling sync for fake entry')
         return True
     ## We have a file sub-entry. Try to sync
     do_schedule(entry, now)
 
+def notify_changes(gov, paths=None):
+    """
+    Schedule syncs for changes pushed by Dropbox (see handlers.notify).
+    paths are the dropbox paths of the changed entries, or None if they
+    are not known, in which case the whole site is synced.
+
+    For each path, the directory listing it is synced after
+    config.NOTIFY_DEBOUNCE seconds. Further notifications for the
+    directory until then are covered by the same sync, so a burst of
+    changes costs one sync. In delta mode, every notification is
+    handled by one sync of the delta feed.
+    Returns the list of directories for which a sync was scheduled.
+    """
+    base_dir = gov.site.dropbox_base_dir.lower()
+    dirs = set()
+    if paths is None or use_delta_sync(gov):
+        dirs.add('/')
+    else:
+        for p in paths:
+            p = p.lower().rstrip('/')
+            if p == base_dir:
+                dirs.add('/')
+            elif p.startswith(base_dir+'/'):
+                dirs.add(posixpath.dirname(p[len(base_dir):]))
+            else:
+                logging.debug('Notify: ignoring change outside site: %s'%p)
+    scheduled = []
+    for path in sorted(dirs):
+        if not memcache.add('_notify:%s'%path, 1, time=max(config.NOTIFY_DEBOUNCE, 1)):
+            logging.debug('Notify: sync of %s is already scheduled'%path)
+            continue
+        gov.cdefer(sync_notified, path, full=(paths is None),
+                   _countdown=config.NOTIFY_DEBOUNCE, _priority='sync')
+        scheduled.append(path)
+    logging.debug('Notify: scheduled sync of %s'%(', '.join(scheduled) or 'nothing'))
+    return scheduled
+
+def sync_notified(gov, path, full=False):
+    """
+    Task syncing the directory at path, or its nearest known ancestor,
+    after a notified change. See notify_changes.
+    """
+    if use_delta_sync(gov):
+        from .delta import perform_delta_sync
+        return perform_delta_sync(gov)
+    ancestors = [path]
+    while ancestors[-1] != '/':
+        ancestors.append(posixpath.dirname(ancestors[-1]))
+    known = [e for e in DirEntry.get_by_key_name(ancestors) if e and e.is_dir]
+    entry = (known and known[0]) or DirEntry.get_root_entry()
+    logging.debug('Notify: syncing %s for change in %s'%(entry.get_path(), path))
+    if config.DROPBOX_SYNC_MODE == 'plan':
+        from .plan import perform_planned_sync
+        return perform_planned_sync(gov, entry)
+    start_sync_run(gov, entry, full=full)
@@ -0,0 +1,308 @@
+"""
+Two-phase sync of the DirEntry tree.
+
+perform_sync handles and writes the changes of each directory as its listing
+arrives. Here, the sync is split in two:
+- make_plan walks Dropbox as perform_sync does, but writes nothing: the
+  entries to remove and to create or update are recorded in a SyncPlan,
+  stored as a compressed blob, split into SyncPlanChunks below the plan
+  when larger than config.PLAN_CHUNK_SIZE. A plan can be inspected
+  (get_diff) before it is applied, which the admin pages use for a dry run.
+- apply_plan removes and writes the planned entries in batches of
+  config.PLAN_APPLY_BATCH, and then calls gov.handle_metadata_changes once
+  per batch of entries of the same resource class.
+
+As all metadata is written before any resource is updated, resources of
+dirs see the final state of their members. Applying is idempotent, so a
+plan that failed halfway can be applied again. A plan records the state
+of Dropbox when it was made, and plans older than config.PLAN_MAX_AGE are
+not applied by apply_plan_by_key.
+
+A plan is made in a single request. In 'plan' mode, syncs are split
+across tasks by a SyncRun as in walk mode, and each task plans and applies
+its own part of the tree (see perform_planned_sync), so resources of dirs
+see the final state of their members, but not of the rest of the tree.
+Plans for the admin pages cover the whole tree, and are made in a task
+by make_stored_plan, so they are only suited to trees that can be walked
+within the task deadline.
+"""
+
+import zlib
+import pickle
+import logging
+from datetime import datetime, timedelta
+
+from google.appengine.ext import db
+
+import config
+from .metadata import DirEntry, DropboxError, _sync_entries, start_sync_run
+
+class SyncPlan(db.Model):
+    """
+    The changes bringing the DirEntries below root_path up to date with
+    Dropbox. data holds the compressed pickle of (removes, upserts), or
+    if that is larger than config.PLAN_CHUNK_SIZE, it is split into
+    chunk_count SyncPlanChunks:
+    removes:  paths of the entries to delete, with everything below them
+    upserts:  tuples of (path, parent path, is_dir, revision, bytes,
+              modified, hash_, subdirs, member_count, existed), one per
+              entry to create (existed is False) or update
+    """
+    root_path = db.StringProperty()
+    created = db.DateTimeProperty(auto_now_add=True)
+    applied = db.DateTimeProperty()
+    remove_count = db.IntegerProperty(default=0)
+    upsert_count = db.IntegerProperty(default=0)
+    data = db.BlobProperty()
+    chunk_count = db.IntegerProperty(default=0)
+    # Changes of a plan made by this request, and their packed form until stored
+    _changes = None
+    _packed = None
+
+    def __str__(self):
+        return 'SyncPlan %s: %d removes, %d upserts%s'%(
+            self.root_path, self.remove_count, self.upsert_count,
+            (self.applied and ', applied') or '')
+
+    @classmethod
+    def make(cls, root_path, removes, upserts):
+        plan = cls(root_path=root_path, remove_count=len(removes), upsert_count=len(upserts))
+        plan._changes = (removes, upserts)
+        plan._packed = zlib.compress(pickle.dumps(plan._changes, 2))
+        return plan
+
+    def put(self, **kwargs):
+        """
+        Store the plan. The first time, its changes are stored along with
+        it, in chunks below it if they do not fit in data.
+        """
+        packed = self._packed
+        if packed is None:
+            return db.Model.put(self, **kwargs)
+        chunks = list(_chunks(packed, config.PLAN_CHUNK_SIZE))
+        if len(chunks) <= 1:
+            self.data = db.Blob(packed)
+            key = db.Model.put(self, **kwargs)
+        else:
+            self.data = None
+            self.chunk_count = len(chunks)
+            def txn():
+                key = db.Model.put(self, **kwargs)
+                db.put([SyncPlanChunk(key=SyncPlanChunk.key_for(self, i), data=db.Blob(c))
+                        for i, c in enumerate(chunks)])
+                return key
+            key = db.run_in_transaction(txn)
+            logging.debug('SyncPlan: stored %s in %d chunks'%(self, len(chunks)))
+        self._packed = None
+        return key
+
+    def get_changes(self):
+        if self._changes is None:
+            if self.chunk_count:
+                chunks = db.get([SyncPlanChunk.key_for(self, i) for i in range(self.chunk_count)])
+                if [c for c in chunks if c is None]:
+                    raise ValueError('The changes of %s are incomplete'%self)
+                packed = ''.join(c.data for c in chunks)
+            else:
+                packed = self.data
+            self._changes = pickle.loads(zlib.decompress(packed))
+        return self._changes
+
+    def is_stale(self, now=None):
+        return (now or datetime.now()) > self.created + timedelta(seconds=config.PLAN_MAX_AGE)
+
+    def get_diff(self):
+        """
+        Returns a list of dicts describing the planned changes, for display
+        """
+        removes, upserts = self.get_changes()
+        diff = [{'action': 'remove', 'path': p} for p in removes]
+        for (path, parent_path, is_dir, revision, bytes, modified, hash_,
+             subdirs, member_count, existed) in upserts:
+            diff.append({
+                    'action': (existed and 'update') or 'create',
+                    'path': path,
+                    'type': (is_dir and 'D') or 'F',
+                    'revision': revision,
+                    'bytes': bytes,
+                    'modified': modified})
+        return diff
+
+    @classmethod
+    def get_latest(cls):
+        return cls.all().order('-created').get()
+
+    @classmethod
+    def prune(cls, keep=5):
+        """
+        Delete all but the `keep` latest plans, with their chunks
+        """
+        keys = cls.all(keys_only=True).order('-created').fetch(100, offset=keep)
+        for key in keys:
+            db.delete(db.Query(keys_only=True).ancestor(key).fetch(1000))
+
+class SyncPlanChunk(db.Model):
+    """
+    A block of the data of a large SyncPlan, keyed below the plan by index
+    """
+    data = db.BlobProperty()
+
+    @staticmethod
+    def key_for(plan, idx):
+        return db.Key.from_path('SyncPlanChunk', '%06d'%idx, parent=plan.key())
+
+class Planner(object):
+    """
+    Records the changes found by _sync_entries instead of applying them
+    """
+    def __init__(self, gov):
+        self.gov = gov
+        self.removes = []
+        self.upserts = []
+
+    def add(self, update, remove):
+        """
+        Record the entries of update and remove, and empty both lists
+        """
+        for e in remove:
+            if not DirEntry.parent_dir.get_value_for_datastore(e):
+                msg = 'Dropbox base dir not accessible'
+                self.gov.access_error_notify(msg)
+                raise DropboxError(0, msg)
+            self.removes.append(e.get_path())
+        for e in update:
+            parent = DirEntry.parent_dir.get_value_for_datastore(e)
+            self.upserts.append((e.get_path(), parent and parent.name(), e.is_dir, e.revision,
+                                 e.bytes, e.modified, e.hash_ and unicode(e.hash_),
+                                 list(e.subdirs), e.member_count, e.is_saved()))
+        del remove[:]
+        del update[:]
+
+    def get_upserts(self):
+        """
+        The recorded upserts, keeping the last one recorded for each path
+        """
+        seen = set()
+        upserts = []
+        for u in reversed(self.upserts):
+            if u[0] not in seen:
+                seen.add(u[0])
+                upserts.append(u)
+        upserts.reverse()
+        return upserts
+
+def make_plan(gov, entry=None, window=None):
+    """
+    Walk Dropbox from entry (default: root) as perform_sync, without
+    writing anything. Returns an unsaved SyncPlan of the changes found.
+    """
+    entry = entry or DirEntry.get_by_key_name('/') or DirEntry(key_name='/', is_dir=True)
+    planner = Planner(gov)
+    logging.debug('SyncPlan: planning sync from %s'%entry)
+    _sync_entries(gov, [entry], window, planner=planner)
+    plan = SyncPlan.make(entry.get_path(), planner.removes, planner.get_upserts())
+    logging.debug('SyncPlan: %s'%plan)
+    return plan
+
+def make_stored_plan(gov):
+    """
+    Task making a plan of a sync from root and storing it, to be shown
+    by the admin pages (see SyncPlan.get_latest)
+    """
+    plan = make_plan(gov)
+    plan.put()
+    SyncPlan.prune()
+    return plan
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+def _resource_class(gov, path, is_dir):
+    entry_path = path.rstrip('/')
+    if is_dir:
+        entry_path += '/'
+    return gov.get_resource_default_attributes(entry_path).get('resource_class')
+
+def apply_plan(gov, plan, batch_size=None):
+    """
+    Apply plan, see the module documentation. The removed entries are
+    handled before they are deleted, as in perform_sync.
+    """
+    batch_size = batch_size or config.PLAN_APPLY_BATCH
+    removes, upserts = plan.get_changes()
+    logging.debug('SyncPlan: applying %s'%plan)
+
+    for paths in _chunks(removes, batch_size):
+        entries = [e for e in DirEntry.get_by_key_name(paths) if e]
+        if entries:
+            gov.handle_metadata_changes(removed=entries)
+            DirEntry.delete_all_below(entries)
+            db.delete(entries)
+
+    # Write all metadata, then group the entries by resource class
+    groups = {}
+    for chunk in _chunks(upserts, batch_size):
+        entries = DirEntry.get_by_key_name([u[0] for u in chunk])
+        for i, (path, parent_path, is_dir, revision, bytes, modified, hash_,
+                subdirs, member_count, existed) in enumerate(chunk):
+            parent_key = parent_path and db.Key.from_path(DirEntry.kind(), parent_path)
+            e = entries[i] or DirEntry(key_name=path)
+            e.parent_dir = parent_key
+            e.is_dir = is_dir
+            e.revision = revision
+            e.bytes = bytes
+            e.modified = modified
+            e.hash_ = hash_
+            e.subdirs = subdirs
+            e.member_count = member_count
+            entries[i] = e
+            groups.setdefault(_resource_class(gov, path, is_dir), []).append(path)
+        db.put(entries)
+
+    for resource_class in sorted(groups.keys()):
+        logging.debug('SyncPlan: updating %d entries of class %s'%(
+                len(groups[resource_class]), resource_class))
+        for paths in _chunks(groups[resource_class], batch_size):
+            gov.handle_metadata_changes(updated=[e for e in DirEntry.get_by_key_name(paths) if e])
+
+    plan.applied = datetime.now()
+    if plan.is_saved():
+        plan.put()
+
+def apply_plan_by_key(gov, plan_key):
+    """
+    Task applying a stored plan, unless it was applied or is stale
+    """
+    plan = SyncPlan.get(plan_key)
+    if not plan or plan.applied:
+        logging.info('SyncPlan: %s is gone or applied, nothing to do'%plan_key)
+        return
+    if plan.is_stale():
+        logging.warning('SyncPlan: not applying stale %s'%plan)
+        return
+    apply_plan(gov, plan)
+
+def apply_planner(gov, planner, root_path):
+    """
+    Apply the changes recorded by planner, without storing them.
+    Returns the (unsaved) SyncPlan applied.
+    """
+    plan = SyncPlan.make(root_path, planner.removes, planner.get_upserts())
+    logging.debug('SyncPlan: %s'%plan)
+    if plan.remove_count or plan.upsert_count:
+        apply_plan(gov, plan)
+    return plan
+
+def perform_planned_sync(gov, entry=None):
+    """
+    Sync the tree below entry (default: root) in a planned SyncRun, of
+    which each task plans and applies its part of the tree (see
+    start_sync_run). A file entry is planned and applied right away.
+    """
+    entry = entry or DirEntry.get_root_entry()
+    if entry.is_dir:
+        return start_sync_run(gov, entry, planned=True)
+    planner = Planner(gov)
+    _sync_entries(gov, [entry], planner=planner)
+    return apply_planner(gov, planner, entry.get_path())
@@ -7,18 +7,27 @@ import logging
 import yaml
 import cgi
 import traceback
+import zlib
+import gzip
+import bisect
+import time
+from cStringIO import StringIO
+from email.utils import parsedate
 
 import aetycoon
 import dropbox.auth
 import dropbox.client
 from google.appengine.ext import db
 from google.appengine.ext.db import polymodel
+from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
 
 import google.appengine.ext.webapp.template #just to fix django imports
 import django.template
 import django.template.loader
 
 from siteinadropbox import formatters
+from siteinadropbox import cache
 import config
 
 """
@@ -34,17 +43,142 @@ currently using a modified __getattr__, but it seems better to implement a cache
 class FormatError(Exception):
     pass
 
+def http_date(dt):
+    "Format a (UTC) datetime as an RFC 1123 date"
+    return dt.strftime('%a, %d %b %Y %H:%M:%S GMT')
+
+def parse_http_date(s):
+    "Returns a datetime, or None if s cannot be parsed"
+    t = s and parsedate(s)
+    if t:
+        return datetime(*t[:6])
+
+def is_not_modified(request, etag=None, last_modified=None):
+    """
+    Check the conditional headers of request against the current validators.
+    If-None-Match takes precedence over If-Modified-Since (RFC 2616, 14.26).
+    """
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and etag:
+        tags = [t.strip() for t in if_none_match.split(',')]
+        return '*' in tags or etag in tags or ('W/'+etag) in tags
+    since = parse_http_date(request.headers.get('If-Modified-Since'))
+    if since and last_modified:
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+COMPRESSIBLE_CONTENT_TYPES = re.compile(
+    r'^(text/.*|image/svg\+xml|application/(x-)?javascript|application/json|application/.*\+?xml)(;.*)?$',
+    re.IGNORECASE)
+
+def gzip_compress(data, content_type=None):
+    """
+    Returns the gzip variant of data, or None if data is too small or
+    of a content type that does not compress.
+    """
+    if not data or len(data) < config.GZIP_MIN_SIZE:
+        return None
+    if content_type and not COMPRESSIBLE_CONTENT_TYPES.match(content_type):
+        return None
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    buf = StringIO()
+    f = gzip.GzipFile(mode='wb', fileobj=buf, compresslevel=config.GZIP_LEVEL)
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+def accepts_gzip(request):
+    for coding in request.headers.get('Accept-Encoding', '').split(','):
+        parts = [p.strip() for p in coding.split(';')]
+        if parts[0].lower() in ['gzip', 'x-gzip']:
+            return not [p for p in parts[1:] if p.replace(' ','') in ['q=0', 'q=0.0']]
+    return False
+
+def write_body(handler, body, body_gz=None):
+    """
+    Write body to the response, or the precompressed body_gz if the client accepts it.
+    """
+    if body_gz:
+        handler.response.headers['Vary'] = 'Accept-Encoding'
+        if accepts_gzip(handler.request):
+            handler.response.headers['Content-Encoding'] = 'gzip'
+            handler.response.out.write(body_gz)
+            return
+    handler.response.out.write(body)
+
+def _pending_key(resource_key):
+    return '_pending_revision:%s'%resource_key
+
+def set_pending_revision(resource_key, revision):
+    """
+    Mark a resource as having an action for revision scheduled.
+    The marker holds (revision, time first marked).
+    """
+    key = _pending_key(resource_key)
+    old = memcache.get(key)
+    if old and old[0] == revision:
+        return
+    memcache.set(key, (revision, time.time()))
+
+def get_pending_revision(resource_key):
+    """
+    Returns (revision, seconds since marked) for a resource with a
+    scheduled action, otherwise None
+    """
+    marker = memcache.get(_pending_key(resource_key))
+    if marker:
+        return (marker[0], time.time()-marker[1])
+
+def clear_pending_revisions(resources):
+    """
+    Remove the markers which are satisfied by the current revision of resources
+    """
+    keys = [_pending_key(r.key()) for r in resources]
+    markers = memcache.get_multi(keys)
+    memcache.delete_multi([k for k, r in zip(keys, resources)
+                           if k in markers and markers[k][0] <= (r.revision or 0)])
+
+def clear_pending_revision(resource_keys):
+    memcache.delete_multi([_pending_key(k) for k in resource_keys])
+
 class Resource(polymodel.PolyModel):
     """
     A resource is identified by a unique Uniform Resource Locator and knows how to serve itself.
     """
     revision = db.IntegerProperty()
+    modified = db.DateTimeProperty()
     url = db.StringProperty()
-    queue_name = config.RESOURCE_QUEUENAME
+    priority = config.RESOURCE_PRIORITY
 
     def __str__(self):
         return '%s@%s backed by %s'%(self.__class__.__name__,self.url, self.parent())
 
+    def get_validators(self, gov):
+        """
+        Returns (etag, last_modified) for the current representation.
+        Either can be None.
+        """
+        if self.revision is None:
+            return (None, None)
+        return ('"rev%d"'%self.revision, self.modified)
+
+    def serve(self, gov, handler):
+        """
+        Serve handler.request, answering conditional requests with
+        a body-less 304 when the validators match.
+        """
+        etag, last_modified = self.get_validators(gov)
+        if etag:
+            handler.response.headers['ETag'] = etag
+        if last_modified:
+            handler.response.headers['Last-Modified'] = http_date(last_modified)
+        if is_not_modified(handler.request, etag, last_modified):
+            logging.debug('Not modified: %s'%self)
+            handler.response.set_status(304)
+            return
+        self.serve_request(gov, handler)
+
     def serve_request(self, site, handler):
         "Serve according to a web-ob request object"
         raise NotImplementedError()
@@ -57,9 +191,50 @@ class Resource(polymodel.PolyModel):
         """
         pass
 
-    def schedule(self, gov, action, new_revision):
+    def schedule(self, gov, action, new_revision, priority=None):
+        """
+        Have action run on this resource for new_revision, as a task of
+        priority (default: gov.action_priority, else the priority of the resource)
+        """
+        priority = priority or getattr(gov, 'action_priority', None) or self.priority
         logging.debug('Scheduling %s on %s. New rev.: %d'%(action.__name__, self, new_revision))
-        gov.cdefer(action, new_revision, _queue = self.queue_name)
+        set_pending_revision(self.key(), new_revision)
+        if new_revision != self.revision:
+            # Stale responses are not cached, see main.PageHandler.revalidate
+            cache.flush_response(self.url)
+        if getattr(gov, 'batch_actions', False):
+            from .batch import add_action
+            add_action(gov, self, action.__name__, new_revision, priority)
+            return
+        gov.cdefer(action, new_revision, _priority = priority)
+
+    def estimate_fetch_time(self):
+        """
+        Estimated seconds to download the source of this resource
+        """
+        entry = self.parent()
+        return config.SWR_FETCH_LATENCY + float((entry and entry.bytes) or 0)/config.SWR_FETCH_BANDWIDTH
+
+    def refresh(self, gov, new_revision):
+        """
+        Run the actions pending on this resource now. Returns the updated resource.
+        """
+        if getattr(gov, 'batch_actions', False):
+            from .batch import run_batch
+            run_batch(gov, resource_keys=[str(self.key())])
+        else:
+            self.fetch(gov, new_revision)
+        return Resource.get(self.key())
+
+    def request_refresh(self, gov, new_revision):
+        """
+        Have the actions pending on this resource run soon, in an interactive task
+        """
+        if getattr(gov, 'batch_actions', False):
+            from .batch import promote_actions
+            promote_actions(gov, self.key())
+        elif memcache.add('_refresh:%s:%d'%(self.key(), new_revision), 1, time=60):
+            gov.cdefer(self.fetch, new_revision, _priority='interactive')
 
     @classmethod
     def delete_orphans(cls,gov):
@@ -73,8 +248,33 @@ class Resource(polymodel.PolyModel):
 
     @classmethod
     def get_resource_by_url(cls, url):
-        # We cannot use 'get_by_key_name' because that would require knowing the parent
-        return cls.all().filter('url =',url.lower()).get()
+        return cls.get_resources_by_url([url])[0]
+
+    @classmethod
+    def get_resources_by_url(cls, urls):
+        """
+        Batch lookup of resources by url. Returns a list matching urls,
+        with None for unknown urls.
+        We cannot use 'get_by_key_name' because that would require knowing the parent,
+        so we go through the UrlIndex. Until the index has been backfilled
+        (see UrlIndex.backfill), urls missing from it are looked up with a
+        query, and indexed if found, as they may belong to resources from
+        before the index. Once it is backfilled, a miss is a miss.
+        """
+        urls = [u.lower() for u in urls]
+        keys = UrlIndex.get_resource_keys(urls)
+        hits = [k for k in keys if k]
+        resources = dict((r.key(), r) for r in (hits and db.get(hits) or []) if r)
+        found = [(k in resources and resources[k].url == u and resources[k]) or None
+                 for u,k in zip(urls, keys)]
+        if None in keys and not UrlIndex.is_backfilled():
+            for i, u in enumerate(urls):
+                if not keys[i]:
+                    found[i] = cls.all().filter('url =', u).get()
+                    if found[i]:
+                        logging.debug('Resource %s was not indexed, indexing it'%u)
+                        UrlIndex.set(found[i])
+        return found
 
     @classmethod 
     def update(cls, gov, entry):
@@ -99,7 +299,9 @@ class Resource(polymodel.PolyModel):
             ## run block delete and call the listener
             for rr in  Resource.all().ancestor(entry).run():
                 logging.debug('Entry: %s. Old resource deleted, url: %s. Res: %s'%(entry_path, rr.url, rr))
+                UrlIndex.remove(rr)
                 rr.delete()
+                gov.handle_resource_changes(removed=[rr])
 
         ##Compute a normalized entry path (ends with / for dirs)
         entry_path = entry.get_path().rstrip('/')
@@ -136,11 +338,13 @@ class Resource(polymodel.PolyModel):
                 return
             else:
                 logging.debug('Entry %s: Takes precedence over %s for URL %s'%(entry, resource.parent(), url))
+                UrlIndex.remove(resource)
                 resource.delete()
                 resource=None
         if resource and not isinstance(resource, resource_class):
             logging.debug('Resource for %s deleted as previous type %s did not match %s'%(
                 entry_path,type(resource), resource_class))
+            UrlIndex.remove(resource)
             resource.delete()
             resource=None
 
@@ -152,6 +356,7 @@ class Resource(polymodel.PolyModel):
                                                     parent=entry,
                                                     url=url)
             resource.put()
+            UrlIndex.set(resource)
         else:
             assert (
                 (resource.parent().key() == entry.key()) and
@@ -163,11 +368,272 @@ class Resource(polymodel.PolyModel):
         resource.verify_state(gov, entry, default_attributes = attributes)
 
 
+class UrlIndex(db.Model):
+    """
+    Root-level entity keyed by url, pointing to the resource serving that url.
+    Kept in sync by Resource.update. Entries pointing to deleted resources
+    are treated as misses by Resource.get_resources_by_url.
+    The entry with key name BACKFILLED (not a url, as urls start with '/')
+    marks that all resources have been indexed, see backfill.
+    """
+    resource = db.ReferenceProperty()
+
+    BACKFILLED = '_backfilled'
+    # Bumped whenever the set of indexed urls changes
+    generation = cache.Generation('urls')
+    # Instance copies of the known urls: namespace -> (generation, sorted
+    # list of urls, False if the index is incomplete or None if the list is
+    # not built, time loaded)
+    _known_urls = {}
+    # Namespaces seen to be backfilled by this instance
+    _backfilled = set()
+
+    @classmethod
+    def changed(cls):
+        """
+        Record a change to the set of indexed urls
+        """
+        memcache.set('_known_urls_changed', time.time())
+        cls.generation.bump()
+
+    @classmethod
+    def is_backfilled(cls):
+        """
+        True if all resources of the current namespace have been indexed.
+        The marker is only looked up until it is found, as it is never removed.
+        """
+        namespace = namespace_manager.get_namespace()
+        if namespace in cls._backfilled:
+            return True
+        if cls.get_by_key_name(cls.BACKFILLED):
+            cls._backfilled.add(namespace)
+            return True
+        return False
+
+    @classmethod
+    def get_resource_keys(cls, urls):
+        """
+        Returns the list of resource keys for urls, without fetching the resources.
+        """
+        return [idx and cls.resource.get_value_for_datastore(idx)
+                for idx in cls.get_by_key_name(urls)]
+
+    @classmethod
+    def set(cls, resource):
+        cls(key_name=resource.url, resource=resource).put()
+        cls.update_known_urls(add=[resource.url])
+        cls.changed()
+
+    @classmethod
+    def remove(cls, resource):
+        """
+        Remove the index entry for resource, unless the url has been taken over
+        """
+        idx = cls.get_by_key_name(resource.url)
+        if idx and cls.resource.get_value_for_datastore(idx) == resource.key():
+            idx.delete()
+            cls.update_known_urls(remove=[resource.url])
+            cls.changed()
+
+    @classmethod
+    def remove_keys(cls, resource_keys):
+        """
+        Remove the index entries pointing to the resources of resource_keys,
+        for resources deleted by key (see DirEntry.delete_all_below)
+        """
+        if not resource_keys:
+            return
+        indexed = cls.get_by_key_name([k.name() for k in resource_keys])
+        stale = [idx for idx, k in zip(indexed, resource_keys)
+                 if idx and cls.resource.get_value_for_datastore(idx) == k]
+        if stale:
+            db.delete(stale)
+            cls.update_known_urls(remove=[idx.key().name() for idx in stale])
+            cls.changed()
+
+    @classmethod
+    def backfill(cls, batch_size=500):
+        """
+        Index the resources that have no index entry, such as those created
+        before the index was introduced, and mark the index as complete.
+        Returns the number of entries added.
+        """
+        added = 0
+        last = None
+        while True:
+            q = Resource.all(keys_only=True).order('__key__')
+            if last:
+                q.filter('__key__ >', last)
+            keys = q.fetch(batch_size)
+            if not keys:
+                break
+            last = keys[-1]
+            indexed = cls.get_by_key_name([k.name() for k in keys])
+            missing = [cls(key_name=k.name(), resource=k) for k, idx in zip(keys, indexed) if not idx]
+            if missing:
+                db.put(missing)
+                added += len(missing)
+        if added:
+            logging.info('UrlIndex: indexed %d resources'%added)
+        if added or not cls.get_by_key_name(cls.BACKFILLED):
+            cls(key_name=cls.BACKFILLED).put()
+            # Rebuilt with the new entries, see request_rebuild
+            memcache.delete('_known_urls')
+            cls.changed()
+        return added
+
+    @classmethod
+    def get_known_urls(cls, now=None):
+        """
+        Returns a sorted list of all indexed urls, or None if it is not known.
+        The list is kept (compressed) in memcache, where set and remove
+        update it as urls are indexed, and in instance memory for up to
+        config.KNOWN_URLS_MAX_AGE seconds or until the generation changes.
+        It is never built here: when it is missing from memcache, it is
+        not known until rebuild_known_urls has run, see request_rebuild.
+        Nor is it known before the index has been backfilled; this is
+        cached as the list would be, see request_backfill.
+        """
+        now = now or time.time()
+        gen = cls.generation.get()
+        namespace = namespace_manager.get_namespace()
+        known = cls._known_urls.get(namespace)
+        if not (known and known[0] == gen and now-known[2] < config.KNOWN_URLS_MAX_AGE):
+            known = (gen, _unpack_urls(memcache.get('_known_urls')), now)
+            cls._known_urls[namespace] = known
+        if known[1] is None or known[1] is False:
+            return None
+        return known[1]
+
+    @classmethod
+    def update_known_urls(cls, add=[], remove=[]):
+        """
+        Add and remove urls from the list of known urls in memcache, if it
+        is there. If the update fails, the list is dropped, to be rebuilt.
+        """
+        client = memcache.Client()
+        for attempt in range(3):
+            packed = client.gets('_known_urls')
+            if packed is None or packed is False:
+                return
+            urls = set(_unpack_urls(packed))
+            urls.update(add)
+            urls.difference_update(remove)
+            try:
+                if client.cas('_known_urls', _pack_urls(sorted(urls))):
+                    return
+            except ValueError:
+                logging.warning('List of known urls is too large for memcache')
+                break
+        memcache.delete('_known_urls')
+
+    @classmethod
+    def rebuild_known_urls(cls, gov):
+        """
+        Build the list of known urls with a keys-only query and store it in
+        memcache. As the query is eventually consistent, it may miss urls
+        indexed less than config.KNOWN_URLS_SETTLE seconds ago, so the
+        rebuild is postponed until the last change has settled, and is
+        redone if the index changed while it ran.
+        """
+        start = time.time()
+        changed = memcache.get('_known_urls_changed')
+        if changed and start-changed < config.KNOWN_URLS_SETTLE:
+            logging.debug('UrlIndex: postponing rebuild of known urls until changes settle')
+            gov.cdefer(rebuild_known_url_list, _countdown=int(config.KNOWN_URLS_SETTLE-(start-changed))+1,
+                       _priority='sync')
+            return
+        names = [k.name() for k in cls.all(keys_only=True)]
+        if cls.BACKFILLED in names:
+            urls = sorted(n for n in names if n != cls.BACKFILLED)
+            packed = _pack_urls(urls)
+            logging.debug('Rebuilt list of %d known urls (%d B)'%(len(urls), len(packed)))
+        else:
+            logging.debug('Url index is not backfilled, urls are not known')
+            packed = False
+        try:
+            memcache.set('_known_urls', packed)
+        except ValueError:
+            logging.warning('List of known urls is too large for memcache')
+            return
+        changed = memcache.get('_known_urls_changed')
+        if changed and changed >= start:
+            # Changes made meanwhile may be missing from both the list and the query
+            memcache.delete('_known_urls')
+            gov.cdefer(rebuild_known_url_list, _countdown=config.KNOWN_URLS_SETTLE+1, _priority='sync')
+            return
+        cls.generation.bump()
+
+    @classmethod
+    def request_rebuild(cls, gov):
+        """
+        Queue a rebuild if get_known_urls found no list of known urls.
+        At most one is queued per config.KNOWN_URLS_SETTLE seconds.
+        """
+        known = cls._known_urls.get(namespace_manager.get_namespace())
+        if known and known[1] is None and memcache.add(
+            '_known_urls_rebuild_queued', time.time(), time=config.KNOWN_URLS_SETTLE):
+            logging.info('UrlIndex: queueing rebuild of known urls')
+            gov.cdefer(rebuild_known_url_list, _priority='sync')
+
+    @classmethod
+    def request_backfill(cls, gov):
+        """
+        Queue a backfill if get_known_urls found the index incomplete.
+        At most one is queued per config.URL_BACKFILL_INTERVAL.
+        """
+        known = cls._known_urls.get(namespace_manager.get_namespace())
+        if known and known[1] is False and memcache.add(
+            '_url_backfill_queued', time.time(), time=config.URL_BACKFILL_INTERVAL):
+            logging.info('UrlIndex: queueing backfill')
+            gov.cdefer(backfill_url_index, _priority='bulk')
+
+    @classmethod
+    def may_exist(cls, urls):
+        """
+        Returns False only if none of urls are known. Only indexed urls
+        can be served, so this is a definite miss -- except when the list of
+        known urls is not known, see get_known_urls.
+        """
+        known = cls.get_known_urls()
+        if known is None:
+            return True
+        for url in urls:
+            url = url.lower()
+            i = bisect.bisect_left(known, url)
+            if i < len(known) and known[i] == url:
+                return True
+        return False
+
+def backfill_url_index(gov):
+    """
+    Task running UrlIndex.backfill, see UrlIndex.request_backfill
+    """
+    UrlIndex.backfill()
+
+def rebuild_known_url_list(gov):
+    """
+    Task running UrlIndex.rebuild_known_urls, see UrlIndex.request_rebuild
+    """
+    UrlIndex.rebuild_known_urls(gov)
+
+def _pack_urls(urls):
+    return zlib.compress('\n'.join(u.encode('utf-8') for u in urls))
+
+def _unpack_urls(packed):
+    """
+    The list of urls packed by _pack_urls. None and False are passed through.
+    """
+    if packed is None or packed is False:
+        return packed
+    return [u.decode('utf-8') for u in zlib.decompress(packed).split('\n') if u]
+
 class TextResource(Resource):
     source = db.TextProperty()
+    source_gz = db.BlobProperty()
 
     def serve_request(self, gov, handler):
-        handler.response.out.write(self.source)
+        write_body(handler, self.source, self.source_gz)
 
     def verify_state(self, gov, entry, default_attributes):
         if entry.revision != self.revision:
@@ -175,15 +641,28 @@ class TextResource(Resource):
             self.schedule(gov, action=self.fetch, new_revision=entry.revision)
 
     def fetch(self, gov, new_revision):
-        self.fetch_from_dropbox(gov, new_revision)
+        entry = self.parent()
+        self.receive(gov, entry, entry.download_content(gov), new_revision)
         self.put()
         gov.handle_resource_changes(updated=[self])
 
+    def receive(self, gov, entry, source, new_revision):
+        """
+        Take in downloaded source for new_revision of entry. Does not put,
+        so fetches can be batched, see batch.run_batch.
+        """
+        self.set_source(entry, source, new_revision)
+        self.source_gz = gzip_compress(self.source)
+
+    def set_source(self, entry, source, new_revision):
+        self.source=source
+        self.revision=new_revision
+        self.modified=entry.modified
+
     def fetch_from_dropbox(self, gov, new_revision):
         entry = self.parent()
-        self.source=entry.download_content(gov)
-        self.revision=new_revision
-        
+        self.set_source(entry, entry.download_content(gov), new_revision)
+
 class PageResource(TextResource):
     """
     A page resource can represent a single file or a dir with or without index.
@@ -195,6 +674,7 @@ class PageResource(TextResource):
     """
     source_format = db.StringProperty()
     body = db.TextProperty()
+    body_gz = db.BlobProperty()
 # tags = TODO
 # title = TODO
     default_attributes = aetycoon.PickleProperty(default={})
@@ -242,6 +722,7 @@ class PageResource(TextResource):
                 self.schedule(gov, action=self.run_formatter, new_revision=entry.revision)
             elif self.body:
                 self.body = None
+                self.body_gz = None
                 modlist.append('body')
         if 'source' in modlist or 'body' in modlist:
             self.put()
@@ -249,16 +730,25 @@ class PageResource(TextResource):
         
     def fetch(self, gov, new_revision):
         logging.debug('PageResource fetch on %s to rev %d'%(self, new_revision))
-        super(PageResource,self).fetch_from_dropbox(gov, new_revision)
-        self.run_formatter(gov, new_revision)
-        gov.handle_resource_changes(updated=[self])
+        TextResource.fetch(self, gov, new_revision)
+
+    def receive(self, gov, entry, source, new_revision):
+        self.set_source(entry, source, new_revision)
+        self.format_source(gov)
 
     def run_formatter(self, gov, new_revision):
+        self.format_source(gov)
+        self.put()
+
+    def format_source(self, gov):
+        """
+        Set body and attributes from source. Does not put.
+        """
         logging.debug('PageResource format %s as %s'%(self, self.source_format))
-        def fail(msg):
+        def fail():
             self.body = cgi.escape(self.source)
+            self.body_gz = gzip_compress(self.body)
             self.attributes = self.default_attributes
-            self.put()
 
         formatter=formatters.get_formatter_by_name(self.source_format)
         if (not formatter) and (self.source_format is not None):
@@ -277,8 +767,7 @@ class PageResource(TextResource):
         else:
             self.body = cgi.escape(self.source)
             self.attributes = self.default_attributes
-            
-        self.put()
+        self.body_gz = gzip_compress(self.body)
 
     def __getattr__(self, k):
         try:
@@ -286,6 +775,18 @@ class PageResource(TextResource):
         except KeyError:
             raise AttributeError(k)
 
+    def get_validators(self, gov):
+        """
+        The rendered page depends on the templates and the site config as well as
+        the revision. Reformatting does not change the revision, so the body is
+        checksummed as well. No Last-Modified is given.
+        """
+        body = self.body or u''
+        return ('"p%s-%08x-t%s-c%s"'%(
+                self.revision, zlib.adler32(body.encode('utf-8')) & 0xffffffff,
+                cache.template_generation.get(), cache.config_generation.get()),
+                None)
+
     def serve_request(self, gov, handler):
         template_path = self.attributes.get('template', None)
         if template_path:
@@ -297,7 +798,7 @@ class PageResource(TextResource):
             handler.response.out.write(template.render(context))
         else:
             logging.debug('Serving request with raw body')
-            handler.response.out.write(self.body)
+            write_body(handler, self.body, self.body_gz)
 
 class ConfigResource(TextResource):
     def fetch(self, gov, new_revision):
@@ -326,27 +827,120 @@ def debug_headers(response):
     response.wsgi_write(sr)
     raise Exception('Trying to debug headers')
 
+def parse_range(range_header, size):
+    """
+    Parse a single byte range 'bytes=first-last' or 'bytes=-suffix'.
+    Returns (first, last) inclusive, None if the header should be ignored
+    and False if the range cannot be satisfied.
+    """
+    if not range_header or not range_header.startswith('bytes='):
+        return None
+    spec = range_header[6:].strip()
+    if ',' in spec or '-' not in spec:
+        return None
+    first, last = [p.strip() for p in spec.split('-', 1)]
+    try:
+        if not first:
+            n = int(last)
+            if n <= 0:
+                return False
+            return (max(size-n, 0), size-1)
+        first = int(first)
+        if last:
+            last = min(int(last), size-1)
+        else:
+            last = size-1
+    except ValueError:
+        return None
+    if first > last or first >= size:
+        return False
+    return (first, last)
+
+class ContentChunk(db.Model):
+    """
+    A block of the content of a large RawResource.
+    Chunks are keyed below the resource as 'r<revision>-<index>'.
+    """
+    data = db.BlobProperty()
+
+    @staticmethod
+    def key_for(resource, revision, idx):
+        return db.Key.from_path('ContentChunk', 'r%d-%06d'%(revision, idx), parent=resource.key())
+
 class RawResource(Resource):
+    """
+    Content up to config.CONTENT_CHUNK_SIZE is stored in source. Larger files
+    are streamed from Dropbox into ContentChunk entities, and served chunk by chunk.
+    """
     source = db.BlobProperty()
+    source_gz = db.BlobProperty()
     content_type = db.StringProperty()
+    size = db.IntegerProperty()
+    chunk_count = db.IntegerProperty(default=0)
 
     def serve_request(self, gov, handler):
-        handler.response.out.write(self.source)
         if self.content_type:
             handler.response.headers['Content-Type']=str(self.content_type)
         if config.PROXY_ENABLED:
             #The headers field is not quite a dict and does not support `update`
             for k,v in {
                 'Cache-Control': 'max-age=%d'%config.PROXY_MAX_AGE,
-                'ETag': '"rev%d"'%self.revision,
                 }.iteritems():
                 handler.response.headers[k]=str(v)
+        handler.response.headers['Accept-Ranges'] = 'bytes'
+
+        size = self.size
+        if size is None:
+            size = len(self.source or '')
+        byte_range = None
+        if_range = handler.request.headers.get('If-Range')
+        if not if_range or if_range == self.get_validators(gov)[0]:
+            byte_range = parse_range(handler.request.headers.get('Range'), size)
+        if byte_range is False:
+            handler.response.set_status(416)
+            handler.response.headers['Content-Range'] = 'bytes */%d'%size
+            return
+        if byte_range:
+            first, last = byte_range
+            handler.response.set_status(206)
+            handler.response.headers['Content-Range'] = 'bytes %d-%d/%d'%(first, last, size)
+            self.write_content(handler, first, last+1)
+        elif self.chunk_count:
+            self.write_content(handler, 0, size)
+        else:
+            write_body(handler, self.source, self.source_gz)
         #debug_headers(handler.response)
 
+    def write_content(self, handler, start, stop):
+        """
+        Write bytes [start, stop) to the response, reading only the chunks needed
+        """
+        for block in self.iter_content(start, stop):
+            handler.response.out.write(block)
+
+    def iter_content(self, start=0, stop=None):
+        """
+        Yield bytes [start, stop) of the content, one chunk at a time
+        """
+        if not self.chunk_count:
+            yield (self.source or '')[start:stop]
+            return
+        if stop is None:
+            stop = self.size
+        chunk_size = config.CONTENT_CHUNK_SIZE
+        for idx in range(start//chunk_size, (stop-1)//chunk_size+1):
+            chunk = db.get(ContentChunk.key_for(self, self.revision, idx))
+            if not chunk:
+                logging.error('Missing chunk %d of %s'%(idx, self))
+                raise FormatError('Content of %s is incomplete'%self)
+            offset = idx*chunk_size
+            yield chunk.data[max(start-offset, 0):stop-offset]
+
     def verify_state(self, gov, entry, default_attributes):
         content_type = default_attributes.get('content_type',None)
         if content_type != self.content_type:
             self.content_type = content_type
+            self.source_gz = gzip_compress(self.source, self.content_type or 'application/octet-stream')
             self.put()
             gov.handle_resource_changes(updated = [self])
         if entry.revision != self.revision:
@@ -356,9 +950,71 @@ class RawResource(Resource):
     def fetch(self, gov, new_revision):
         self.fetch_from_dropbox(gov, new_revision)
         self.put()
+        # Requests that loaded the previous revision may still be reading its chunks
+        gov.cdefer(delete_stale_chunks_by_key, str(self.key()), self.revision,
+                   _countdown=config.CONTENT_CHUNK_GRACE, _priority='bulk')
         gov.handle_resource_changes(updated=[self])
 
     def fetch_from_dropbox(self, gov, new_revision):
+        """
+        Reads the file one chunk at a time. Only if there is more than one chunk
+        are they written to ContentChunk entities as they arrive.
+        """
         entry = self.parent()
-        self.source=entry.download_content(gov)
+        chunk_size = config.CONTENT_CHUNK_SIZE
+        first = None
+        size = 0
+        chunk_count = 0
+        for block in entry.iter_content(gov, chunk_size):
+            if first is None:
+                first = block
+            else:
+                if chunk_count == 0:
+                    ContentChunk(key=ContentChunk.key_for(self, new_revision, 0), data=first).put()
+                    chunk_count = 1
+                ContentChunk(key=ContentChunk.key_for(self, new_revision, chunk_count), data=block).put()
+                chunk_count += 1
+            size += len(block)
+        logging.debug('Downloaded %d bytes in %d chunks for %s'%(size, chunk_count, self))
+        if chunk_count:
+            self.source = None
+            self.source_gz = None
+        else:
+            self.source = first or ''
+            self.source_gz=gzip_compress(self.source, self.content_type or 'application/octet-stream')
+        self.size = size
+        self.chunk_count = chunk_count
         self.revision=new_revision
+        self.modified=entry.modified
+
+    def delete_stale_chunks(self, before=None):
+        """
+        Delete chunks not belonging to the current revision.
+        If before is given, chunks of that and later revisions are kept.
+        """
+        prefix = 'r%d-'%(self.revision or 0)
+        stale = []
+        for k in ContentChunk.all(keys_only=True).ancestor(self):
+            if self.chunk_count and k.name().startswith(prefix):
+                continue
+            if before is not None and int(k.name()[1:].split('-')[0]) >= before:
+                continue
+            stale.append(k)
+        if stale:
+            logging.debug('Deleting %d stale chunks of %s'%(len(stale), self))
+            db.delete(stale)
+
+def delete_stale_chunks_by_key(gov, resource_key, revision):
+    """
+    Task deleting the chunks replaced by revision of a RawResource.
+    It runs config.CONTENT_CHUNK_GRACE seconds after the fetch, so
+    requests serving the previous revision can finish reading it.
+    """
+    resource = db.get(resource_key)
+    if resource:
+        resource.delete_stale_chunks(before=revision)
+        return
+    stale = ContentChunk.all(keys_only=True).ancestor(db.Key(resource_key)).fetch(1000)
+    if stale:
+        logging.debug('Deleting %d chunks of removed resource %s'%(len(stale), resource_key))
+        db.delete(stale)
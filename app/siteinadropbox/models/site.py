@@ -15,6 +15,9 @@ from google.appengine.api import users
 from google.appengine.api import namespace_manager  
 
 import config
+from siteinadropbox import cache
+from siteinadropbox.localclient import LocalFolderClient
+from .guard import GuardedClient
 
 class InvalidSiteError(Exception):
     pass
@@ -38,6 +41,18 @@ class Site(db.Model):
     dropbox_email = db.EmailProperty()
     owner = db.UserProperty(required=True)
     owner_id = db.StringProperty(required=True)
+    # Serve the site from this local directory instead of from Dropbox
+    local_root = db.StringProperty()
+    local_trust_dir_mtime = db.BooleanProperty(default=True)
+
+    def put(self, **kwargs):
+        """
+        Cached controllers hold a dropbox client and config derived from the
+        site, so they are invalidated on every put
+        """
+        key = db.Model.put(self, **kwargs)
+        cache.controller_generation.bump()
+        return key
 
     @classmethod
     def get_current_site(cls):
@@ -61,16 +76,26 @@ class Site(db.Model):
         return cls.get_or_insert(key_name=cls.the_key_name,
                                  owner=user,
                                  owner_id=user.user_id(),
-                                 dropbox_base_dir=default_base_dir)
+                                 dropbox_base_dir=default_base_dir,
+                                 local_root=cls.dropbox_config.get('local_root') or None,
+                                 local_trust_dir_mtime=cls.dropbox_config.get(
+                                     'trust_dir_mtime', 'true').lower() in ['1', 'yes', 'true', 'on'])
     
     def get_dropbox_client(self):
+        """
+        Returns a client for Dropbox, or with local_root set, for a local directory
+        """
+        if self.local_root:
+            if config.DROPBOX_SYNC_MODE == 'delta':
+                logging.warning('Local folders have no delta feed: syncs will walk the tree')
+            return LocalFolderClient(self.local_root, trust_dir_mtime=self.local_trust_dir_mtime)
         if not self.dropbox_access_token:
             return None
-        return dropbox.client.DropboxClient(
+        return GuardedClient(dropbox.client.DropboxClient(
             Site.dropbox_config['server'],
             Site.dropbox_config['content_server'],
             80, Site.dropbox_auth, 
-            oauth.OAuthToken.from_string(self.dropbox_access_token))
+            oauth.OAuthToken.from_string(self.dropbox_access_token)))
 
     def get_config_path(self):
         return os.path.join(self.dropbox_base_dir, self.dropbox_site_yaml)
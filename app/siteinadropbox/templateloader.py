@@ -3,28 +3,110 @@ import logging
 
 from  django.template import loader
 from google.appengine.ext import db
+from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
 
 import config
-from siteinadropbox.models.resources import TextResource
+from siteinadropbox import cache
+from siteinadropbox.models.resources import TextResource, PageResource
 
 def get_resource_by_entry_path(p):
-    return TextResource.all().ancestor(db.Key.from_path('DirEntry',p.lower())).get()
+    """
+    Templates are stored as TextResources (or PageResources) keyed by url
+    below the DirEntry for p. Both candidate keys are tried in a single batch get.
+    """
+    p = p.lower()
+    entry_key = db.Key.from_path('DirEntry', p)
+    urls = [TextResource.compute_url_from_entry_path(p)]
+    page_url = PageResource.compute_url_from_entry_path(p)
+    if page_url not in urls:
+        urls.append(page_url)
+    for r in db.get([db.Key.from_path('Resource', u, parent=entry_key) for u in urls]):
+        if r and isinstance(r, TextResource):
+            return r
+
+# Compiled templates by (namespace, template generation, entry path, revision).
+# One instance serves several sites, which may have templates at the same path
+# and revision. Django compiles constant include and extends tags into the
+# parent, so a parent is only valid for the generation it was compiled in.
+_compiled_templates = cache.LRUCache(config.TEMPLATE_CACHE_SIZE)
+
+def _source_key(filepath):
+    return '_template_source:%s:%s'%(cache.template_generation.get(), filepath.lower())
+
+# Used instead of the datastore when rendering outside a request, see export.py
+_static_sources = None
+
+def set_static_sources(sources):
+    """
+    Serve templates from a dict of lower case path -> (revision, source).
+    Pass None to go back to the datastore.
+    """
+    global _static_sources
+    _static_sources = sources
+
+def get_template_source(filepath):
+    """
+    Returns (revision, source) for the template at filepath, or None.
+    Kept in memcache (also for missing templates) until flush_template_source
+    is called or cache.template_generation is bumped.
+    """
+    if _static_sources is not None:
+        return _static_sources.get(filepath.lower())
+    val = memcache.get(_source_key(filepath))
+    if val is None:
+        template=get_resource_by_entry_path(filepath)
+        if template:
+            val = (template.revision, template.source or '&nbsp;')
+        else:
+            val = ()
+        memcache.set(_source_key(filepath), val)
+    return val or None
+
+def flush_template_source(filepath):
+    """
+    Should be called whenever the template resource at filepath is fetched
+    """
+    memcache.delete(_source_key(filepath))
 
 class TemplateLoader(loader.BaseLoader):
     """
     A template loader class for djanog 1.2
     To use, include the full name of this class as string in TEMPLATE_LOADERS
+
+    Compiled templates are cached in instance memory, keyed by namespace,
+    template generation and revision.
     """
     is_usable = True
 
+    def load_template(self, template_name, template_dirs=None):
+        filepath=os.path.join(config.TEMPLATE_DIR,template_name)
+        val = get_template_source(filepath)
+        if not val:
+            logging.debug('Failed to find template %s'%filepath)
+            raise  loader.TemplateDoesNotExist('The template %s does not exist'%filepath)
+        revision, source = val
+        key = (namespace_manager.get_namespace(), cache.template_generation.get(), filepath, revision)
+        template = _compiled_templates.get(key)
+        if template is None:
+            logging.debug('siteinadropbox.templateloader: compiling template %s rev. %s'%(template_name, revision))
+            origin = loader.make_origin(filepath, self.load_template_source, template_name, template_dirs)
+            try:
+                template = loader.get_template_from_string(source, origin, template_name)
+            except loader.TemplateDoesNotExist:
+                # Same fallback as django.template.loader.BaseLoader
+                return source, filepath
+            _compiled_templates.set(key, template)
+        return template, None
+
     def load_template_source(self, template_name, template_dirs=None):
         filepath=os.path.join(config.TEMPLATE_DIR,template_name)
-        template=get_resource_by_entry_path(filepath)
-        if not template:
+        val = get_template_source(filepath)
+        if not val:
             logging.debug('Failed to find template %s'%filepath)
             raise  loader.TemplateDoesNotExist('The template %s does not exist'%filepath)
         logging.debug('siteinadropbox.templateloader: found template %s'%template_name)
-        return (template.source or '&nbsp;', filepath)
+        return (val[1], filepath)
     load_template_source.is_usable = True
 #_loader = Loader()
 
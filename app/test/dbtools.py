@@ -11,6 +11,9 @@ import subprocess
 import zipfile
 import functools
 import traceback
+import time
+import zlib
+import base64
 
 import dropbox.auth
 import dropbox.client
@@ -18,6 +21,9 @@ from oauth import oauth
 import dropbox.auth
 import config
 import types
+from siteinadropbox import controller
+from siteinadropbox import models
+from siteinadropbox.handlers import cdeferred
 
 
 default_token_file_name = '/Users/janus/Desktop/dbtoken.txt'
@@ -95,15 +101,26 @@ class DBTool(object):
 class FakeConnection(object):
     def __init__(self, content, status=200):
         self._content=content
+        self._pos=0
         self.status=status
-    def read(self):
-        return self._content
+        self.reason=(status == 200 and 'OK') or 'Not Found'
+    def read(self, n=None):
+        if n is None:
+            n = len(self._content)-self._pos
+        block = self._content[self._pos:self._pos+n]
+        self._pos += len(block)
+        return block
     def close(self):
         pass
     
 class FakeClient(object):
+    """
+    Replays a state zip. A latency (in seconds) can be injected
+    into metadata requests.
+    """
 
-    def __init__(self, response_dict_pickle=None, content_dict = None, state_zip = None):
+    def __init__(self, response_dict_pickle=None, content_dict = None, state_zip = None, latency = 0):
+        self.latency = latency
         if state_zip:
             zf = zipfile.ZipFile(state_zip)
             response_dict_pickle=zf.read('_response_pickle.txt')
@@ -115,7 +132,8 @@ class FakeClient(object):
         self.content_dict = content_dict
 
     def metadata(self, dummy, path, hash = None):
-        
+        if self.latency:
+            time.sleep(self.latency)
         if len(path)>1 and path.endswith('/'):
             path=path[0:-1]
         path = path.lower()
@@ -135,6 +153,32 @@ class FakeClient(object):
             resp = FakeResponse(status = 404, reason = 'Not Found', data = {'error': 'Path %s not found'%path})
         return resp
 
+    def delta(self, cursor=None):
+        """
+        A delta feed for the state zip. The cursor holds the revisions
+        of all entries, so it can be passed on to a client for the next state zip.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        state = dict((path, (r.data['is_dir'], r.data['revision'])) for path, r in self.rd.items())
+        entries = []
+        if cursor is None:
+            old_state = {}
+        else:
+            old_state = pickle.loads(zlib.decompress(base64.urlsafe_b64decode(cursor)))
+        for path in sorted(state.keys()):
+            if old_state.get(path) != state[path]:
+                metadata = dict(self.rd[path].data)
+                metadata.pop('contents', None)
+                metadata.pop('hash', None)
+                entries.append([path, metadata])
+        entries.extend([[path, None] for path in sorted(old_state.keys()) if path not in state])
+        data = {'entries': entries,
+                'reset': cursor is None,
+                'cursor': base64.urlsafe_b64encode(zlib.compress(pickle.dumps(state))),
+                'has_more': False}
+        return FakeResponse(status=200, reason='OK', data=data, body='')
+
     def get_file(self, dummy, path):
         path=path.lower()
         if path in self.content_dict:
@@ -163,6 +207,39 @@ class FakeSite(object):
     def get_dropbox_client(self):
         return self._db_client
         
+class ImmediateController(controller.BaseController):
+    """
+    Updates the resources of changed entries, and runs deferred calls
+    right away -- or, with collect_tasks set, collects them for run_tasks.
+    The queue each call was deferred to is recorded in deferred.
+    """
+    collect_tasks = False
+
+    def __init__(self, site):
+        self.tasks = []
+        self.deferred = []
+        controller.BaseController.__init__(self, site)
+
+    def handle_metadata_changes(self, created=[], updated=[], removed=[]):
+        for entry in created+updated:
+            models.Resource.update(self, entry)
+
+    def cdefer(self, obj, *args, **kwargs):
+        taskargs, queue, transactional = cdeferred.pop_task_options(kwargs)
+        self.deferred.append((obj, queue))
+        if self.collect_tasks:
+            self.tasks.append((obj, args, kwargs))
+        else:
+            obj(self, *args, **kwargs)
+
+    def run_tasks(self):
+        n = 0
+        while self.tasks:
+            obj, args, kwargs = self.tasks.pop(0)
+            obj(self, *args, **kwargs)
+            n += 1
+        return n
+
 def make_fake_controller(db_client = None, base_dir='/dropsite', site_yaml='site.yaml'):
     """
     Will insert a real-looking 'Site' entry, so get_current_site_controller works
@@ -180,6 +257,25 @@ def make_fake_controller(db_client = None, base_dir='/dropsite', site_yaml='site
     gov.db_client = db_client
     return gov
 
+def make_notification(secret, paths=None):
+    """
+    Returns (body, headers) of a signed change notification, see siteinadropbox.handlers.notify
+    """
+    import simplejson as json
+    from siteinadropbox.handlers import notify
+    body = json.dumps((paths is not None and {'paths': paths}) or {'delta': {'users': [0]}})
+    return body, {'Content-Type': 'application/json',
+                  notify.SIGNATURE_HEADER: notify.sign(secret, body)}
+
+def post_notification(url, secret, paths=None):
+    """
+    Stand-in for Dropbox: POST a change notification to url,
+    e.g. http://localhost:8080/_notify/dropbox on the development server
+    """
+    import urllib2
+    body, headers = make_notification(secret, paths)
+    return urllib2.urlopen(urllib2.Request(url, body, headers)).read()
+
 def getClipboardData():
   p = subprocess.Popen(['pbpaste'], stdout=subprocess.PIPE)
   retcode = p.wait()
@@ -211,3 +307,40 @@ def highlight(f):
     return new_f
 
         
+def count_calls(func, *args, **kwargs):
+    """
+    Call func, returning the number of datastore calls it made
+    """
+    return _count_datastore_calls(None, func, args, kwargs)
+
+def count_queries(func, *args, **kwargs):
+    """
+    Call func, returning the number of datastore queries it ran
+    """
+    return _count_datastore_calls('RunQuery', func, args, kwargs)
+
+def count_puts(func, *args, **kwargs):
+    """
+    Call func, returning the number of datastore puts it made
+    """
+    return _count_datastore_calls('Put', func, args, kwargs)
+
+def count_deletes(func, *args, **kwargs):
+    """
+    Call func, returning the number of datastore deletes it made
+    """
+    return _count_datastore_calls('Delete', func, args, kwargs)
+
+def _count_datastore_calls(name, func, args, kwargs):
+    from google.appengine.api import apiproxy_stub_map
+    calls = []
+    def hook(service, call, request, response):
+        if name is None or call == name:
+            calls.append(call)
+    hooks = apiproxy_stub_map.apiproxy.GetPreCallHooks()
+    hooks.Append('count_datastore_calls', hook, 'datastore_v3')
+    try:
+        func(*args, **kwargs)
+    finally:
+        hooks.Clear()
+    return len(calls)
@@ -18,10 +18,10 @@ B-cases test dir <> file transitions
    b1.txt
 """
 
-def make_fake_client(name):
+def make_fake_client(name, **kwargs):
     filename = os.path.abspath(os.path.join(os.path.split(__file__)[0], name+'.zip'))
-    return dbtools.FakeClient(state_zip=filename)
+    return dbtools.FakeClient(state_zip=filename, **kwargs)
         
-def make_fake_site(name):
-    return dbtools.FakeSite(make_fake_client(name), base_dir='/Dropsite')
+def make_fake_site(name, **kwargs):
+    return dbtools.FakeSite(make_fake_client(name, **kwargs), base_dir='/Dropsite')
 
@@ -0,0 +1,58 @@
+import unittest
+
+from google.appengine.api import namespace_manager
+from google.appengine.ext import testbed
+
+from siteinadropbox import controller
+from siteinadropbox import models
+from test import dbtools
+from test.dbtools import highlight, count_calls
+
+class ControllerCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+        self.testbed.init_user_stub()
+        controller._controllers.clear()
+        dbtools.make_fake_controller()
+
+    def tearDown(self):
+        controller._controllers.clear()
+        self.testbed.deactivate()
+
+    @highlight
+    def test_reused(self):
+        gov = controller.get_current_site_controller()
+        self.assertTrue(controller.get_current_site_controller() is gov)
+        # Without looking up the site
+        self.assertEqual(count_calls(controller.get_current_site_controller), 0)
+        # Other sites have their own
+        namespace = namespace_manager.get_namespace()
+        namespace_manager.set_namespace('othersite')
+        try:
+            self.assertRaises(models.InvalidSiteError, controller.get_current_site_controller)
+        finally:
+            namespace_manager.set_namespace(namespace)
+        self.assertTrue(controller.get_current_site_controller() is gov)
+
+    @highlight
+    def test_site_put(self):
+        gov = controller.get_current_site_controller()
+        site = models.Site.get_current_site()
+        site.dropbox_display_name = 'Renamed'
+        site.put()
+        new_gov = controller.get_current_site_controller()
+        self.assertFalse(new_gov is gov)
+        self.assertEqual(new_gov.site.dropbox_display_name, 'Renamed')
+        self.assertTrue(controller.get_current_site_controller() is new_gov)
+
+    @highlight
+    def test_config_change(self):
+        gov = controller.get_current_site_controller()
+        gov.handle_config_changes()
+        new_gov = controller.get_current_site_controller()
+        self.assertFalse(new_gov is gov)
+        self.assertTrue(controller.get_current_site_controller() is new_gov)
@@ -0,0 +1,135 @@
+import unittest
+import httplib
+import simplejson as json
+
+from dropbox import rest
+from test.dbtools import highlight
+
+class FakeHTTPResponse(object):
+    def __init__(self, body, will_close=False):
+        self.status = 200
+        self.reason = 'OK'
+        self.will_close = will_close
+        self._body = body
+
+    def read(self, n=None):
+        if n is None:
+            n = len(self._body)
+        data, self._body = self._body[:n], self._body[n:]
+        return data
+
+    def isclosed(self):
+        return not self._body
+
+    def getheaders(self):
+        return []
+
+    def close(self):
+        pass
+
+class FakeHTTPConnection(object):
+    opened = []
+
+    def __init__(self, host, port):
+        self.sock = object()
+        self.closed = False
+        self.requests = 0
+        self.fail_next = False
+        FakeHTTPConnection.opened.append(self)
+
+    def request(self, method, url, body=None, headers={}):
+        if self.fail_next:
+            raise httplib.BadStatusLine('')
+        self.requests += 1
+
+    def getresponse(self):
+        return FakeHTTPResponse('{"n": %d}'%self.requests, will_close=(self.requests >= 3))
+
+    def close(self):
+        self.closed = True
+        self.sock = None
+
+class FakePool(rest.ConnectionPool):
+    connection_class = FakeHTTPConnection
+
+    def is_healthy(self, conn):
+        return conn.sock is not None
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        FakeHTTPConnection.opened = []
+        self.pool = FakePool()
+        self.client = rest.RESTClient('example.com', 80, connection_pool=self.pool)
+
+    @highlight
+    def test_keep_alive(self):
+        self.assertEqual(self.client.GET('/a').data['n'], 1)
+        self.assertEqual(self.client.GET('/b').data['n'], 2)
+        # The server closes after the third request
+        self.assertEqual(self.client.GET('/c').data['n'], 3)
+        self.assertEqual(self.client.GET('/d').data['n'], 1)
+        self.assertEqual(len(FakeHTTPConnection.opened), 2)
+        self.assertTrue(FakeHTTPConnection.opened[0].closed)
+
+    @highlight
+    def test_idle_timeout(self):
+        self.pool.idle_timeout = 0
+        self.client.GET('/a')
+        self.client.GET('/b')
+        self.assertEqual(len(FakeHTTPConnection.opened), 2)
+
+    @highlight
+    def test_retry_stale(self):
+        self.client.GET('/a')
+        FakeHTTPConnection.opened[0].fail_next = True
+        self.assertEqual(self.client.GET('/b').data['n'], 1)
+        self.assertEqual(len(FakeHTTPConnection.opened), 2)
+        self.client.GET('/c')
+        FakeHTTPConnection.opened[1].fail_next = True
+        self.assertRaises(httplib.BadStatusLine, self.client.POST, '/d', {'a': 1})
+
+    @highlight
+    def test_raw_response(self):
+        resp = self.client.request('GET', '/a', raw_response=True)
+        resp.read(2)
+        resp.close()
+        # Partly read: the connection can not be reused
+        self.assertTrue(FakeHTTPConnection.opened[0].closed)
+        resp = self.client.request('GET', '/b', raw_response=True)
+        self.assertEqual(resp.status, 200)
+        resp.read()
+        resp.close()
+        self.client.GET('/c')
+        self.assertEqual(len(FakeHTTPConnection.opened), 2)
+
+class JSONStreamTest(unittest.TestCase):
+    def stream(self, doc, status=200):
+        http_resp = FakeHTTPResponse(doc)
+        http_resp.status = status
+        return rest.JSONStreamResponse(http_resp, 'contents')
+
+    @highlight
+    def test_stream(self):
+        chunk_size = rest.JSONStreamResponse.chunk_size
+        # Small chunks, so values are split across them
+        rest.JSONStreamResponse.chunk_size = 5
+        try:
+            contents = [{'path': '/a/%d'%i, 'is_dir': False, 'revision': 12345+i} for i in range(20)]
+            resp = self.stream('{"hash": "abc", "bytes": 1234567,\n "contents": %s, "is_dir": true}'%
+                               json.dumps(contents))
+            self.assertEqual(resp.data, {'hash': 'abc', 'bytes': 1234567})
+            self.assertEqual(list(resp.iter_array()), contents)
+            self.assertEqual(resp.data['is_dir'], True)
+
+            resp = self.stream('{"is_dir": false, "revision": 10}')
+            self.assertEqual(resp.data, {'is_dir': False, 'revision': 10})
+            self.assertEqual(list(resp.iter_array()), [])
+        finally:
+            rest.JSONStreamResponse.chunk_size = chunk_size
+
+    @highlight
+    def test_errors(self):
+        resp = self.stream('{"error": "Not found"}', status=404)
+        self.assertEqual(resp.data, {'error': 'Not found'})
+        resp = self.stream('{"contents": [{"a": 1} {"b": 2}]}')
+        self.assertRaises(ValueError, list, resp.iter_array())
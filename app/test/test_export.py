@@ -0,0 +1,75 @@
+import unittest
+import os.path
+import shutil
+import tempfile
+import tarfile
+from cStringIO import StringIO
+
+from google.appengine.ext import testbed
+
+from siteinadropbox import export
+from siteinadropbox import models
+from test import pickledsites
+from test.dbtools import highlight
+
+class ExportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.target = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+        shutil.rmtree(self.target)
+
+    def export(self, name, writer=None):
+        site = pickledsites.make_fake_site(name)
+        return export.export_from_client(site, writer or export.DirectoryWriter(self.target), processes=1)
+
+    @highlight
+    def test_directory_export(self):
+        stats = self.export('Dropsite_2011-07-19T145942')
+        print stats
+        self.assertTrue(os.path.exists(os.path.join(self.target, 'b', 'index.html')))
+        self.assertTrue(os.path.exists(os.path.join(self.target, export.MANIFEST_NAME)))
+        f = open(os.path.join(self.target, 'b', 'index.html'))
+        self.assertTrue('Wonder' in f.read())
+        f.close()
+
+    @highlight
+    def test_incremental_export(self):
+        first = self.export('Dropsite_2011-07-19T145942')
+        second = self.export('Dropsite_2011-07-19T145942')
+        print first, second
+        self.assertTrue(first['written'] > 0)
+        self.assertEqual(second['written'], 0)
+        self.assertEqual(second['skipped'], first['written'])
+
+    @highlight
+    def test_tar_export(self):
+        buf = StringIO()
+        self.export('Dropsite_2011-07-19T145942', export.TarWriter(buf))
+        names = tarfile.open(fileobj=StringIO(buf.getvalue())).getnames()
+        print names
+        self.assertTrue('b/index.html' in names)
+
+    @highlight
+    def test_config_changes(self):
+        gov = export.ExportController(pickledsites.make_fake_site('C1'))
+        verified = []
+        gov.do_verify_database_consistency = lambda: verified.append(True)
+        models.perform_sync(gov, models.DirEntry.get_root_entry())
+        # The config is loaded without verifying the database
+        self.assertEqual(gov.site_constants.get('title'), 'Site in a Dropbox')
+        self.assertEqual(verified, [])
+        # ... and the entries synced before it are updated again
+        self.assertTrue(len(gov.updated_keys) > 1)
+        self.assertNotEqual(models.Resource.get_resource_by_url('/'), None)
+
+    def test_url_to_path(self):
+        self.assertEqual(export.url_to_path('/', True), 'index.html')
+        self.assertEqual(export.url_to_path('/b/', True), 'b/index.html')
+        self.assertEqual(export.url_to_path('/hello', True), 'hello.html')
+        self.assertEqual(export.url_to_path('/favicon.ico', False), 'favicon.ico')
@@ -0,0 +1,95 @@
+import unittest
+
+from google.appengine.ext import webapp
+from google.appengine.ext import testbed
+
+import config
+from siteinadropbox import models
+from siteinadropbox.models import metadata
+from siteinadropbox.handlers.notify import NotificationHandler
+from test import pickledsites
+from test.dbtools import highlight, make_notification
+from test.test_models_metadata import TaskController
+
+SECRET = 'notifysecret'
+
+class NotificationTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.secret = config.NOTIFY_SECRET
+        config.NOTIFY_SECRET = SECRET
+
+        self.root = models.DirEntry.get_root_entry()
+        self.lsr = models.ListingVisitor()
+        self.gov = TaskController(pickledsites.make_fake_site('A0'))
+        models.perform_sync(self.gov, self.root)
+        self.listing = self.lsr.make_listing(self.root)
+        self.gov = TaskController(pickledsites.make_fake_site('A1'))
+        NotificationHandler.set_controller_factory(lambda: self.gov)
+
+    def tearDown(self):
+        config.NOTIFY_SECRET = self.secret
+        self.testbed.deactivate()
+
+    def request(self, method, url=config.NOTIFY_URL, body=None, headers={}):
+        request = webapp.Request.blank(url)
+        request.method = method
+        if body is not None:
+            request.body = body
+        for k, v in headers.items():
+            request.headers[k] = v
+        response = webapp.Response()
+        handler = NotificationHandler()
+        handler.initialize(request, response)
+        getattr(handler, method.lower())()
+        return response
+
+    def notify(self, paths=None, secret=SECRET):
+        body, headers = make_notification(secret, paths)
+        return self.request('POST', body=body, headers=headers)
+
+    @highlight
+    def test_challenge(self):
+        response = self.request('GET', url=config.NOTIFY_URL+'?challenge=abc123')
+        self.assertEqual(response.out.getvalue(), 'abc123')
+
+    @highlight
+    def test_bad_signature(self):
+        response = self.notify(['/Dropsite/b/b1.txt'], secret='wrong')
+        self.assertEqual(response.status, 403)
+        self.assertEqual(self.gov.tasks, [])
+
+    @highlight
+    def test_targeted_sync(self):
+        # A burst of changes in /b gives one sync
+        self.notify(['/Dropsite/b/b1.txt'])
+        self.notify(['/dropsite/b/b1.txt', '/Elsewhere/x.txt'])
+        self.assertEqual(len(self.gov.tasks), 1)
+        self.gov.run_tasks()
+        run = models.SyncRun.get_latest()
+        self.assertEqual(run.root_path, '/b')
+        self.assertFalse(run.full)
+        listing = self.lsr.make_listing(self.root)
+        self.assertNotEqual(listing, self.listing)
+        # The sync found the change
+        models.perform_sync(self.gov, self.root)
+        self.assertEqual(self.lsr.make_listing(self.root), listing)
+
+    @highlight
+    def test_unknown_dir(self):
+        # Changes in dirs not seen yet are synced from the nearest known dir
+        metadata.sync_notified(self.gov, '/b/new/deeper')
+        self.gov.run_tasks()
+        self.assertEqual(models.SyncRun.get_latest().root_path, '/b')
+
+    @highlight
+    def test_whole_site(self):
+        self.notify()
+        self.assertEqual(len(self.gov.tasks), 1)
+        self.gov.run_tasks()
+        run = models.SyncRun.get_latest()
+        self.assertEqual(run.root_path, '/')
+        self.assertTrue(run.full)
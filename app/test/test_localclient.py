@@ -0,0 +1,169 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from google.appengine.api import namespace_manager
+from google.appengine.api import users
+from google.appengine.ext import testbed
+
+import config
+from siteinadropbox import models
+from siteinadropbox.localclient import LocalFolderClient
+from test.dbtools import highlight, FakeSite
+from test.test_models_metadata import LoggingController
+
+class CountingClient(object):
+    """
+    Records the status of metadata responses
+    """
+    def __init__(self, client):
+        self.client = client
+        self.statuses = []
+
+    def metadata(self, *args, **kwargs):
+        response = self.client.metadata(*args, **kwargs)
+        self.statuses.append(response.status)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+class LocalClientTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_user_stub()
+
+        self.local_root = tempfile.mkdtemp()
+        self.write('Dropsite/a.txt', 'Some text')
+        self.write('Dropsite/B/b1.txt', 'x'*10000)
+        self.root = models.DirEntry.get_root_entry()
+
+    def tearDown(self):
+        shutil.rmtree(self.local_root)
+        self.testbed.deactivate()
+
+    def write(self, path, content, mode='wb'):
+        filename = os.path.join(self.local_root, path)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        f = open(filename, mode)
+        f.write(content)
+        f.close()
+
+    def sync(self, client):
+        counting = CountingClient(client)
+        gov = LoggingController(FakeSite(counting, base_dir='/Dropsite'))
+        models.perform_sync(gov, self.root, window=1)
+        return gov, counting.statuses
+
+    @highlight
+    def test_sync(self):
+        gov, statuses = self.sync(LocalFolderClient(self.local_root))
+        print models.ListingVisitor().make_listing(self.root)
+        self.assertEqual(statuses, [200, 200])
+        # Members are listed by lowercased name
+        contents = LocalFolderClient(self.local_root).metadata('dropbox', '/Dropsite').data['contents']
+        self.assertEqual([c['path'] for c in contents], ['/Dropsite/a.txt', '/Dropsite/B'])
+        entry = models.DirEntry.get_by_key_name('/b/b1.txt')
+        self.assertEqual(entry.bytes, 10000)
+        self.assertEqual(entry.download_content(gov), 'x'*10000)
+        self.assertEqual([len(b) for b in entry.iter_content(gov, 4096)], [4096, 4096, 1808])
+
+        # Nothing changed
+        gov, statuses = self.sync(LocalFolderClient(self.local_root))
+        self.assertEqual(statuses, [304, 304])
+
+    @highlight
+    def test_changes(self):
+        # Files modified in place are only found when members are stat'ed
+        client = LocalFolderClient(self.local_root, trust_dir_mtime=False)
+        self.sync(client)
+        rev = models.DirEntry.get_by_key_name('/b/b1.txt').revision
+        self.write('Dropsite/B/b1.txt', 'y', mode='r+b')
+        os.remove(os.path.join(self.local_root, 'Dropsite/a.txt'))
+        gov, statuses = self.sync(client)
+        self.assertEqual(statuses, [200, 200])
+        self.assertEqual(models.DirEntry.get_by_key_name('/a.txt'), None)
+        self.assertNotEqual(models.DirEntry.get_by_key_name('/b/b1.txt').revision, rev)
+
+    @highlight
+    def test_trust_dir_mtime(self):
+        client = LocalFolderClient(self.local_root)
+        self.sync(client)
+        # Only the changed dir is listed
+        self.write('Dropsite/B/b2.txt', 'New')
+        gov, statuses = self.sync(client)
+        self.assertEqual(statuses, [304, 200])
+        self.assertTrue(models.DirEntry.get_by_key_name('/b/b2.txt'))
+        # Files modified in place are missed
+        self.write('Dropsite/B/b2.txt', 'Old', mode='r+b')
+        gov, statuses = self.sync(client)
+        self.assertEqual(statuses, [304, 304])
+
+    @highlight
+    def test_missing(self):
+        client = LocalFolderClient(self.local_root)
+        self.assertEqual(client.metadata('sandbox', '/dropsite/nothing').status, 404)
+        self.assertEqual(client.get_file('sandbox', '/dropsite/b').status, 404)
+        self.assertEqual(client.get_file('sandbox', '/DROPSITE/b/B1.TXT').read(3), 'xxx')
+
+    @highlight
+    def test_outside_root(self):
+        self.write('Secret.txt', 'Not served')
+        client = LocalFolderClient(os.path.join(self.local_root, 'Dropsite'))
+        self.assertEqual(client.get_file('sandbox', '/../secret.txt').status, 404)
+        self.assertEqual(client.metadata('sandbox', '/b/../..').status, 404)
+        self.assertEqual(client.metadata('sandbox', '/b').status, 200)
+
+    @highlight
+    def test_links(self):
+        self.write('Secret.txt', 'Not served')
+        os.symlink(os.path.join(self.local_root, 'Secret.txt'),
+                   os.path.join(self.local_root, 'Dropsite', 'secret.txt'))
+        os.symlink(self.local_root, os.path.join(self.local_root, 'Dropsite', 'up'))
+        os.symlink(os.path.join(self.local_root, 'Dropsite', 'a.txt'),
+                   os.path.join(self.local_root, 'Dropsite', 'B', 'a.txt'))
+        # The root may be reached through a link
+        os.symlink(os.path.join(self.local_root, 'Dropsite'), os.path.join(self.local_root, 'Linked'))
+        client = LocalFolderClient(os.path.join(self.local_root, 'Linked'))
+        self.assertEqual(client.get_file('sandbox', '/secret.txt').status, 404)
+        self.assertEqual(client.get_file('sandbox', '/up/secret.txt').status, 404)
+        self.assertEqual(client.metadata('sandbox', '/up').status, 404)
+        # Links out of the root are not listed, links within it are
+        paths = [m['path'] for m in client.metadata('sandbox', '/').data['contents']]
+        self.assertEqual(paths, ['/B', '/a.txt'])
+        self.assertEqual(client.get_file('sandbox', '/secret.txt').status, 404)
+        self.assertEqual(client.get_file('sandbox', '/b/a.txt').read(), 'Some text')
+
+    @highlight
+    def test_delta_mode(self):
+        # Local folders have no delta feed, so syncs walk
+        mode = config.DROPBOX_SYNC_MODE
+        config.DROPBOX_SYNC_MODE = 'delta'
+        try:
+            gov, statuses = self.sync(LocalFolderClient(self.local_root))
+            self.assertFalse(models.use_delta_sync(gov))
+            models.perform_sync_by_key(gov, self.root.key())
+        finally:
+            config.DROPBOX_SYNC_MODE = mode
+        self.assertTrue(models.DirEntry.get_by_key_name('/b/b1.txt'))
+
+    @highlight
+    def test_site_local_root(self):
+        # Each site is served from its own local root
+        namespace = namespace_manager.get_namespace()
+        roots = {}
+        try:
+            for ns, root in [('site1', self.local_root), ('site2', os.path.join(self.local_root, 'Dropsite'))]:
+                namespace_manager.set_namespace(ns)
+                models.Site(key_name=models.Site.the_key_name, owner=users.User('fake@halwe.dk'),
+                            owner_id='abekat', dropbox_base_dir='/dropsite', local_root=root).put()
+                roots[ns] = models.Site.get_current_site().get_dropbox_client().local_root
+        finally:
+            namespace_manager.set_namespace(namespace)
+        self.assertEqual(roots, {'site1': os.path.realpath(self.local_root),
+                                 'site2': os.path.realpath(os.path.join(self.local_root, 'Dropsite'))})
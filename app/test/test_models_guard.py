@@ -0,0 +1,122 @@
+import unittest
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+import config
+from siteinadropbox import models
+from siteinadropbox.models import guard
+from test import pickledsites
+from test.dbtools import highlight, FakeSite, FakeResponse
+from test.test_models_metadata import LoggingController
+
+class FlakyClient(object):
+    """
+    Wraps a client, answering 503 to metadata requests while failing is set
+    """
+    def __init__(self, client):
+        self.client = client
+        self.failing = False
+        self.calls = 0
+
+    def metadata(self, *args, **kwargs):
+        self.calls += 1
+        if self.failing:
+            return FakeResponse(status=503, reason='Service Unavailable', data=None, body='')
+        return self.client.metadata(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+class GuardTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.threshold = config.BREAKER_THRESHOLD
+        config.BREAKER_THRESHOLD = 3
+
+        self.flaky = FlakyClient(pickledsites.make_fake_client('A0'))
+        self.client = guard.GuardedClient(self.flaky)
+        self.gov = LoggingController(FakeSite(self.client, base_dir='/Dropsite'))
+        self.root = models.DirEntry.get_root_entry()
+
+    def tearDown(self):
+        config.BREAKER_THRESHOLD = self.threshold
+        self.testbed.deactivate()
+
+    def metadata(self):
+        return self.client.metadata('sandbox', '/dropsite')
+
+    def expire(self):
+        """
+        Move the end of the open period of the breaker to the past
+        """
+        state = memcache.get(guard.breaker._state_key, namespace=guard.GUARD_NAMESPACE)
+        state['retry_at'] = time.time()-1
+        memcache.set(guard.breaker._state_key, state, namespace=guard.GUARD_NAMESPACE)
+
+    @highlight
+    def test_sync_through_guard(self):
+        models.perform_sync(self.gov, self.root)
+        self.assertTrue(models.DirEntry.get_by_key_name('/b/b1.txt'))
+        self.assertEqual(guard.get_guard_status()['breaker']['state'], 'closed')
+
+    @highlight
+    def test_breaker(self):
+        self.flaky.failing = True
+        for i in range(3):
+            self.assertEqual(self.metadata().status, 503)
+        self.assertTrue(guard.is_open())
+        self.assertRaises(guard.DropboxUnavailable, self.metadata)
+        self.assertEqual(self.flaky.calls, 3)
+        self.assertRaises(guard.DropboxUnavailable, models.perform_sync, self.gov, self.root)
+        # No syncs are scheduled while open
+        self.assertEqual(models.schedule_sync(self.gov), True)
+        self.assertEqual(models.Throttle.all().count(), 0)
+
+        # Half-open: a failing probe opens the breaker again, for longer
+        self.expire()
+        status = guard.get_guard_status()['breaker']
+        self.assertEqual(status['state'], 'half-open')
+        self.assertEqual(self.metadata().status, 503)
+        status = guard.get_guard_status()['breaker']
+        self.assertEqual(status['state'], 'open')
+        self.assertEqual(status['trips'], 2)
+        delay = status['retry_at']-status['opened_at']
+        self.assertEqual(delay.seconds, 2*config.BREAKER_BASE_DELAY)
+
+        # A successful probe closes it, and other requests wait for the probe
+        self.expire()
+        self.flaky.failing = False
+        self.assertTrue(guard.breaker.allow())
+        self.assertFalse(guard.breaker.allow())
+        memcache.delete(guard.breaker._probe_key, namespace=guard.GUARD_NAMESPACE)
+        self.assertEqual(self.metadata().status, 200)
+        self.assertFalse(guard.is_open())
+        self.assertEqual(guard.get_guard_status()['breaker']['state'], 'closed')
+        self.assertEqual(self.metadata().status, 200)
+
+    @highlight
+    def test_failures_must_be_consecutive(self):
+        for i in range(5):
+            self.flaky.failing = True
+            self.metadata()
+            self.flaky.failing = False
+            self.metadata()
+        self.assertFalse(guard.is_open())
+
+    @highlight
+    def test_bucket(self):
+        bucket = guard.TokenBucket('test', rate=1, capacity=3)
+        now = 3000.0
+        for i in range(3):
+            self.assertEqual(bucket.try_acquire(now), 0)
+        self.assertEqual(bucket.try_acquire(now+1), 2)
+        self.assertEqual(bucket.try_acquire(now+3), 0)
+        # A long refill period, so the bucket stays empty
+        bucket = guard.TokenBucket('slow', rate=0.001, capacity=1)
+        bucket.acquire()
+        self.assertRaises(guard.DropboxUnavailable, bucket.acquire, 0)
@@ -1,16 +1,22 @@
 import unittest
 import sys
+import datetime
+import simplejson as json
 
 
 from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
 from google.appengine.ext import db
 from google.appengine.ext import testbed
 
+import config
+from dropbox import rest
 from siteinadropbox import models, controller
 #from siteinadropbox.handlers import dropboxhandlers
 from siteinadropbox.models import metadata
 from test import pickledsites
-from test.dbtools import highlight
+from test.dbtools import highlight, count_queries, count_puts, count_deletes, ImmediateController
+from test.test_dropbox_rest import FakeHTTPResponse
 
 
 def dump_metadata(nmax=100):
@@ -35,7 +41,7 @@ def find_orphans(nmax=100):
         
 class LoggingController(controller.BaseController):
     def __init__(self, site):
-        controller.BaseController.__init__(self, site)
+        super(LoggingController, self).__init__(site)
         self.clear()
     
     def clear(self):
@@ -52,6 +58,51 @@ class LoggingController(controller.BaseController):
         self.called('updated', created)
         self.called('removed', created)
 
+class TaskController(LoggingController, ImmediateController):
+    """
+    Collects deferred calls, to be run by run_tasks
+    """
+    collect_tasks = True
+
+    def clear(self):
+        LoggingController.clear(self)
+        self.tasks = []
+        self.completed = []
+    def handle_sync_complete(self, run):
+        self.completed.append(run)
+
+class StreamingClient(object):
+    """
+    Serves the listings of a FakeClient as streaming responses
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def metadata_stream(self, root, path, file_limit=10000, hash=None):
+        response = self.client.metadata(root, path, hash=hash)
+        http_resp = FakeHTTPResponse(json.dumps(response.data))
+        http_resp.status = response.status
+        return rest.JSONStreamResponse(http_resp, 'contents')
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+class ReversedClient(object):
+    """
+    Serves the listings of a FakeClient in reverse order
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def metadata(self, root, path, hash=None):
+        response = self.client.metadata(root, path, hash=hash)
+        if response.data.get('contents'):
+            response.data = dict(response.data, contents=response.data['contents'][::-1])
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
 class SyncTestCase(unittest.TestCase):
     def setUp(self):
         
@@ -72,14 +123,25 @@ class SyncTestCase(unittest.TestCase):
     def tearDown(self):
         self.testbed.deactivate()
 
-    def progression_step(self,name, entry = None):
-        self.gov = LoggingController(pickledsites.make_fake_site(name))
+    def progression_step(self,name, entry = None, window = 1, latency = 0, streaming = False):
+        site = pickledsites.make_fake_site(name, latency=latency)
+        if streaming:
+            site._db_client = StreamingClient(site._db_client)
+        self.gov = LoggingController(site)
         if not entry:
             entry = self.root
-        models.perform_sync(self.gov,entry)
+        models.perform_sync(self.gov,entry, window=window)
         self.listing = self.lsr.make_listing(self.root)        
         print('\n%s\nListing:\n%s\n'%(self.gov,self.listing))
 
+    def delta_step(self, name):
+        self.gov = TaskController(pickledsites.make_fake_site(name))
+        models.perform_delta_sync(self.gov)
+        # Syncs after a reset run as a SyncRun
+        self.gov.run_tasks()
+        self.listing = self.lsr.make_listing(self.root)
+        print('\n%s\nListing:\n%s\n'%(self.gov,self.listing))
+
     @highlight
     def test_progressionA(self):
         self.progression_step('A0')
@@ -87,6 +149,214 @@ class SyncTestCase(unittest.TestCase):
         self.progression_step('A2')
         self.assertTrue(self.listing.endswith('f0161748:   a.txt'))
 
+    @highlight
+    def test_concurrent_progressionA(self):
+        self.progression_step('A0', window=4, latency=0.05)
+        self.progression_step('A1', window=4, latency=0.05)
+        self.progression_step('A2', window=4, latency=0.05)
+        self.assertTrue(self.listing.endswith('f0161748:   a.txt'))
+
+    @highlight
+    def test_concurrent_matches_serial(self):
+        self.progression_step('Dropsite_2011-07-19T145942')
+        serial = self.listing
+        models.DirEntry.flush_resources()
+        self.root = models.DirEntry.get_root_entry()
+        self.progression_step('Dropsite_2011-07-19T145942', window=8, latency=0.02)
+        self.assertEqual(self.listing, serial)
+
+    @highlight
+    def test_delta_progressionA(self):
+        self.delta_step('A0')
+        self.delta_step('A1')
+        self.assertTrue(self.listing.endswith("f0161736:     b1.txt"))
+        self.delta_step('A2')
+        self.assertEqual(models.DirEntry.get_by_key_name('/b'), None)
+        self.assertTrue(self.listing.endswith('f0161748:   a.txt'))
+
+    @highlight
+    def test_delta_reset(self):
+        self.gov = TaskController(pickledsites.make_fake_site('A0'))
+        models.perform_delta_sync(self.gov)
+        # Without a cursor, the tree is walked by a SyncRun, not inline
+        self.assertNotEqual(models.DeltaCursor.get_cursor(), None)
+        self.assertEqual(models.DirEntry.all().count(), 1)
+        self.assertEqual([obj for obj, args, kwargs in self.gov.tasks], [metadata.sync_subtree])
+        self.gov.run_tasks()
+        self.assertEqual(len(self.gov.completed), 1)
+        self.assertTrue(self.gov.completed[0].full)
+        self.assertTrue(models.DirEntry.all().count() > 1)
+        # With a cursor, changes are applied right away
+        self.gov = TaskController(pickledsites.make_fake_site('A1'))
+        models.perform_delta_sync(self.gov)
+        self.assertEqual(self.gov.tasks, [])
+
+    @highlight
+    def test_delta_matches_walk(self):
+        self.progression_step('B0')
+        self.progression_step('B1')
+        walked = self.listing
+        models.DirEntry.flush_resources()
+        self.root = models.DirEntry.get_root_entry()
+        self.delta_step('B0')
+        self.delta_step('B1')
+        self.assertEqual(self.listing, walked)
+
+    @highlight
+    def test_streaming_matches_walk(self):
+        streaming, batch = config.STREAMING_LISTINGS, config.SYNC_LISTING_BATCH
+        for names in [['A0', 'A1', 'A2'], ['B0', 'B1'], ['Dropsite_2011-07-19T145942']]:
+            for name in names:
+                self.progression_step(name)
+            walked = self.listing
+            models.DirEntry.flush_resources()
+            self.root = models.DirEntry.get_root_entry()
+            config.STREAMING_LISTINGS, config.SYNC_LISTING_BATCH = True, 1
+            try:
+                for name in names:
+                    self.progression_step(name, streaming=True)
+            finally:
+                config.STREAMING_LISTINGS, config.SYNC_LISTING_BATCH = streaming, batch
+            self.assertEqual(self.listing, walked)
+            models.DirEntry.flush_resources()
+            self.root = models.DirEntry.get_root_entry()
+
+    @highlight
+    def test_merge_listing(self):
+        class Member(object):
+            def __init__(self, path):
+                self.path = path
+            def get_path(self):
+                return self.path
+        members = [Member(p) for p in ['/a', '/c', '/d', '/f']]
+        for items in [['/b', '/c', '/f'], ['/f', '/b', '/c'], ['/c', '/b', '/f']]:
+            merged = list(metadata._merge_listing(iter([(p,) for p in items]), iter(members)))
+            self.assertEqual(sorted((p, bool(i), e and e.get_path()) for p, i, e in merged),
+                             [('/a', False, '/a'), ('/b', True, None), ('/c', True, '/c'),
+                              ('/d', False, '/d'), ('/f', True, '/f')])
+
+    @highlight
+    def test_unsorted_listing(self):
+        class Listing(object):
+            def __init__(self, paths):
+                self.data = {'contents': [{'path': p, 'is_dir': False} for p in paths]}
+        normalize_path = lambda p: p.lower()[len('/dropsite'):]
+        items = metadata._iter_listing(
+            Listing(['/Dropsite/c.txt', '/Dropsite/B.txt', '/Dropsite/a.txt']), normalize_path)
+        self.assertEqual([i[0] for i in items], ['/a.txt', '/b.txt', '/c.txt'])
+
+        # Syncing reversed listings gives the same result
+        for name in ['A0', 'A1', 'A2']:
+            self.progression_step(name)
+        walked = self.listing
+        models.DirEntry.flush_resources()
+        self.root = models.DirEntry.get_root_entry()
+        for name in ['A0', 'A1', 'A2']:
+            site = pickledsites.make_fake_site(name)
+            site._db_client = ReversedClient(site._db_client)
+            self.gov = LoggingController(site)
+            models.perform_sync(self.gov, self.root, window=1)
+        self.assertEqual(self.lsr.make_listing(self.root), walked)
+
+    @highlight
+    def test_unsorted_streamed_listing(self):
+        class Member(object):
+            def __init__(self, path):
+                self.path = path
+            def get_path(self):
+                return self.path
+        def merged(paths, page_size):
+            members = [Member(p) for p in ['/a', '/c', '/e']]
+            return [(path, item and item[0], entry and entry.get_path()) for path, item, entry in
+                    metadata._merge_listing(iter([(p,) for p in paths]), iter(members), page_size)]
+        expected = [('/a', '/a', '/a'), ('/b', '/b', None), ('/c', '/c', '/c'),
+                    ('/d', '/d', None), ('/e', None, '/e')]
+        # Streamed listings are sorted a page at a time
+        self.assertEqual(merged(['/b', '/a', '/d', '/c'], 2), expected)
+        # ... and merged in memory when the pages overlap
+        self.assertEqual(sorted(merged(['/d', '/c', '/b', '/a'], 2)), expected)
+        self.assertEqual(sorted(merged(['/d', '/c', '/b', '/a'], None)), expected)
+
+        # Syncing reversed streamed listings gives the same result, either way
+        for name in ['A0', 'A1', 'A2']:
+            self.progression_step(name)
+        walked = self.listing
+        streaming, batch = config.STREAMING_LISTINGS, config.SYNC_LISTING_BATCH
+        try:
+            for config.STREAMING_LISTINGS, config.SYNC_LISTING_BATCH in [(True, 1), (True, 1000)]:
+                models.DirEntry.flush_resources()
+                self.root = models.DirEntry.get_root_entry()
+                for name in ['A0', 'A1', 'A2']:
+                    site = pickledsites.make_fake_site(name)
+                    site._db_client = StreamingClient(ReversedClient(site._db_client))
+                    self.gov = LoggingController(site)
+                    models.perform_sync(self.gov, self.root, window=1)
+                self.assertEqual(self.lsr.make_listing(self.root), walked)
+        finally:
+            config.STREAMING_LISTINGS, config.SYNC_LISTING_BATCH = streaming, batch
+
+    @highlight
+    def test_sync_run(self):
+        self.progression_step('Dropsite_2011-07-19T145942')
+        serial = self.listing
+        models.DirEntry.flush_resources()
+        self.root = models.DirEntry.get_root_entry()
+
+        max_dirs = config.SYNC_TASK_MAX_DIRS
+        config.SYNC_TASK_MAX_DIRS = 1
+        try:
+            self.gov = TaskController(pickledsites.make_fake_site('Dropsite_2011-07-19T145942'))
+            run = models.start_sync_run(self.gov, self.root)
+            ntasks = self.gov.run_tasks()
+        finally:
+            config.SYNC_TASK_MAX_DIRS = max_dirs
+        run = models.SyncRun.get(run.key())
+        print run
+        self.assertTrue(ntasks > 1)
+        self.assertEqual(run.task_count, ntasks)
+        self.assertEqual(run.pending, [])
+        self.assertNotEqual(run.finished, None)
+        self.assertEqual(len(self.gov.completed), 1)
+        self.assertEqual(self.lsr.make_listing(self.root), serial)
+
+        # A retried task does nothing
+        metadata.sync_subtree(self.gov, str(run.key()), '0', [str(self.root.key())])
+        self.assertEqual(self.gov.tasks, [])
+        self.assertEqual(len(self.gov.completed), 1)
+
+        # Completing a run prunes the old runs, except active ones
+        for i in range(6):
+            models.SyncRun(root_path='/', started=run.started-datetime.timedelta(hours=i+1),
+                           finished=run.finished).put()
+        active = models.SyncRun(root_path='/', started=run.started-datetime.timedelta(days=1))
+        active.put()
+        models.start_sync_run(self.gov, self.root)
+        self.gov.run_tasks()
+        runs = [r.key() for r in models.SyncRun.all().order('-started')]
+        self.assertEqual(len(runs), 6)
+        self.assertEqual(runs[1], run.key())
+        self.assertEqual(runs[-1], active.key())
+
+    @highlight
+    def test_filtered_leftovers(self):
+        self.progression_step('Dropsite_2011-07-19T145942')
+        models.DirEntry.flush_resources()
+        self.root = models.DirEntry.get_root_entry()
+        now = datetime.datetime.now()
+        b = models.DirEntry.get_by_key_name('/b')
+        b.next_poll = now+datetime.timedelta(hours=1)
+        b.put()
+        self.gov = TaskController(pickledsites.make_fake_site('Dropsite_2011-07-19T145942'))
+        is_due = lambda e: e.is_due(now)
+        # Member dirs which are not due are not handed on to the next task
+        visit, visited = metadata._sync_entries(self.gov, [self.root], max_dirs=1, visit_filter=is_due)
+        self.assertEqual(visited, 1)
+        self.assertEqual(visit, [])
+        # ... but entries to start from are
+        visit, visited = metadata._sync_entries(self.gov, [self.root, b], max_dirs=1, visit_filter=is_due)
+        self.assertEqual(visited, 1)
+        self.assertEqual([e.get_path() for e in visit], ['/'])
+
     @highlight
     def test_progressionB(self):
         self.progression_step('B0')
@@ -105,6 +375,88 @@ class SyncTestCase(unittest.TestCase):
         self.progression_step('A1', models.DirEntry.get_by_key_name('/b')) 
         self.assertTrue(self.listing.endswith("f0161736:     b1.txt"))
 
+    @highlight
+    def test_subdirs(self):
+        self.progression_step('A0')
+        root = models.DirEntry.get_root_entry()
+        self.assertEqual(root.subdirs, ['/b'])
+        self.assertEqual(root.member_count, 2)
+        # An unchanged tree is walked through the member dirs, without queries
+        gov = LoggingController(pickledsites.make_fake_site('A0'))
+        self.assertEqual(count_queries(models.perform_sync, gov, self.root), 0)
+        # ... and the poll statistics of its dirs are written together
+        self.assertEqual(count_puts(models.perform_sync, gov, models.DirEntry.get_root_entry()), 1)
+        self.assertEqual(models.DirEntry.get_by_key_name('/b').get_poll_stats()[0], 3)
+        self.progression_step('A0')
+        self.assertTrue(self.listing.endswith("f0161736:     b1.txt"))
+        self.progression_step('A2')
+        root = models.DirEntry.get_root_entry()
+        self.assertEqual(root.subdirs, [])
+        self.assertEqual(root.member_count, 1)
+
+    @highlight
+    def test_adaptive_polling(self):
+        self.progression_step('A0')
+        root = models.DirEntry.get_root_entry()
+        b = models.DirEntry.get_by_key_name('/b')
+        self.assertEqual(root.poll_interval, config.POLL_MIN_INTERVAL)
+        self.assertEqual(root.get_poll_stats(), (1, 1, 0.0))
+        # Unchanged: back off
+        self.progression_step('A0')
+        root = models.DirEntry.get_root_entry()
+        self.assertEqual(root.poll_interval, config.POLL_MIN_INTERVAL*config.POLL_BACKOFF)
+        self.assertEqual(root.get_poll_stats(), (2, 1, 0.5))
+
+        now = datetime.datetime.now()
+        self.assertEqual(models.DirEntry.get_due_dirs(now), [])
+        later = now+datetime.timedelta(seconds=config.POLL_MIN_INTERVAL*config.POLL_BACKOFF+1)
+        # /b is below root, which is due as well
+        self.assertEqual([e.get_path() for e in models.DirEntry.get_due_dirs(later)], ['/'])
+        root.next_poll = later+datetime.timedelta(days=1)
+        root.put()
+        self.assertEqual([e.get_path() for e in models.DirEntry.get_due_dirs(later)], ['/b'])
+
+    @highlight
+    def test_delete_below(self):
+        self.progression_step('A0')
+        b = models.DirEntry.get_by_key_name('/b')
+        models.Throttle(parent=b, earliest_sync=metadata.BEGINNING_OF_TIME).put()
+        models.Throttle(parent=self.root, earliest_sync=metadata.BEGINNING_OF_TIME).put()
+        b.delete_below()
+        self.assertEqual(models.DirEntry.get_by_key_name('/b/b1.txt'), None)
+        self.assertEqual(models.Throttle.all().ancestor(b).count(), 0)
+        self.assertNotEqual(models.DirEntry.get_by_key_name('/a.txt'), None)
+        self.root.delete_below()
+        self.assertEqual([e.get_path() for e in models.DirEntry.all()], ['/'])
+        self.assertEqual(models.Throttle.all().count(), 0)
+
+    @highlight
+    def test_delete_all_below(self):
+        self.progression_step('A0')
+        members = list(self.root.dir_members)
+        self.assertTrue(len(members) > 1)
+        for e in members:
+            models.Throttle(parent=e, earliest_sync=metadata.BEGINNING_OF_TIME).put()
+        # The entities below all members go in one delete
+        self.assertEqual(count_deletes(models.DirEntry.delete_all_below, members), 1)
+        self.assertEqual(models.Throttle.all().count(), 0)
+        self.assertEqual(sorted(e.get_path() for e in models.DirEntry.all()),
+                         sorted(['/']+[e.get_path() for e in members]))
+
+    @highlight
+    def test_sync_gate(self):
+        now = datetime.datetime.now()
+        polint = datetime.timedelta(seconds=60)
+        self.assertTrue(metadata._acquire_sync_lease('/', polint, now))
+        self.assertFalse(metadata._acquire_sync_lease('/', polint, now))
+        # The gate of one site does not hold back another
+        namespace = namespace_manager.get_namespace()
+        namespace_manager.set_namespace('othersite')
+        try:
+            self.assertTrue(metadata._acquire_sync_lease('/', polint, now))
+        finally:
+            namespace_manager.set_namespace(namespace)
+
     @highlight
     def test_zorphan_capture(self):
         orphans=[models.DirEntry.get_or_insert(key_name=k) for k in ['/a.txt', '/b/b1.txt']]
@@ -0,0 +1,160 @@
+import unittest
+import re
+from datetime import timedelta
+
+from google.appengine.ext import testbed
+
+import config
+from siteinadropbox import models
+from siteinadropbox.models import plan
+from test import pickledsites
+from test.dbtools import highlight, count_puts
+from test.test_models_metadata import LoggingController, TaskController
+
+class PlanController(LoggingController):
+    """
+    Records the paths handed to handle_metadata_changes
+    """
+    def handle_metadata_changes(self, created=[], updated=[], removed=[]):
+        self.called('updated', [e.get_path() for e in created+updated])
+        self.called('removed', [e.get_path() for e in removed])
+
+class ClassesController(PlanController):
+    """
+    Serves the files of /b as raw files, and other text files as pages
+    """
+    def __init__(self, site):
+        PlanController.__init__(self, site)
+        self.resource_default_attributes = [
+            (re.compile(r'.*\.txt$'), {'resource_class': 'PageResource'}),
+            (re.compile(r'/b/.*'), {'resource_class': 'RawResource'})]
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.root = models.DirEntry.get_root_entry()
+        self.lsr = models.ListingVisitor()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def walk(self, names):
+        """
+        Returns the listings after walk syncs to each of the states in names
+        """
+        listings = []
+        for name in names:
+            models.perform_sync(LoggingController(pickledsites.make_fake_site(name)), self.root)
+            listings.append(self.lsr.make_listing(self.root))
+        models.DirEntry.flush_resources()
+        self.root = models.DirEntry.get_root_entry()
+        return listings
+
+    @highlight
+    def test_plan_matches_walk(self):
+        names = ['A0', 'A1', 'A2']
+        walked = self.walk(names)
+        for name, listing in zip(names, walked):
+            before = self.lsr.make_listing(self.root)
+            self.gov = PlanController(pickledsites.make_fake_site(name))
+            p = models.make_plan(self.gov)
+            print '%s\n%s'%(p, '\n'.join([str(c) for c in p.get_diff()]))
+            # A dry run changes nothing
+            self.assertEqual(self.lsr.make_listing(self.root), before)
+            self.assertEqual(self.gov.calls, [])
+            p.put()
+            models.apply_plan(self.gov, models.SyncPlan.get(p.key()))
+            self.assertEqual(self.lsr.make_listing(self.root), listing)
+            self.assertTrue(models.SyncPlan.get(p.key()).applied)
+            # Nothing is left to do
+            p = models.make_plan(self.gov)
+            self.assertEqual((p.remove_count, p.upsert_count), (0, 0))
+
+    @highlight
+    def test_grouped_by_resource_class(self):
+        self.gov = ClassesController(pickledsites.make_fake_site('A0'))
+        models.apply_plan(self.gov, models.make_plan(self.gov))
+        print self.gov
+        # Groups of no class, PageResource and RawResource
+        self.assertEqual([(action, sorted(paths)) for action, paths in self.gov.calls],
+                         [('updated', ['/']), ('updated', ['/a.txt']),
+                          ('updated', ['/b', '/b/b1.txt'])])
+
+    @highlight
+    def test_dry_run_writes_nothing(self):
+        self.gov = PlanController(pickledsites.make_fake_site('A0'))
+        models.perform_sync(self.gov, self.root)
+        # An entry from before member dirs were kept
+        self.root.member_count = None
+        self.root.put()
+        # Unchanged, so the walk goes through the member dirs of root
+        self.assertEqual(count_puts(models.make_plan, self.gov), 0)
+        self.assertEqual(models.DirEntry.get_by_key_name('/').member_count, None)
+
+    @highlight
+    def test_stale_plan(self):
+        self.gov = PlanController(pickledsites.make_fake_site('A0'))
+        p = models.make_plan(self.gov)
+        p.put()
+        p.created -= timedelta(days=1)
+        p.put()
+        models.apply_plan_by_key(self.gov, str(p.key()))
+        self.assertEqual(self.gov.calls, [])
+        self.assertFalse(models.SyncPlan.get(p.key()).applied)
+
+    @highlight
+    def test_stored_plan(self):
+        self.gov = PlanController(pickledsites.make_fake_site('A0'))
+        self.assertEqual(models.SyncPlan.get_latest(), None)
+        for i in range(7):
+            p = models.make_stored_plan(self.gov)
+        # The admin pages show the latest, and old plans are pruned
+        self.assertEqual(models.SyncPlan.get_latest().key(), p.key())
+        self.assertEqual(models.SyncPlan.all().count(), 5)
+        self.assertEqual(self.gov.calls, [])
+
+    @highlight
+    def test_chunked_plan(self):
+        self.gov = PlanController(pickledsites.make_fake_site('A0'))
+        chunk_size = config.PLAN_CHUNK_SIZE
+        config.PLAN_CHUNK_SIZE = 64
+        try:
+            p = models.make_plan(self.gov)
+            changes = p.get_changes()
+            p.put()
+        finally:
+            config.PLAN_CHUNK_SIZE = chunk_size
+        # Stored in chunks below the plan, and read back from them
+        stored = models.SyncPlan.get(p.key())
+        self.assertTrue(stored.chunk_count > 1)
+        self.assertEqual(stored.data, None)
+        self.assertEqual(plan.SyncPlanChunk.all().ancestor(p).count(), stored.chunk_count)
+        self.assertEqual(stored.get_changes(), changes)
+        models.apply_plan(self.gov, stored)
+        self.assertTrue(models.SyncPlan.get(p.key()).applied)
+        # Pruned along with the plan
+        models.SyncPlan.prune(keep=0)
+        self.assertEqual(models.SyncPlan.all().count(), 0)
+        self.assertEqual(plan.SyncPlanChunk.all().count(), 0)
+
+    @highlight
+    def test_planned_sync_run(self):
+        names = ['A0', 'A1', 'A2']
+        walked = self.walk(names)
+        max_dirs = config.SYNC_TASK_MAX_DIRS
+        config.SYNC_TASK_MAX_DIRS = 1
+        try:
+            for name, listing in zip(names, walked):
+                self.gov = TaskController(pickledsites.make_fake_site(name))
+                run = plan.perform_planned_sync(self.gov)
+                self.assertTrue(run.planned)
+                # Each task plans and applies its own part of the tree
+                self.assertEqual(self.gov.run_tasks(), models.SyncRun.get(run.key()).task_count)
+                self.assertEqual(len(self.gov.completed), 1)
+                self.assertEqual(self.lsr.make_listing(models.DirEntry.get_root_entry()), listing)
+        finally:
+            config.SYNC_TASK_MAX_DIRS = max_dirs
+        self.assertEqual(models.SyncPlan.all().count(), 0)
@@ -1,38 +1,50 @@
 import unittest
 import sys
+import re
 import logging
+import time
+import gzip
+from cStringIO import StringIO
+from datetime import datetime, timedelta
 
 from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
 from google.appengine.ext import db
+from google.appengine.ext import webapp
 from google.appengine.ext import testbed
 
 from siteinadropbox.handlers import dropboxhandlers
 from siteinadropbox.handlers import resourcehandlers
-from siteinadropbox.handlers import cdeferred
+import config
 from siteinadropbox import controller
 from siteinadropbox import models
+from siteinadropbox import cache
+from siteinadropbox import main
+from siteinadropbox import templateloader
+from siteinadropbox.models import batch
+from siteinadropbox.models import resources
 
 from test import dbtools
 from test import pickledsites
-from test.dbtools import highlight
-
-class ImmediateController(controller.BaseController):
-    def handle_metadata_changes(self, created=[], updated=[], removed=[]):
-        logging.debug('Handling metadata changed')
-        for entry in created+updated:
-            models.Resource.update(self, entry)
-
-    def cdefer(self, obj, *args, **kwargs):
-        taskargs = dict((x, kwargs.pop(("_%s" % x), None))
-                        for x in ("countdown", "eta", "name"))
-        taskargs["url"] = kwargs.pop("_url", cdeferred._DEFAULT_URL)
-        taskargs["transactional"] = kwargs.pop("_transactional", False)
-        taskargs["headers"] = cdeferred._TASKQUEUE_HEADERS
-        taskargs["queue"] = kwargs.pop("_queue", cdeferred._DEFAULT_QUEUE)
-
-        logging.debug('Immediately executing cdefer call. Options were: %s'%taskargs)
-        logging.debug('Object to call: %s, args: %s, %s'%(obj, args, kwargs))
-        obj(self, *args, **kwargs)
+from test.dbtools import highlight, count_calls, ImmediateController
+
+class BatchController(ImmediateController):
+    """
+    Coalesces resource actions, collecting the batch tasks for run_tasks
+    """
+    batch_actions = True
+    collect_tasks = True
+
+class AccessRecorder(ImmediateController):
+    """
+    Records the accesses it is notified of
+    """
+    def __init__(self, site):
+        ImmediateController.__init__(self, site)
+        self.accessed = []
+
+    def resource_access_notify(self, resource=None, url=None, resource_key=None):
+        self.accessed.append((resource, url, resource_key))
 
 class ResourceTestCase(unittest.TestCase):
     def setUp(self):
@@ -51,6 +63,9 @@ class ResourceTestCase(unittest.TestCase):
 
 
     def tearDown(self):
+        controller._controllers.clear()
+        models.UrlIndex._backfilled.clear()
+        models.UrlIndex._known_urls.clear()
         self.testbed.deactivate()
 
     def syncto(self,name):
@@ -58,6 +73,59 @@ class ResourceTestCase(unittest.TestCase):
         self.root = models.DirEntry.get_root_entry()
         models.perform_sync(self.gov, self.root)
 
+    def install_controller(self, gov):
+        """
+        Make gov the current site controller, as if loaded by an earlier request
+        """
+        controller._controllers[namespace_manager.get_namespace()] = (
+            cache.controller_generation.get(), gov)
+        return gov
+
+    def handler(self, url, headers={}, handler_class=main.PageHandler):
+        """
+        Returns a handler of handler_class, initialized with a GET request for url
+        """
+        request = webapp.Request.blank(url)
+        for k, v in headers.items():
+            request.headers[k] = v
+        handler = handler_class()
+        handler.initialize(request, webapp.Response())
+        return handler
+
+    def make_raw(self, data, revision=3, r=None):
+        """
+        Returns a RawResource at /data.bin holding data, stored in chunks
+        of config.CONTENT_CHUNK_SIZE if larger than one chunk.
+        If r is given, it is updated to the new revision instead.
+        """
+        if not r:
+            entry = models.DirEntry(key_name='/data.bin', revision=revision, bytes=len(data),
+                                    modified=datetime(2011, 7, 19, 14, 59, 42, 123))
+            entry.put()
+            r = resources.RawResource(parent=entry, url='/data.bin', modified=entry.modified,
+                                      content_type='application/octet-stream')
+            r.put()
+        r.revision = revision
+        r.size = len(data)
+        chunk_size = config.CONTENT_CHUNK_SIZE
+        if len(data) > chunk_size:
+            r.chunk_count = (len(data)+chunk_size-1)//chunk_size
+            db.put([resources.ContentChunk(key=resources.ContentChunk.key_for(r, revision, idx),
+                                           data=data[idx*chunk_size:(idx+1)*chunk_size])
+                    for idx in range(r.chunk_count)])
+        else:
+            r.source = data
+        r.put()
+        return r
+
+    def serve(self, resource, headers={}):
+        """
+        Returns the handler after resource has served a request with headers
+        """
+        h = self.handler(resource.url, headers)
+        resource.serve(self.gov, h)
+        return h
+
     @highlight
     def test_default_attr(self):
         self.syncto('C0')
@@ -83,3 +151,582 @@ class ResourceTestCase(unittest.TestCase):
         rs=models.Resource.get_resource_by_url('/')
         print('URL /: %s'%(rs))
         self.assertEqual(rs.parent().get_path(),'/index.txt')
+
+    @highlight
+    def test_batch(self):
+        self.gov = BatchController(pickledsites.make_fake_site('Dropsite_2011-07-19T145942'))
+        self.root = models.DirEntry.get_root_entry()
+        models.perform_sync(self.gov, self.root)
+        pending = models.PendingAction.all().count()
+        print 'Pending actions: %d, batch tasks: %d'%(pending, len(self.gov.tasks))
+        self.assertTrue(pending > 1)
+        self.assertTrue(len(self.gov.tasks) < pending)
+        # Scheduling again does not duplicate actions
+        models.perform_sync(self.gov, self.root)
+        self.assertEqual(models.PendingAction.all().count(), pending)
+
+        self.gov.run_tasks()
+        self.assertEqual(models.PendingAction.all().count(), 0)
+        rs=models.Resource.get_resource_by_url('/b/')
+        self.assertEqual(rs.title, 'An index')
+        self.assertTrue(rs.body.startswith('<p>Wonder'))
+
+    @highlight
+    def test_collected_actions(self):
+        self.gov = BatchController(pickledsites.make_fake_site('Dropsite_2011-07-19T145942'))
+        self.root = models.DirEntry.get_root_entry()
+        models.collect_actions(self.gov)
+        models.perform_sync(self.gov, self.root)
+        self.assertEqual(models.PendingAction.all().count(), 0)
+        self.assertTrue(len(self.gov._collected_actions) > 1)
+        models.flush_actions(self.gov)
+        self.assertTrue(models.PendingAction.all().count() > 1)
+        self.assertEqual(len(self.gov.tasks), 1)
+
+        # A batch finding nothing checks again while its query may miss new actions
+        db.delete(models.PendingAction.all(keys_only=True).fetch(1000))
+        memcache.flush_all()
+        batch._note_added()
+        self.gov.tasks = []
+        models.run_batch(self.gov)
+        self.assertEqual(len(self.gov.tasks), 1)
+        memcache.flush_all()
+        self.gov.tasks = []
+        models.run_batch(self.gov)
+        self.assertEqual(self.gov.tasks, [])
+
+    @highlight
+    def test_batch_task_names(self):
+        namespace = namespace_manager.get_namespace()
+        names = set()
+        try:
+            for ns in ['', 'a.b', 'a_b', 'a-b']:
+                namespace_manager.set_namespace(ns)
+                names.add(batch._task_namespace())
+        finally:
+            namespace_manager.set_namespace(namespace)
+        # Namespaces do not share task names
+        self.assertEqual(len(names), 4)
+        for name in names:
+            self.assertTrue(re.match(r'^[a-zA-Z0-9_-]*$', name))
+
+    @highlight
+    def test_promote_actions(self):
+        self.gov = BatchController(pickledsites.make_fake_site('Dropsite_2011-07-19T145942'))
+        self.root = models.DirEntry.get_root_entry()
+        models.perform_sync(self.gov, self.root)
+        pending = models.PendingAction.all().count()
+        self.gov.tasks = []
+        rs = models.Resource.get_resource_by_url('/b/')
+        self.assertTrue(models.has_pending_actions(rs.key()))
+        self.assertTrue(models.promote_actions(self.gov, rs.key()))
+        # Only one promotion at a time
+        models.promote_actions(self.gov, rs.key())
+        self.assertEqual(len(self.gov.tasks), 1)
+        self.gov.run_tasks()
+        self.assertFalse(models.has_pending_actions(rs.key()))
+        self.assertTrue(models.PendingAction.all().count() < pending)
+        rs = models.Resource.get_resource_by_url('/b/')
+        self.assertTrue(rs.body.startswith('<p>Wonder'))
+
+    def deferred_queues(self, gov, obj):
+        return set(queue for o, queue in gov.deferred if o == obj)
+
+    @highlight
+    def test_action_priority(self):
+        gov = ImmediateController(pickledsites.make_fake_site('Dropsite_2011-07-19T145942'))
+        gov.collect_tasks = True
+        models.perform_sync(gov, models.DirEntry.get_root_entry())
+        queues = [queue for o, queue in gov.deferred if o.__name__ == 'fetch']
+        self.assertTrue(len(queues) > 1)
+        self.assertEqual(set(queues), set([config.TASK_PRIORITY_QUEUES[config.RESOURCE_PRIORITY]]))
+        # Fetches found by a consistency check go to the bulk queue
+        gov.tasks = []
+        gov.deferred = []
+        gov.do_verify_database_consistency()
+        queues = [queue for o, queue in gov.deferred if o.__name__ == 'fetch']
+        self.assertTrue(len(queues) > 1)
+        self.assertEqual(set(queues), set([config.TASK_PRIORITY_QUEUES['bulk']]))
+        self.assertEqual(gov.action_priority, None)
+
+    @highlight
+    def test_batch_priority(self):
+        self.gov = BatchController(pickledsites.make_fake_site('Dropsite_2011-07-19T145942'))
+        models.perform_sync(self.gov, models.DirEntry.get_root_entry())
+        pending = models.PendingAction.all().count()
+        self.assertEqual(self.deferred_queues(self.gov, models.run_batch),
+                         set([config.TASK_PRIORITY_QUEUES[config.RESOURCE_PRIORITY]]))
+        # Verifying does not demote actions already pending
+        self.gov.tasks = []
+        self.gov.deferred = []
+        self.gov.do_verify_database_consistency()
+        self.assertEqual(models.PendingAction.all().filter('priority =', 'bulk').count(), 0)
+        self.assertEqual(self.gov.tasks, [])
+
+        # Actions first found by verifying are batched on their own, in the bulk queue
+        db.delete(models.PendingAction.all(keys_only=True).fetch(1000))
+        memcache.flush_all()
+        self.gov.do_verify_database_consistency()
+        self.assertEqual(models.PendingAction.all().filter('priority =', 'bulk').count(), pending)
+        self.assertEqual(self.deferred_queues(self.gov, models.run_batch),
+                         set([config.TASK_PRIORITY_QUEUES['bulk']]))
+        self.assertEqual(self.gov.tasks[0][2]['priority'], 'bulk')
+        # ... which a batch of another priority leaves alone
+        models.run_batch(self.gov, priority=config.RESOURCE_PRIORITY)
+        self.assertEqual(models.PendingAction.all().count(), pending)
+
+        # Requesting one of them again at the resource's priority moves it up
+        rs = models.Resource.get_resource_by_url('/b/')
+        pa = models.PendingAction.all().filter('resource =', rs).get()
+        memcache.flush_all()
+        self.gov.tasks = []
+        self.gov.deferred = []
+        rs.schedule(self.gov, getattr(rs, pa.action), pa.revision)
+        self.assertEqual(models.PendingAction.get(pa.key()).priority, config.RESOURCE_PRIORITY)
+        self.assertEqual(self.deferred_queues(self.gov, models.run_batch),
+                         set([config.TASK_PRIORITY_QUEUES[config.RESOURCE_PRIORITY]]))
+
+        self.gov.run_tasks()
+        self.assertEqual(models.PendingAction.all().filter('priority =', 'bulk').count(), pending-1)
+        self.assertEqual(models.PendingAction.all().filter('priority =', config.RESOURCE_PRIORITY).count(), 0)
+        models.run_batch(self.gov, size=1000, priority='bulk')
+        self.assertEqual(models.PendingAction.all().count(), 0)
+
+    @highlight
+    def test_promote_bulk_actions(self):
+        self.gov = BatchController(pickledsites.make_fake_site('Dropsite_2011-07-19T145942'))
+        self.gov.action_priority = 'bulk'
+        models.perform_sync(self.gov, models.DirEntry.get_root_entry())
+        self.gov.action_priority = None
+        pending = models.PendingAction.all().count()
+        self.gov.tasks = []
+        self.gov.deferred = []
+        # Nothing to promote on a resource without pending actions
+        rs = models.Resource.get_resource_by_url('/b/')
+        resources.clear_pending_revision([rs.key()])
+        self.assertFalse(models.promote_actions(self.gov, rs.key()))
+        self.assertEqual(self.gov.deferred, [])
+        # Bulk actions are promoted to the interactive queue like any other
+        resources.set_pending_revision(rs.key(), rs.parent().revision)
+        self.assertTrue(models.promote_actions(self.gov, rs.key()))
+        self.assertEqual(self.deferred_queues(self.gov, models.run_batch),
+                         set([config.TASK_PRIORITY_QUEUES['interactive']]))
+        self.gov.run_tasks()
+        self.assertFalse(models.has_pending_actions(rs.key()))
+        self.assertEqual(models.PendingAction.all().count(), pending-1)
+        rs = models.Resource.get_resource_by_url('/b/')
+        self.assertTrue(rs.body.startswith('<p>Wonder'))
+
+    @highlight
+    def test_refresh_pending(self):
+        self.gov = BatchController(pickledsites.make_fake_site('Dropsite_2011-07-19T145942'))
+        self.root = models.DirEntry.get_root_entry()
+        models.perform_sync(self.gov, self.root)
+        rs = models.Resource.get_resource_by_url('/b/')
+        pending = models.get_pending_revision(rs.key())
+        print 'Pending: %s, current: %s'%(pending, rs.revision)
+        self.assertNotEqual(pending, None)
+        self.assertNotEqual(pending[0], rs.revision)
+        self.assertTrue(rs.estimate_fetch_time() < config.SWR_BUDGET)
+        rs = rs.refresh(self.gov, pending[0])
+        self.assertEqual(rs.revision, pending[0])
+        self.assertEqual(models.get_pending_revision(rs.key()), None)
+
+    def serve_pending(self, attributes={}, pending=True):
+        """
+        Returns (controller, handler) after a request for /data.bin, stored at
+        revision 3, while revision 4 is pending (if pending is set) and with
+        default attributes `attributes`. Deferred calls are collected.
+        """
+        gov = ImmediateController(pickledsites.make_fake_site('C0'))
+        gov.collect_tasks = True
+        gov.resource_default_attributes = [(re.compile('.*'), attributes)]
+        gov.db_client.content_dict['/dropsite/data.bin'] = 'new content'
+        self.install_controller(gov)
+        r = self.make_raw('0123456789')
+        if pending:
+            resources.set_pending_revision(r.key(), 4)
+        h = self.handler('/data.bin')
+        h.get('/data.bin')
+        return gov, h
+
+    def assertServed(self, h, body, pending_revision=None):
+        self.assertEqual(h.response.status, 200)
+        self.assertEqual(h.response.out.getvalue(), body)
+        self.assertEqual(h.response.headers.get('X-Pending-Revision'), pending_revision)
+        cached = cache.get_cached_response('/data.bin')
+        if pending_revision:
+            # Stale responses are not cached
+            self.assertEqual(cached, None)
+        else:
+            self.assertEqual(cached[2], body)
+
+    @highlight
+    def test_swr_fresh(self):
+        gov, h = self.serve_pending(pending=False)
+        self.assertServed(h, '0123456789')
+
+    @highlight
+    def test_swr_inline_refresh(self):
+        # Fetching is estimated to take less than config.SWR_BUDGET
+        gov, h = self.serve_pending()
+        self.assertServed(h, 'new content')
+        self.assertEqual(models.Resource.get_resource_by_url('/data.bin').revision, 4)
+
+    @highlight
+    def test_swr_stale(self):
+        gov, h = self.serve_pending({'swr_budget': '0'})
+        self.assertServed(h, '0123456789', '4')
+        # The fetch is handed on to an interactive task
+        self.assertEqual(gov.deferred[-1][1], config.TASK_PRIORITY_QUEUES['interactive'])
+        gov.run_tasks()
+        self.assertEqual(models.Resource.get_resource_by_url('/data.bin').revision, 4)
+
+    @highlight
+    def test_swr_max_stale(self):
+        # Pending for longer than swr_max_stale: fetched inline, however slow
+        gov, h = self.serve_pending({'swr_budget': '0', 'swr_max_stale': '-1'})
+        self.assertServed(h, 'new content')
+
+    @highlight
+    def test_swr_max_inline_fetch(self):
+        # Fetches which could run past the request deadline are never made inline
+        max_inline = config.SWR_MAX_INLINE_FETCH
+        config.SWR_MAX_INLINE_FETCH = 0
+        try:
+            gov, h = self.serve_pending({'swr_budget': '0', 'swr_max_stale': '-1'})
+        finally:
+            config.SWR_MAX_INLINE_FETCH = max_inline
+        self.assertServed(h, '0123456789', '4')
+
+    def indexed_urls(self):
+        return [k.name() for k in models.UrlIndex.all(keys_only=True)
+                if k.name() != models.UrlIndex.BACKFILLED]
+
+    @highlight
+    def test_url_index(self):
+        self.syncto('C0')
+        indexed = len(self.indexed_urls())
+        self.assertTrue(indexed > 1)
+        # Resources from before the index are found, and indexed
+        db.delete(models.UrlIndex.all(keys_only=True).fetch(1000))
+        models.UrlIndex._backfilled.clear()
+        self.assertTrue(models.Resource.get_resource_by_url('/'))
+        self.assertEqual(len(self.indexed_urls()), 1)
+        self.assertEqual(models.UrlIndex.backfill(), indexed-1)
+        self.assertEqual(len(self.indexed_urls()), indexed)
+        # Once backfilled, a miss is one key lookup, without a query
+        self.assertEqual(models.Resource.get_resource_by_url('/nothing/here'), None)
+        self.assertEqual(count_calls(models.Resource.get_resource_by_url, '/nothing/here'), 1)
+        # Index entries go with their resources
+        self.root.delete_below()
+        self.assertEqual(self.indexed_urls(), [])
+
+    def settle_url_changes(self):
+        memcache.set('_known_urls_changed', time.time()-config.KNOWN_URLS_SETTLE-1)
+
+    @highlight
+    def test_known_urls(self):
+        self.syncto('C0')
+        db.delete(models.UrlIndex.get_by_key_name(models.UrlIndex.BACKFILLED))
+        gov = BatchController(pickledsites.make_fake_site('C0'))
+        # Requests do not build the list, but have it rebuilt, once
+        self.assertEqual(count_calls(models.UrlIndex.get_known_urls), 0)
+        self.assertEqual(models.UrlIndex.get_known_urls(), None)
+        models.UrlIndex.request_backfill(gov)
+        models.UrlIndex.request_rebuild(gov)
+        models.UrlIndex.request_rebuild(gov)
+        self.assertEqual(len(gov.tasks), 1)
+        # ... once changes have settled
+        obj, args, kwargs = gov.tasks.pop(0)
+        obj(gov, *args, **kwargs)
+        self.assertEqual([obj for obj, args, kwargs in gov.tasks], [resources.rebuild_known_url_list])
+        self.settle_url_changes()
+        self.assertEqual(gov.run_tasks(), 1)
+        # Not known until backfilled
+        self.assertEqual(models.UrlIndex.get_known_urls(), None)
+        # ... which is remembered, in this instance and in memcache
+        models.UrlIndex._known_urls.clear()
+        self.assertEqual(count_calls(models.UrlIndex.get_known_urls), 0)
+        self.assertEqual(models.UrlIndex.get_known_urls(), None)
+        # A backfill is queued once
+        models.UrlIndex.request_rebuild(gov)
+        models.UrlIndex.request_backfill(gov)
+        models.UrlIndex.request_backfill(gov)
+        self.assertEqual(gov.run_tasks(), 1)
+        self.assertTrue(models.UrlIndex.get_by_key_name(models.UrlIndex.BACKFILLED))
+        # ... after which the list is rebuilt
+        self.assertEqual(models.UrlIndex.get_known_urls(), None)
+        self.assertTrue(models.UrlIndex.may_exist(['/nothing/here']))
+        memcache.delete('_known_urls_rebuild_queued')
+        models.UrlIndex.request_rebuild(gov)
+        self.settle_url_changes()
+        self.assertEqual(gov.run_tasks(), 1)
+        known = models.UrlIndex.get_known_urls()
+        self.assertTrue('/' in known)
+        self.assertFalse(models.UrlIndex.BACKFILLED in known)
+        self.assertFalse(models.UrlIndex.may_exist(['/nothing/here']))
+
+        # Urls indexed or removed later are known right away, without a query
+        r = models.Resource.get_resource_by_url('/')
+        models.UrlIndex.remove(r)
+        self.assertFalse('/' in models.UrlIndex.get_known_urls())
+        models.UrlIndex.set(r)
+        self.assertEqual(count_calls(models.UrlIndex.get_known_urls), 0)
+        self.assertEqual(models.UrlIndex.get_known_urls(), known)
+        # Other sites have their own list
+        namespace = namespace_manager.get_namespace()
+        namespace_manager.set_namespace('othersite')
+        try:
+            self.assertEqual(models.UrlIndex.get_known_urls(), None)
+        finally:
+            namespace_manager.set_namespace(namespace)
+        self.assertEqual(models.UrlIndex.get_known_urls(), known)
+
+    @highlight
+    def test_response_cache(self):
+        gov = self.install_controller(AccessRecorder(pickledsites.make_fake_site('C0')))
+        resource_key = db.Key.from_path('DirEntry', '/page.txt', 'Resource', '/page')
+        cache.set_cached_response('/page', 200, [('Content-Type', 'text/html')],
+                                  'cached body', None, max_age=60,
+                                  resource_key=str(resource_key))
+        # A hit is served without touching the datastore
+        h = self.handler('/page')
+        self.assertEqual(count_calls(h.get, '/page'), 0)
+        self.assertEqual(h.response.status, 200)
+        self.assertEqual(h.response.out.getvalue(), 'cached body')
+        # ... but the access is still notified, so syncs are triggered
+        self.assertEqual(gov.accessed, [(None, None, resource_key)])
+        # ... at most once per interval
+        self.handler('/page').get('/page')
+        self.assertEqual(len(gov.accessed), 1)
+        # Until a controller is loaded in this instance, hits are not notified
+        controller._controllers.clear()
+        memcache.flush_all()
+        cache.set_cached_response('/page', 200, [('Content-Type', 'text/html')],
+                                  'cached body', None, max_age=60,
+                                  resource_key=str(resource_key))
+        h = self.handler('/page')
+        self.assertEqual(count_calls(h.get, '/page'), 0)
+        self.assertEqual(h.response.out.getvalue(), 'cached body')
+        self.assertEqual(len(gov.accessed), 1)
+        # Query strings and ranges go past the cache
+        self.assertFalse(self.handler('/page?x=1').serve_cached('/page'))
+        self.assertFalse(self.handler('/page', {'Range': 'bytes=0-3'}).serve_cached('/page'))
+        # ... and are not cached
+        h = self.handler('/other?x=1')
+        h.response.out.write('other body')
+        h.cache_response('/other')
+        self.assertEqual(cache.get_cached_response('/other'), None)
+        h = self.handler('/other')
+        h.response.out.write('other body')
+        h.cache_response('/other')
+        self.assertEqual(cache.get_cached_response('/other')[2], 'other body')
+
+        # An entry with only a gzipped body is not served to clients without gzip
+        cache.set_cached_response('/gz', 200, [('Content-Type', 'text/html')],
+                                  None, 'gzipped body', max_age=60)
+        self.assertFalse(self.handler('/gz').serve_cached('/gz'))
+        self.assertFalse(self.handler('/gz', {'Accept-Encoding': 'gzip;q=0'}).serve_cached('/gz'))
+        h = self.handler('/gz', {'Accept-Encoding': 'gzip'})
+        self.assertTrue(h.serve_cached('/gz'))
+        self.assertEqual(h.response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(h.response.out.getvalue(), 'gzipped body')
+
+        # Flushing bumps the generation, so all entries are gone
+        generation = cache.response_generation.get()
+        cache.flush_responses()
+        self.assertNotEqual(cache.response_generation.get(), generation)
+        for url in ['/page', '/other', '/gz']:
+            self.assertEqual(cache.get_cached_response(url), None)
+        self.assertFalse(self.handler('/page').serve_cached('/page'))
+
+    @highlight
+    def test_not_modified(self):
+        self.gov = ImmediateController(pickledsites.make_fake_site('C0'))
+        r = self.make_raw('0123456789')
+        etag, last_modified = r.get_validators(self.gov)
+        since = resources.http_date(last_modified)
+        earlier = resources.http_date(last_modified-timedelta(seconds=1))
+
+        h = self.serve(r)
+        self.assertEqual(h.response.status, 200)
+        self.assertEqual(h.response.headers['ETag'], etag)
+        self.assertEqual(h.response.headers['Last-Modified'], since)
+        self.assertEqual(h.response.out.getvalue(), '0123456789')
+
+        # Uncached
+        for headers, status in [
+            ({'If-None-Match': etag}, 304),
+            ({'If-None-Match': '"rev1", W/%s'%etag}, 304),
+            ({'If-None-Match': '*'}, 304),
+            ({'If-None-Match': '"rev1"'}, 200),
+            # If-None-Match takes precedence
+            ({'If-None-Match': '"rev1"', 'If-Modified-Since': since}, 200),
+            ({'If-Modified-Since': since}, 304),
+            ({'If-Modified-Since': earlier}, 200),
+            ({'If-Modified-Since': 'not a date'}, 200)]:
+            h = self.serve(r, headers)
+            self.assertEqual((headers, h.response.status), (headers, status))
+            self.assertEqual(h.response.out.getvalue(), (status == 200 and '0123456789') or '')
+
+        # Cached: the validators are stored with the response
+        self.install_controller(AccessRecorder(pickledsites.make_fake_site('C0')))
+        h.cache_response(r.url, r.key())
+        for headers, status in [
+            ({'If-None-Match': etag}, 304),
+            ({'If-None-Match': '"rev1"'}, 200),
+            ({'If-Modified-Since': since}, 304),
+            ({'If-Modified-Since': earlier}, 200)]:
+            h = self.handler(r.url, headers)
+            self.assertEqual(count_calls(h.get, r.url), 0)
+            self.assertEqual((headers, h.response.status), (headers, status))
+            self.assertEqual(h.response.headers['ETag'], etag)
+            self.assertEqual(h.response.out.getvalue(), (status == 200 and '0123456789') or '')
+
+    @highlight
+    def test_gzip(self):
+        for accept, accepted in [
+            (None, False),
+            ('gzip', True),
+            ('deflate, gzip;q=0.5', True),
+            ('x-gzip', True),
+            ('GZIP', True),
+            ('identity', False),
+            ('gzip;q=0', False),
+            ('gzip; q=0.0, deflate', False)]:
+            headers = (accept and {'Accept-Encoding': accept}) or {}
+            self.assertEqual((accept, models.accepts_gzip(self.handler('/', headers).request)),
+                             (accept, accepted))
+
+        text = 'Some text worth compressing. '*100
+        for content_type, compressed in [
+            ('text/html', True),
+            ('text/css; charset=utf-8', True),
+            ('application/javascript', True),
+            ('image/svg+xml', True),
+            ('application/atom+xml', True),
+            ('image/png', False),
+            ('application/octet-stream', False)]:
+            self.assertEqual((content_type, models.gzip_compress(text, content_type) is not None),
+                             (content_type, compressed))
+        # Small bodies are not worth it
+        self.assertEqual(models.gzip_compress(text[:config.GZIP_MIN_SIZE-1], 'text/html'), None)
+        text_gz = models.gzip_compress(text, 'text/html')
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(text_gz)).read(), text)
+
+        # The variant is picked by Accept-Encoding, and either varies by it
+        h = self.handler('/', {'Accept-Encoding': 'gzip'})
+        models.write_body(h, text, text_gz)
+        self.assertEqual(h.response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(h.response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(h.response.out.getvalue(), text_gz)
+        for accept in [None, 'gzip;q=0']:
+            h = self.handler('/', (accept and {'Accept-Encoding': accept}) or {})
+            models.write_body(h, text, text_gz)
+            self.assertEqual(h.response.headers.get('Content-Encoding'), None)
+            self.assertEqual(h.response.headers['Vary'], 'Accept-Encoding')
+            self.assertEqual(h.response.out.getvalue(), text)
+        # Without a gzipped variant, the response does not vary
+        h = self.handler('/', {'Accept-Encoding': 'gzip'})
+        models.write_body(h, text, None)
+        self.assertEqual(h.response.headers.get('Content-Encoding'), None)
+        self.assertEqual(h.response.headers.get('Vary'), None)
+        self.assertEqual(h.response.out.getvalue(), text)
+
+    @highlight
+    def test_parse_range(self):
+        for header, expected in [
+            (None, None),
+            ('bytes=0-3', (0, 3)),
+            ('bytes=4-', (4, 9)),
+            ('bytes=-3', (7, 9)),
+            ('bytes=-30', (0, 9)),
+            ('bytes=5-100', (5, 9)),
+            ('bytes=-0', False),
+            ('bytes=10-', False),
+            ('bytes=4-3', False),
+            ('bytes=0-1,4-5', None),
+            ('bytes=a-b', None),
+            ('items=0-3', None)]:
+            self.assertEqual((header, resources.parse_range(header, 10)), (header, expected))
+
+    @highlight
+    def test_chunked_content(self):
+        self.gov = ImmediateController(pickledsites.make_fake_site('C0'))
+        chunk_size = config.CONTENT_CHUNK_SIZE
+        config.CONTENT_CHUNK_SIZE = 4
+        try:
+            data = '0123456789'
+            r = self.make_raw(data)
+            self.assertEqual(r.chunk_count, 3)
+            self.assertEqual(r.source, None)
+            # Reassembled from all chunks
+            h = self.serve(r)
+            self.assertEqual(h.response.status, 200)
+            self.assertEqual(h.response.headers['Accept-Ranges'], 'bytes')
+            self.assertEqual(h.response.out.getvalue(), data)
+
+            for range_, first, last in [
+                ('bytes=3-8', 3, 8),   # across chunks
+                ('bytes=4-7', 4, 7),   # a single chunk
+                ('bytes=-3', 7, 9),    # suffix
+                ('bytes=6-', 6, 9),    # open-ended
+                ('bytes=2-100', 2, 9)]:
+                h = self.serve(r, {'Range': range_})
+                self.assertEqual(h.response.status, 206)
+                self.assertEqual(h.response.headers['Content-Range'], 'bytes %d-%d/10'%(first, last))
+                self.assertEqual(h.response.out.getvalue(), data[first:last+1])
+
+            h = self.serve(r, {'Range': 'bytes=10-'})
+            self.assertEqual(h.response.status, 416)
+            self.assertEqual(h.response.headers['Content-Range'], 'bytes */10')
+            self.assertEqual(h.response.out.getvalue(), '')
+            # A range for another revision is ignored
+            h = self.serve(r, {'Range': 'bytes=3-8', 'If-Range': '"rev2"'})
+            self.assertEqual(h.response.status, 200)
+            self.assertEqual(h.response.out.getvalue(), data)
+
+            # The chunks of a replaced revision are kept until the grace
+            # period is over, so requests that loaded it can finish
+            old = resources.RawResource.get(r.key())
+            new = self.make_raw('abcdefghijklm', revision=4, r=r)
+            # ... also when the task of an earlier fetch runs late
+            resources.delete_stale_chunks_by_key(self.gov, str(new.key()), 3)
+            chunks = [k.name() for k in resources.ContentChunk.all(keys_only=True).ancestor(new)]
+            self.assertEqual(len(chunks), 7)
+            self.assertEqual(''.join(old.iter_content()), data)
+            self.assertEqual(''.join(new.iter_content()), 'abcdefghijklm')
+            resources.delete_stale_chunks_by_key(self.gov, str(new.key()), new.revision)
+            chunks = [k.name() for k in resources.ContentChunk.all(keys_only=True).ancestor(new)]
+            self.assertEqual(chunks, ['r4-%06d'%i for i in range(4)])
+            self.assertRaises(models.FormatError, lambda: ''.join(old.iter_content()))
+            # Chunks go with their resource
+            new.delete()
+            resources.delete_stale_chunks_by_key(self.gov, str(new.key()), new.revision)
+            self.assertEqual(resources.ContentChunk.all().count(), 0)
+        finally:
+            config.CONTENT_CHUNK_SIZE = chunk_size
+
+    @highlight
+    def test_template_cache(self):
+        self.gov = controller.Controller(pickledsites.make_fake_site('C0'))
+        path = config.TEMPLATE_DIR+'/base.html'
+        entry = models.DirEntry(key_name=path, revision=1)
+        entry.put()
+        t = resources.TextResource(parent=entry, key_name=path, url=path, revision=1, source=u'Base')
+        t.put()
+        self.assertEqual(templateloader.get_template_source(path), (1, u'Base'))
+
+        # Compiled templates are reused within a template generation only
+        loader = templateloader.TemplateLoader()
+        compiled = loader.load_template('base.html')[0]
+        self.assertTrue(loader.load_template('base.html')[0] is compiled)
+        cache.template_generation.bump()
+        self.assertFalse(loader.load_template('base.html')[0] is compiled)
+
+        # The source is flushed when the template is removed
+        t.delete()
+        self.assertEqual(templateloader.get_template_source(path), (1, u'Base'))
+        self.gov.handle_metadata_changes(removed=[entry])
+        self.assertEqual(templateloader.get_template_source(path), None)